@@ -5,56 +5,111 @@ Created on Mon Aug  9 16:01:33 2021
 @author: Gillies
 """
 
-import numpy
-from numpy import float32, zeros
-import math
-import imageio
 import os
+import queue
+import threading
 
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 from tkinter import *
 
-# These are the gain, offset, effective bandwidth, and band-averaged solar spectral irradiance 
-# figures for each band, in dictionary form.  The gain and offset figures came from 
-# "ABSOLUTE RADIOMETRIC CALIBRATION",
-# published by Maxar in 2021.
- # The solar spectral irradiance and effective bandwith figures came from the PDF 
-# "Radiometric Use of WorldView-3 Imagery",
-# published by DigitalGlobe in 2016.
-calibration_figures = [{"band": "Pan", "gain": 0.955, "offset": -5.505, "effective bandwidth": 0.2896, "band averaged solar_spectral irradiance (Thuillier 2003)": 1574.41},
-                       {"band": "Coastal", "gain": 0.938, "offset": -13.099, "effective bandwidth": 0.0405, "band averaged solar_spectral irradiance (Thuillier 2003)": 1757.89},
-                       {"band": "Blue", "gain": 0.946, "offset": -9.409, "effective bandwidth": 0.0540, "band averaged solar_spectral irradiance (Thuillier 2003)": 2004.61},
-                       {"band": "Green", "gain": 0.958, "offset": -7.771, "effective bandwidth": 0.0618, "band averaged solar_spectral irradiance (Thuillier 2003)": 1830.18},
-                       {"band": "Yellow", "gain": 0.979, "offset": -5.489, "effective bandwidth": 0.0381, "band averaged solar_spectral irradiance (Thuillier 2003)": 1712.07},
-                       {"band": "Red", "gain": 0.969, "offset": -4.579, "effective bandwidth": 0.0585, "band averaged solar_spectral irradiance (Thuillier 2003)": 1535.33},
-                       {"band": "RedEdge", "gain": 1.027, "offset": -5.552, "effective bandwidth": 0.0387, "band averaged solar_spectral irradiance (Thuillier 2003)": 1348.08},
-                       {"band": "NIR1", "gain": 0.977, "offset": -6.508, "effective bandwidth": 0.1004, "band averaged solar_spectral irradiance (Thuillier 2003)": 1055.94},
-                       {"band": "NIR2", "gain": 1.007, "offset": -3.699, "effective bandwidth": 0.0889, "band averaged solar_spectral irradiance (Thuillier 2003)": 858.77}]
-
-# These figures would ideally be read automatically from the *.imd file included with the Worldview-3 images.
-# Since we don't actually have an *.imd file, we'll have to input them manually.
-# These would be automatically read in the real version of the script.
-abscal_factor = 0
-earth_sun_distance = 0
-solar_zenith_angle = 0
-
-# This function sets the GUI progress bar maximum value to a figure equal to the height of the input image
-def setProgressBarMaximum(xDim):
-    progessBarOne['maximum']=xDim
-    root.update_idletasks()
-
-# As the script loops through the image and calculates the TOA reflectance values for each pixel,
-# this function increases the progress bar value by 1 each time the script starts processing
-# a new row of pixels on the y-axis
-def makeProgress():
-	progessBarOne['value']=progessBarOne['value'] + 1
-	root.update_idletasks()
+# The TOA calculation itself (with the gain, offset, effective bandwidth, and band-averaged
+# solar spectral irradiance figures for each band) lives in toa_reflectance.py, so it can be
+# used without the GUI
+from toa_reflectance import process_scene, ProcessingCancelled, ALL_BANDS, DEFAULT_BLOCK_ROWS
+from imd_metadata import parse_imd, parameters_from_metadata
+
+# The abscal factor, earth-sun distance and solar zenith angle can be typed in by hand, or read
+# from the *.IMD (or *.XML) file included with the Worldview-3 images (see imd_metadata.py).
+# When a metadata file has been read, its figures are kept here and used for the calculation,
+# including every band's own abscal factor and effective bandwidth.
+scene_metadata = None
+
+# The calculation runs on a worker thread, so the window stays responsive.  The worker puts
+# messages on this queue, and the GUI thread checks it every PROGRESS_REDRAW_MS milliseconds:
+#   ('progress', rows done, total rows), ('done', output path), ('cancelled',), ('error', message)
+progress_queue = queue.Queue()
+PROGRESS_REDRAW_MS = 100
+
+# Set by the Cancel button; the worker checks it before each block of rows
+cancel_event = threading.Event()
+
+# This function moves the progress bar to the number of rows of pixels done so far.
+# The maximum is the height of the input image.
+def showProgress(rows_done, total_rows):
+    progessBarOne['maximum'] = total_rows
+    progessBarOne['value'] = rows_done
+
+# This runs on the worker thread.  It does the calculation (see process_scene in toa_reflectance.py)
+# and reports back through "progress_queue"; it never touches the GUI itself.
+def calculate_in_background(path, this_band, abscal_factor, earth_sun_distance, solar_zenith_angle, effective_bandwidth, output_format):
+    try:
+        out_path = process_scene(path, this_band, abscal_factor, earth_sun_distance, solar_zenith_angle,
+                                 output_format=output_format, effective_bandwidth=effective_bandwidth, block_rows=DEFAULT_BLOCK_ROWS,
+                                 progress=lambda rows_done, total_rows: progress_queue.put(('progress', rows_done, total_rows)),
+                                 cancel=cancel_event)
+        progress_queue.put(('done', out_path))
+    except ProcessingCancelled:
+        progress_queue.put(('cancelled',))
+    except Exception as error:
+        progress_queue.put(('error', str(error)))
+
+# This runs on the GUI thread every PROGRESS_REDRAW_MS milliseconds while the worker is busy.
+# It takes everything off the queue, but only redraws the progress bar once, with the latest figures.
+def checkProgress():
+    latest_progress = None
+    while True:
+        try:
+            message = progress_queue.get_nowait()
+        except queue.Empty:
+            break
+        if message[0] == 'progress':
+            latest_progress = message[1:]
+            continue
+        
+        # The worker has finished
+        if message[0] == 'done':
+            # Show a success messagebox, and close the main window.  The program is complete.
+            showProgress(1, 1)
+            messagebox.showinfo("Complete", "Processing is complete.  The TOA reflectance values are saved in the original directory as '" + os.path.basename(message[1]) + "'.")
+            root.destroy()
+            return
+        if message[0] == 'cancelled':
+            messagebox.showinfo("Cancelled", "Processing was cancelled.  No output was saved.")
+        else:
+            messagebox.showerror("Error", "Processing failed: " + message[1])
+        showProgress(0, 1)
+        setRunning(False)
+        return
+    
+    if latest_progress is not None:
+        showProgress(*latest_progress)
+    root.after(PROGRESS_REDRAW_MS, checkProgress)
+
+# While the worker is busy, the user can cancel but can't start another calculation
+def setRunning(running):
+    chooseButton['state'] = DISABLED if running else NORMAL
+    cancelButton['state'] = NORMAL if running else DISABLED
+
+# This function is called when the user clicks the Cancel button
+def cancel_calculation():
+    cancel_event.set()
+    cancelButton['state'] = DISABLED
 
 # This function gets the band chosen in the dropdown by the user
 def getBand():
 	return bands.get()
 
+# The output formats offered in the GUI, and the format names toa_reflectance.py uses for them
+output_format_choices = {'Text file (.txt)': 'txt',
+                         'GeoTIFF (.tif)': 'gtiff',
+                         'NumPy array (.npy)': 'npy',
+                         'Raw memory-mapped file (.dat)': 'memmap'}
+
+# This function gets the output format chosen in the dropdown by the user
+def getOutputFormat():
+    return output_format_choices[output_formats.get()]
+
 # This function gets the abscal factor input by the user in the input box
 def getAbscalFactor():
     userInput = abscalfactor_input.get()
@@ -70,89 +125,88 @@ def getSolarZenithAngle():
 	userInput = solarzenithangle_input.get()
 	return userInput
 
-def getValueFromBand(band, value):
-    for b in calibration_figures:
-        if (b['band'] == band):
-            return b[value]
+# This function is called when the user clicks the "Read figures from .IMD" button.
+# It reads the chosen metadata file and fills the input boxes with its figures.
+def load_imd():
+    global scene_metadata
+    imd_path = filedialog.askopenfilename(initialdir = os.path.join(os.environ['HOMEPATH'], "Desktop"),
+                                          title = "Choose the *.IMD or *.XML file of the Worldview-3 image",
+                                          filetypes = [("Worldview-3 metadata", "*.IMD *.imd *.XML *.xml"), ("All files", "*.*")])
+    if not imd_path:
+        return
+    try:
+        scene_metadata = parse_imd(imd_path)
+    except Exception as error:
+        messagebox.showerror("Error", "Could not read the metadata file: " + str(error))
+        return
+    showMetadata()
+
+# Show the figures read from the metadata file in the input boxes, for the band chosen in the dropdown
+def showMetadata(event=None):
+    if scene_metadata is None:
+        return
+    this_band = getBand()
+    abscal_factor = scene_metadata['abscal_factors'].get(this_band, "")
+    if this_band == ALL_BANDS:
+        abscal_factor = "from the .IMD file"
+    for entry, value in ((abscalfactor_input, abscal_factor),
+                         (earthsundistance_input, scene_metadata['earth_sun_distance']),
+                         (solarzenithangle_input, scene_metadata['solar_zenith_angle'])):
+        entry.delete(0, END)
+        entry.insert(0, str(value))
 
 # This is the main function which does the calculation, called when
 # the user chooses an input image
 def choose_and_calculate():
+    # We'll get all the values of the input boxes of the GUI.  A metadata file fills the boxes
+    # when it is read, and any changes the user makes to them afterwards are kept; the file is
+    # only used for the per-band figures that have no box: the effective bandwidth, and the
+    # abscal factor of every band when "All bands" is chosen.
+    # A box that doesn't hold a number, or a band the metadata file has no figures for (the Pan
+    # band with the metadata of a multispectral image, for example), is reported to the user
+    # before any file is chosen.
+    this_band = getBand()
+    try:
+        earth_sun_distance = float(getEarthSunDistance())
+        solar_zenith_angle = float(getSolarZenithAngle())
+        effective_bandwidth = None
+        if scene_metadata is not None:
+            parameters = parameters_from_metadata(scene_metadata, this_band)
+            effective_bandwidth = parameters['effective_bandwidth']
+        if this_band == ALL_BANDS and scene_metadata is not None:
+            abscal_factor = parameters['abscal_factor']
+        else:
+            abscal_factor = float(getAbscalFactor())
+    except ValueError as error:
+        messagebox.showerror("Error", "Can't calculate the " + this_band + " band: " + str(error))
+        return
+
     # A file dialog pops up, and asks the user to choose the file to process.
     # The path to that file (plus the filename) is stored in a variable called "path"
     path = os.path.abspath(filedialog.askopenfilename(initialdir = os.path.join(os.environ['HOMEPATH'], "Desktop"), title = "Choose the Worldview-3 image you want to calculate from"))
-    # ALso, we'll get the file extension from the last part of the filename by splitting it
-    # This is done because we are going to save a text file at the end of the script
-    # and we're going to replace the file extension (for example, .jpg) with 
-    # the text _resampled_and_converted.txt"
-    file_extension = os.path.split(path)[len(os.path.split(path))-1].split(".")[1]
-    
-    # Read the chosen image and get the width and height
-    image = imageio.imread(path)
-    width = image.shape[1]
-    height = image.shape[0]
-    
-    # Now that we know the height of the image, we'll set the progress bar maximum
-    setProgressBarMaximum(height)
     
-    # We'll get all the values of the input boxes of the GUI
-    abscal_factor = float(getAbscalFactor())
-    earth_sun_distance = float(getEarthSunDistance())
-    solar_zenith_angle = float(getSolarZenithAngle())
-    this_band = getBand()
-    
-    # Depending on the band the user chose to analyze, the gain, offset
-    # effective bandwidth, and solar spectral irradiance figures will be different,
-    # so we use a function (getValueFromBand) to retrieve the gain, offset,
-    # effective bandwidth and solar spectral irradiance from the "calibration_figures" dictionary,
-    # depending on the band that was chosen
-    thisBandsGain = getValueFromBand(this_band, 'gain')
-    thisBandsOffset = getValueFromBand(this_band, 'offset')
-    thisBandsEffectiveBandwidth = getValueFromBand(this_band, 'effective bandwidth')
-    thisBandsSolarSpectralIrradiance = getValueFromBand(this_band, 'band averaged solar_spectral irradiance (Thuillier 2003)')
-    
-    # This is an array which will hold the TOA reflectance values.
-    # it is a 3D array simply because the input images I have access to are all 3-band images
-    # (RGB).  This part of the code may have to be changed if the actual Worldview-3 images
-    # turn out to be single-band
-    toa_reflectance_values = zeros((height, width, 3), dtype=float32)
-    
-    # The text file containing the TOA reflectance values needs to be created at the end
-    # of this script.  However, it is impossible with numpy to write a 3D array to a text file,
-    # so here, we create a 2D array which will eventually hold the TOA reflectance values
-    toa_reflectance_values_one_dimension = zeros((height, width), dtype=float32)
-    
-    # Here we go, a double for loop to get the values of each pixel and calculate the TOA reflectance
-    for y in range(toa_reflectance_values.shape[0]):
-        # We've started on a new y-axis row of pixels, so increase the progress bar by one
-        makeProgress()
-        for x in range(toa_reflectance_values.shape[1]):
-            # Get the value of the pixel from the original image
-            dn_of_this_pixel = image[y][x]
-            
-            # Calculate the TOA radiance of the pixel, using the value above and the values gotten from
-            # the "calibration_figures" dictionary, as well as values the user input in the GUI
-            toa_radiance_of_this_pixel = thisBandsGain * (dn_of_this_pixel * (abscal_factor/thisBandsEffectiveBandwidth)) + thisBandsOffset
-            
-            # Finally, get the TOA reflectance 
-            toa_reflectance_of_this_pixel = (toa_radiance_of_this_pixel * pow(earth_sun_distance, 2) * math.pi) / (thisBandsSolarSpectralIrradiance * math.cos(solar_zenith_angle))
-            
-            # Put the value gotten above into the "toa_reflectance_values" array.  That is a 3D array, because
-            # the input images used for testing are all 3-band (RGB) images
-            toa_reflectance_values[y][x] = toa_reflectance_of_this_pixel
-            
-            # The array we will use to write the text file has to be a 2D array,
-            # so here average the R, G and B values of the 3D array into one value, and place
-            # it in the "toa_reflectance_values_one_dimension" array
-            toa_reflectance_values_one_dimension[y][x] = (toa_reflectance_values[y][x][0] + toa_reflectance_values[y][x][1] + toa_reflectance_values[y][x][2]) / 3 
-
-            
-    # Finally, the double for loop is over, so we write the TOA reflectance values array to a text file
-    numpy.savetxt(path.replace(file_extension, "_resampled_and_converted.txt"), toa_reflectance_values_one_dimension, newline="\n")
+    output_format = getOutputFormat()
     
-    # Show a success messagebox, and close the main window.  The program is complete.
-    messagebox.showinfo("Complete", "Processing is complete.  A text file containing all the values is saved in the original directory with the name 'toa_reflectance.txt'.")
-    root.destroy()
+    # Calculate the TOA reflectance (see process_scene in toa_reflectance.py).  The gain, offset,
+    # effective bandwidth and solar spectral irradiance figures for the chosen band come
+    # from the "calibration_figures" dictionary in toa_reflectance.py, and are combined with the values the user
+    # input in the GUI into one scale and one offset.
+    # The image is never loaded whole: it is read, converted and written DEFAULT_BLOCK_ROWS
+    # rows at a time, so even very large scenes fit in memory.  If the input image has more
+    # than one channel (the RGB test images), the R, G and B values are averaged into one
+    # value per pixel.
+    # If the user chose "All bands", every band of a multi-band image (8-band multispectral, or
+    # all nine bands) is calibrated in one pass over the file, each with its own figures from
+    # the "calibration_figures" dictionary in toa_reflectance.py, and a multi-band result is saved.
+    # The result is saved next to the original image, with the suffix "_resampled_and_converted".
+    # The calculation runs on a worker thread at full speed, and checkProgress picks up
+    # its progress and result (see above).
+    cancel_event.clear()
+    setRunning(True)
+    threading.Thread(target=calculate_in_background,
+                     args=(path, this_band, abscal_factor, earth_sun_distance, solar_zenith_angle, effective_bandwidth, output_format),
+                     daemon=True).start()
+    root.after(PROGRESS_REDRAW_MS, checkProgress)
     
     # NOTE: The TOA reflectance value of each pixel could of course be used to brighten or darken 
     # each corresponding pixel of the original image, then an adjusted version of the original image
@@ -167,60 +221,89 @@ def choose_and_calculate():
     # For example, if it was a 10-pixel high and 5-pixel wide image, it is now
     # a 5-row 'high' and 10-column 'wide' text file.  We can take this into acccount if and when
     # we have to work with the text file.
+    # The GeoTIFF, .npy and memory-mapped outputs don't have this problem: they keep the
+    # rows and columns of the input image (and the GeoTIFF keeps its georeferencing), and can
+    # be read a window at a time without parsing any text.
 
 # The code below is just for creating the GUI ---------------------------------------
-root = Tk()
-root.geometry('350x290')
-root.configure(background='#E0EEEE')
-root.title('Calculate TOA Reflectance')
-
-bands= ttk.Combobox(root, values=['Pan', 'Coastal', 'Blue', 'Green', 'Yellow', 'Red', 'RedEdge', 'NIR1', 'NIR2'], font=('arial', 12, 'normal'), width=30)
-bands.place(x=32, y=45)
-bands.current(0)
-
-Label(root, text='Choose a band', 
-      bg='#E0EEEE', 
-      font=('arial', 12, 'normal')).place(x=32, y=15)
-Label(root, text='Earth-Sun distance', 
-      bg='#E0EEEE', 
-      font=('arial', 12, 'normal')).place(x=32, y=125)
-Label(root, text='Abscal factor ', 
-      bg='#E0EEEE', 
-      font=('arial', 12, 'normal')).place(x=72, y=95)
-Label(root, text='Solar zenith angle', 
-      bg='#E0EEEE', 
-      font=('arial', 12, 'normal')).place(x=42, y=155)
-
-abscalfactor_input=Entry(root)
-abscalfactor_input.insert(0, "float, for example 3.14")
-abscalfactor_input.place(x=182, y=95)
-
-earthsundistance_input=Entry(root)
-earthsundistance_input.insert(0, "float, for example 3.14")
-earthsundistance_input.place(x=182, y=125)
-
-solarzenithangle_input=Entry(root)
-solarzenithangle_input.insert(0, "float, for example 3.14")
-solarzenithangle_input.place(x=182, y=155)
-
-Button(root, text='Choose an image and calculate', 
-       bg='#C1CDCD', 
-       font=('arial', 12, 'normal'), 
-       command=choose_and_calculate).place(x=52, y=195)
-
-progessBarOne_style = ttk.Style()
-progessBarOne_style.theme_use('clam')
-progessBarOne_style.configure('progessBarOne.Horizontal.TProgressbar', 
-                              foreground='#76EE00', 
-                              background='#76EE00')
-
-progessBarOne=ttk.Progressbar(root, 
-                              style='progessBarOne.Horizontal.TProgressbar', 
-                              orient='horizontal', 
-                              length=290, 
-                              mode='determinate', 
-                              maximum=100, 
-                              value=0)
-progessBarOne.place(x=32, y=250)
-root.mainloop()
+# It only runs when this script is run directly, so the functions above can be imported
+# without opening a window (the calculation itself is in toa_reflectance.py, and
+# toa_batch.py runs it from the command line)
+if __name__ == '__main__':
+    root = Tk()
+    root.geometry('350x360')
+    root.configure(background='#E0EEEE')
+    root.title('Calculate TOA Reflectance')
+
+    bands= ttk.Combobox(root, values=['Pan', 'Coastal', 'Blue', 'Green', 'Yellow', 'Red', 'RedEdge', 'NIR1', 'NIR2', ALL_BANDS], font=('arial', 12, 'normal'), width=30)
+    bands.place(x=32, y=45)
+    bands.current(0)
+    bands.bind('<<ComboboxSelected>>', showMetadata)
+
+    Label(root, text='Choose a band', 
+          bg='#E0EEEE', 
+          font=('arial', 12, 'normal')).place(x=32, y=15)
+    Label(root, text='Earth-Sun distance', 
+          bg='#E0EEEE', 
+          font=('arial', 12, 'normal')).place(x=32, y=125)
+    Label(root, text='Abscal factor ', 
+          bg='#E0EEEE', 
+          font=('arial', 12, 'normal')).place(x=72, y=95)
+    Label(root, text='Solar zenith angle', 
+          bg='#E0EEEE', 
+          font=('arial', 12, 'normal')).place(x=42, y=155)
+
+    abscalfactor_input=Entry(root)
+    abscalfactor_input.insert(0, "float, for example 3.14")
+    abscalfactor_input.place(x=182, y=95)
+
+    earthsundistance_input=Entry(root)
+    earthsundistance_input.insert(0, "float, for example 3.14")
+    earthsundistance_input.place(x=182, y=125)
+
+    solarzenithangle_input=Entry(root)
+    solarzenithangle_input.insert(0, "float, for example 3.14")
+    solarzenithangle_input.place(x=182, y=155)
+
+    Label(root, text='Output format', 
+          bg='#E0EEEE', 
+          font=('arial', 12, 'normal')).place(x=62, y=190)
+
+    output_formats= ttk.Combobox(root, values=list(output_format_choices), font=('arial', 10, 'normal'), width=20)
+    output_formats.place(x=182, y=190)
+    output_formats.current(0)
+
+    chooseButton=Button(root, text='Choose an image and calculate', 
+                        bg='#C1CDCD', 
+                        font=('arial', 12, 'normal'), 
+                        command=choose_and_calculate)
+    chooseButton.place(x=52, y=230)
+
+    progessBarOne_style = ttk.Style()
+    progessBarOne_style.theme_use('clam')
+    progessBarOne_style.configure('progessBarOne.Horizontal.TProgressbar', 
+                                  foreground='#76EE00', 
+                                  background='#76EE00')
+
+    progessBarOne=ttk.Progressbar(root, 
+                                  style='progessBarOne.Horizontal.TProgressbar', 
+                                  orient='horizontal', 
+                                  length=290, 
+                                  mode='determinate', 
+                                  maximum=100, 
+                                  value=0)
+    progessBarOne.place(x=32, y=285)
+
+    cancelButton=Button(root, text='Cancel', 
+                        bg='#C1CDCD', 
+                        font=('arial', 12, 'normal'), 
+                        state=DISABLED, 
+                        command=cancel_calculation)
+    cancelButton.place(x=252, y=315)
+
+    Button(root, text='Read figures from .IMD', 
+           bg='#C1CDCD', 
+           font=('arial', 12, 'normal'), 
+           command=load_imd).place(x=32, y=315)
+    root.mainloop()
 #  ------------------------------------------------------------------------------
\ No newline at end of file
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""
+The file handling shared by the batch tools (toa_batch.py and resample_batch.py) and the
+engines they run (toa_reflectance.py and geotiff_resampler.py): finding the input files,
+and the temporary name outputs are written under until they are complete.
+
+It only uses the standard library, so importing it doesn't pull in rasterio, GDAL or either engine.
+"""
+
+import glob
+import os
+
+# The file patterns looked for when a directory is given
+scene_patterns = ['*.tif', '*.tiff', '*.TIF', '*.TIFF']
+
+# The outputs are written under a temporary name next to the final one (keeping its extension), and
+# only renamed once they are complete, so a run that fails or is killed part way never leaves a
+# truncated file under the final name (which the batch tools would take for a finished output)
+def partial_path_for(out_path):
+    base, extension = os.path.splitext(out_path)
+    return base + ".partial" + extension
+
+# Whether a file is an output of the batch tools (finished, or left part way by an earlier run)
+# rather than an input
+def is_output_file(path):
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return "_resampled_and_converted" in stem or stem.endswith(".partial")
+
+# Expand the directories and glob patterns given on the command line into a sorted list of
+# input files.  Outputs of earlier runs are left out (see is_output_file).
+def find_scenes(inputs, patterns=scene_patterns):
+    scenes = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            for pattern in patterns:
+                scenes.update(glob.glob(os.path.join(item, pattern)))
+        else:
+            scenes.update(glob.glob(item))
+    return sorted(os.path.abspath(scene) for scene in scenes if not is_output_file(scene))
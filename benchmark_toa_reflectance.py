@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the vectorized TOA reflectance calculation (toa_reflectance.py) against
+the original per-pixel double for loop from 2_Question_seven.py.  The vectorized version
+is timed twice: with the per-band scale and offset, and with the lookup table that
+toa_reflectance.py uses for integer images.
+
+Run it with, for example:
+    python benchmark_toa_reflectance.py --height 500 --width 500 --band Red
+"""
+
+import argparse
+import math
+import time
+
+import numpy
+from numpy import float32, zeros
+
+from toa_reflectance import getValueFromBand, band_scale_and_offset, apply_scale_and_offset, calculate_toa_reflectance, to_single_layer
+
+# This is the calculation exactly as the original GUI script did it, one pixel at a time,
+# without the progress bar
+def per_pixel_toa_reflectance(image, band, abscal_factor, earth_sun_distance, solar_zenith_angle):
+    thisBandsGain = getValueFromBand(band, 'gain')
+    thisBandsOffset = getValueFromBand(band, 'offset')
+    thisBandsEffectiveBandwidth = getValueFromBand(band, 'effective bandwidth')
+    thisBandsSolarSpectralIrradiance = getValueFromBand(band, 'band averaged solar_spectral irradiance (Thuillier 2003)')
+
+    toa_reflectance_values = zeros((image.shape[0], image.shape[1], 3), dtype=float32)
+    toa_reflectance_values_one_dimension = zeros((image.shape[0], image.shape[1]), dtype=float32)
+
+    for y in range(toa_reflectance_values.shape[0]):
+        for x in range(toa_reflectance_values.shape[1]):
+            dn_of_this_pixel = image[y][x]
+            toa_radiance_of_this_pixel = thisBandsGain * (dn_of_this_pixel * (abscal_factor/thisBandsEffectiveBandwidth)) + thisBandsOffset
+            toa_reflectance_of_this_pixel = (toa_radiance_of_this_pixel * pow(earth_sun_distance, 2) * math.pi) / (thisBandsSolarSpectralIrradiance * math.cos(solar_zenith_angle))
+            toa_reflectance_values[y][x] = toa_reflectance_of_this_pixel
+            toa_reflectance_values_one_dimension[y][x] = (toa_reflectance_values[y][x][0] + toa_reflectance_values[y][x][1] + toa_reflectance_values[y][x][2]) / 3
+
+    return toa_reflectance_values_one_dimension
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the per-pixel and vectorized TOA reflectance calculations")
+    parser.add_argument("--height", type=int, default=300)
+    parser.add_argument("--width", type=int, default=300)
+    parser.add_argument("--band", default="Red")
+    parser.add_argument("--abscal-factor", type=float, default=0.0104)
+    parser.add_argument("--earth-sun-distance", type=float, default=1.0148)
+    parser.add_argument("--solar-zenith-angle", type=float, default=0.6)
+    parser.add_argument("--repeat", type=int, default=5, help="how many times to time the vectorized version")
+    args = parser.parse_args()
+
+    # A random 11-bit, 3-band image, like the RGB test images the GUI was written for
+    image = numpy.random.default_rng(0).integers(0, 2048, size=(args.height, args.width, 3), dtype=numpy.uint16)
+    scene = (args.band, args.abscal_factor, args.earth_sun_distance, args.solar_zenith_angle)
+
+    start = time.perf_counter()
+    expected = per_pixel_toa_reflectance(image, *scene)
+    loop_seconds = time.perf_counter() - start
+
+    # Time a vectorized version, and check it against the per-pixel loop
+    def time_vectorized(calculate):
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            result = to_single_layer(calculate())
+        seconds = (time.perf_counter() - start) / args.repeat
+        return seconds, float(numpy.max(numpy.abs(result - expected))), numpy.allclose(result, expected, rtol=1e-5, atol=1e-6)
+
+    scale, offset = band_scale_and_offset(*scene)
+    results = [("scale and offset", time_vectorized(lambda: apply_scale_and_offset(image, scale, offset))),
+               ("lookup table", time_vectorized(lambda: calculate_toa_reflectance(image, *scene)))]
+
+    pixels = args.height * args.width
+    print("image size:          %d x %d (%d pixels)" % (args.height, args.width, pixels))
+    print("per-pixel loop:      %.3f s (%.0f pixels/s)" % (loop_seconds, pixels / loop_seconds))
+    for name, (seconds, max_difference, matches) in results:
+        print("%-20s %.5f s (%.0f pixels/s), %.0fx faster, max abs difference %.3g (%s)"
+              % (name + ":", seconds, pixels / seconds, loop_seconds / seconds, max_difference, "match" if matches else "MISMATCH"))
+
+if __name__ == '__main__':
+    main()
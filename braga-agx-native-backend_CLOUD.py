@@ -6,32 +6,48 @@ Created on Tue Oct 19 16:28:41 2021
 """
 
 import ee
-import time
 import datetime
 from datetime import date
 import json
 
 from google.cloud import storage
-import random
-
-import rasterio
-
-from tempfile import NamedTemporaryFile
 
 from google.oauth2 import service_account
 
+from ee_tasks import ExportScheduler, active_task_count, INTERACTIVE, TaskTimeout, TaskCancelled
+from png_storage import BUCKET, png_name, public_url, pngs_exist, upload_png, convert_export_to_pngs
+from result_cache import ResultCache, result_key
+from sentinel2_indices import NoSceneFound, export_scale, visualization_parameters, use_fast_path, fetch_index_pngs, select_scene, scene_info, scene_image, add_indices, visualize_indices
+
 service_acct = 'agxactly-app-serviceaccount@agxactly-app-backend.iam.gserviceaccount.com'
 credentials = ee.ServiceAccountCredentials(service_acct, 'agxactly-app-backend-42b1257ae398.json')
 ee.Initialize(credentials)
 
 storage_credentials = service_account.Credentials.from_service_account_file('agxactly-app-backend-42b1257ae398.json')
 storage_client = storage.Client("online-library-app", storage_credentials)
+destination_bucket = storage_client.bucket(BUCKET)
 
-# Create a function that adds an NDVI band to a Sentinel-2 image
-def addNDVI(image):
-    ndvi = image.normalizedDifference(['B8', 'B4']).rename('NDVI');
-    return image.addBands(ndvi);
+# Exports run by this instance, at most MAX_RUNNING_EXPORTS at once, and held back while the whole
+# project has MAX_PROJECT_EXPORTS tasks waiting or running, whichever instance started them (see ee_tasks.py)
+export_scheduler = ExportScheduler(count_project_exports=lambda: active_task_count(ee.data.getTaskList()))
 
+# PNGs already made, kept between requests to this instance and in the bucket (see result_cache.py)
+result_cache = ResultCache(destination_bucket)
+
+# The response to a request that failed, as the frontend expects it
+def failure_response(message, code=400):
+    value = {
+        "success": message,
+        "imageURL": "none",
+        "dateTaken": "none"
+    }
+    
+    returnPackage = json.dumps(value)
+    # Set CORS headers for the main request
+    headers = {
+        'Access-Control-Allow-Origin': '*'
+    }
+    return(returnPackage, code, headers)
 
 def cors_enabled_function(request):
 
@@ -67,104 +83,78 @@ def cors_enabled_function(request):
 
         geometry = ee.Geometry.Polygon(realCoords);
         
-        # today = date.today()
-        # start = str(today.year) + "-" + str(today.month) + "-" + str(today.day)
-        
-        # a_month_ago = date.today() - datetime.timedelta(days = 30)
-        # end = str(a_month_ago.year) + "-" + str(a_month_ago.month-1) + "-" + str(a_month_ago.day)
-        
-        S2_SR = ee.ImageCollection('COPERNICUS/S2_SR').filterBounds(geometry) #.filterDate(end, start);
-
-
-        
-        # Apply this function across your image collection
-        S2_NDVI = S2_SR.map(addNDVI);
-        
-        # Sort the image collection by date and select the most recent image
-        recent_S2 = ee.Image(S2_NDVI
-                     .sort('system:time_start', False)
-                     .sort('CLOUD_COVER').first());
-        
-        #Print the image’s metadata to the console to view its metadata
-        dateTaken = recent_S2.date().format().getInfo().split("T")[0]
+        # The scene picked for this field a short while ago, if there was one (see result_cache.py),
+        # so a repeat request doesn't wait for Earth Engine; otherwise pick the scene (see
+        # sentinel2_indices.py), and get its date and ID from Earth Engine (one round trip)
+        # A field with no scene (or a polygon Earth Engine can't use) gets an answer the frontend can
+        # show, rather than an error without the CORS headers
+        info = result_cache.get_scene(realCoords)
+        if info is None:
+            scene = select_scene(geometry)
+            try:
+                info = scene_info(scene)
+            except ee.EEException as error:
+                return failure_response(str(error))
+            if info is None:
+                return failure_response(str(NoSceneFound()))
+            result_cache.remember_scene(realCoords, info)
+        else:
+            scene = scene_image(info['id'])
+        
+        # Add the NDVI band to the scene
+        recent_S2 = add_indices(scene, ['NDVI'])
+        dateTaken = info['date']
         print(dateTaken)
         
-        recent_S2_for_export = recent_S2.select('NDVI').visualize(**{
-            'min': 0,
-            'max': 1,
-            'palette': ['FF0000', 'FF6E07', 'FFA500', 'FFDB00', '00FF00', '009700']
-        })
-                        #red     #dark orange  #orange #yellow   #green   #dark green        
-        
-        nameForFile = str(random.random()).replace(".", "") + '_' + dateTaken
-        
-        task = ee.batch.Export.image.toCloudStorage(
-            image=recent_S2_for_export,
-            region=geometry,
-            description='an image from the iPhone frontend',
-            bucket='braga-agx-native',
-            fileNamePrefix=nameForFile,
-            scale=1,
-            crs='EPSG:4326')
-        
-        task.start()
-        
-        done = False
-        while done == False:
-            state = task.status()['state']
-            print(state)
-            time.sleep(5)
-            if (state == 'COMPLETED'):
-                done = True
-            if (state == 'FAILED'):
-
-                value = {
-                    "success": task.status()['error_message'],
-                    "imageURL": "none",
-                    "dateTaken": "none"
-                }
-                
-                returnPackage = json.dumps(value)
-                # Set CORS headers for the main request
-                headers = {
-                    'Access-Control-Allow-Origin': '*'
-                }
-                return(returnPackage, 400, headers)
-
-        print("task has completed")
-        
-        # Now, download it to temp file, change the format with rasterio,
-        # and re-upload it to cloud storage
-        
-        destination_bucket = storage_client.get_bucket('braga-agx-native')
-        with NamedTemporaryFile() as tempTiff:
-            # Extract name to the temp file
-            tempTiff_file = "".join([str(tempTiff.name), "from_the_cloud.tif"])
-            blob = destination_bucket.blob(nameForFile + ".tif")
-            # Download the file to a destination
-            blob.download_to_filename(tempTiff_file)
+        # Export at the native resolution of the bands, or coarser for a very big field
+        scale = export_scale(realCoords, ['NDVI'])
+        
+        # Look for a PNG already made of this field from this scene (see result_cache.py)
+        key = result_key(realCoords, 'NDVI', visualization_parameters('NDVI'), info['id'], scale)
+        cached = result_cache.get(key)
+        
+        # Named from the cache key, so the same result is only ever stored once (see png_storage.py)
+        nameForFile = png_name('NDVI', key)
+        
+        if cached is not None:
+            url = cached['url']
+        elif pngs_exist(destination_bucket, [nameForFile]):
+            # Made before, but not in the cache
+            url = public_url(nameForFile + ".png")
+        elif use_fast_path(realCoords):
+            # A small field: fetch the PNG straight away, without a batch export (see sentinel2_indices.py)
+            pngs = fetch_index_pngs(recent_S2, geometry, realCoords, ['NDVI'], scale)
+            url = upload_png(destination_bucket, nameForFile, pngs['NDVI'])
+        else:
+            recent_S2_for_export = visualize_indices(recent_S2, ['NDVI'])
+            
+            # Export when a slot is free (see ee_tasks.ExportScheduler); the same export asked for by
+            # another request at the same time is only run once
+            def make_task():
+                return ee.batch.Export.image.toCloudStorage(
+                    image=recent_S2_for_export,
+                    region=geometry,
+                    description='an image from the iPhone frontend',
+                    bucket=BUCKET,
+                    fileNamePrefix=nameForFile,
+                    scale=scale,
+                    crs='EPSG:4326')
             
-            # convert it with rasterio
-            with rasterio.open(tempTiff_file) as infile:
-                profile=infile.profile
-                #
-                # change the driver name from GTiff to PNG
-                #
-                profile['driver']='PNG'
-                
-                with NamedTemporaryFile() as tempPng:
-                    tempPng_file = "".join([str(tempPng.name), "to_the_cloud.png"])
-                    
-                    raster=infile.read()
-                    with rasterio.open(tempPng_file, 'w', **profile) as dst:
-                        dst.write(raster)
-                        
-                    dest_blob = destination_bucket.blob(nameForFile + ".png")
-                    dest_blob.upload_from_filename(tempPng_file)
-                     
+            # Wait for the export, checking often at first and then less often (see ee_tasks.py)
+            try:
+                status = export_scheduler.run(nameForFile, make_task, INTERACTIVE)
+            except (TaskTimeout, TaskCancelled) as error:
+                status = {'state': 'FAILED', 'error_message': str(error)}
+            if status['state'] != 'COMPLETED':
+                return failure_response(status.get('error_message', status['state']))
+
+            print("task has completed")
         
+            # Now turn the exported GeoTIFF into a PNG, in memory, and upload it (see png_storage.py)
+            url = convert_export_to_pngs(destination_bucket, nameForFile, [nameForFile])[0]
         
-        url = "https://storage.googleapis.com/braga-agx-native/" + nameForFile + ".png"
+        if cached is None:
+            result_cache.put(key, {'url': url, 'dateTaken': dateTaken})
 
         
 
@@ -184,3 +174,25 @@ def cors_enabled_function(request):
             
     
     return (returnPackage, 200, headers)
+
+# How this instance's exports are doing (see ee_tasks.ExportScheduler.metrics): how many are
+# queued and running (here, and in the whole project), and how long they have waited for a slot
+def metrics_function(request):
+
+    # Set CORS headers for the preflight request
+    if request.method == 'OPTIONS':
+        # Allows GET requests from any origin with the Content-Type
+        # header and caches preflight response for an 3600s
+        headers = {
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': 'GET',
+            'Access-Control-Allow-Headers': 'Content-Type',
+            'Access-Control-Max-Age': '3600'
+        }
+
+        return ('', 204, headers)
+
+    headers = {
+        'Access-Control-Allow-Origin': '*'
+    }
+    return (json.dumps(export_scheduler.metrics()), 200, headers)
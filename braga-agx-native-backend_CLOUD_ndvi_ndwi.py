@@ -6,261 +6,380 @@ Created on Tue Oct 19 16:28:41 2021
 """
 
 import ee
-import time
+import collections
+import concurrent.futures
 import datetime
 from datetime import date
 import json
 
 from google.cloud import storage
-import random
-
-import rasterio
-
-from tempfile import NamedTemporaryFile
 
 from google.oauth2 import service_account
 
+from ee_tasks import ExportScheduler, active_task_count, INTERACTIVE, BACKFILL, ExportFailed, TaskTimeout, TaskCancelled
+from farm_fields import BATCH_TASK_BUDGET, read_fields
+from jobs import BucketJobStore, CallbackNotAllowed, JobRunner, fail_lost_job
+from png_storage import BUCKET, content_name, png_name, public_url, pngs_exist, upload_png, convert_export_to_pngs
+from result_cache import ResultCache, result_key, scene_key
+from sentinel2_indices import NoSceneFound, export_scale, visualization_parameters, use_fast_path, fetch_index_pngs, parse_indices, select_scene, scene_info, scene_infos, scene_image, add_indices, visualize_indices, visualized_band_numbers
+
 service_acct = 'agxactly-app-serviceaccount@agxactly-app-backend.iam.gserviceaccount.com'
 credentials = ee.ServiceAccountCredentials(service_acct, 'agxactly-app-backend-42b1257ae398.json')
 ee.Initialize(credentials)
 
 storage_credentials = service_account.Credentials.from_service_account_file('agxactly-app-backend-42b1257ae398.json')
 storage_client = storage.Client("online-library-app", storage_credentials)
+destination_bucket = storage_client.bucket(BUCKET)
 
-# Create a function that adds an NDVI band to a Sentinel-2 image
-def addNDVI(image):
-    ndvi = image.normalizedDifference(['B8', 'B4']).rename('NDVI');
-    return image.addBands(ndvi);
-
-def addNDWI(image):
-    ndwi = image.select('B8').subtract(image.select('B12')).divide(image.select('B8').add(image.select('B12'))).rename('NDWI')
-    return image.addBands(ndwi)
+# Exports run by this instance, at most MAX_RUNNING_EXPORTS at once, and held back while the whole
+# project has MAX_PROJECT_EXPORTS tasks waiting or running, whichever instance started them (see ee_tasks.py)
+export_scheduler = ExportScheduler(count_project_exports=lambda: active_task_count(ee.data.getTaskList()))
 
-def cors_enabled_function(request):
+# PNGs already made, kept between requests to this instance and in the bucket (see result_cache.py)
+result_cache = ResultCache(destination_bucket)
 
-    request_json = request.get_json(silent=True)
-    request_args = request.args
+# Jobs started by submit_function, kept in the bucket so any instance can report on them (see jobs.py)
+job_store = BucketJobStore(destination_bucket)
+job_runner = JobRunner(job_store)
 
+# The response to a CORS preflight request
+def preflight_response():
     # For more information about CORS and CORS preflight requests, see:
     # https://developer.mozilla.org/en-US/docs/Glossary/Preflight_request
+    
+    # Allows GET requests from any origin with the Content-Type
+    # header and caches preflight response for an 3600s
+    headers = {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'GET',
+        'Access-Control-Allow-Headers': 'Content-Type',
+        'Access-Control-Max-Age': '3600'
+    }
 
-    # Set CORS headers for the preflight request
-    if request.method == 'OPTIONS':
-        # Allows GET requests from any origin with the Content-Type
-        # header and caches preflight response for an 3600s
-        headers = {
-            'Access-Control-Allow-Origin': '*',
-            'Access-Control-Allow-Methods': 'GET',
-            'Access-Control-Allow-Headers': 'Content-Type',
-            'Access-Control-Max-Age': '3600'
-        }
+    return ('', 204, headers)
+
+# Read the field's coordinates and the indices to return (see sentinel2_indices.py, NDVI and NDWI if
+# none are given) from a request.  Raises ValueError if they can't be read.
+def read_field_request(request):
+    request_json = request.get_json(silent=True)
+    request_args = request.args
 
-        return ('', 204, headers)
+    if request_json and 'coords' in request_json:
+        coords = request_json['coords']
+        realCoords = json.loads(coords)
 
+    elif request_args and 'coords' in request_args:
+        coords = request_args.get('coords')
+        realCoords = json.loads(coords)
     else:
+        coords = request.data
+        request_json = json.loads(coords)
+        realCoords = request_json['coords']
 
-        if request_json and 'coords' in request_json:
-            coords = request_json['coords']
-            realCoords = json.loads(coords)
-  
-        elif request_args and 'coords' in request_args:
-            coords = request_args('coords')
-            realCoords = json.loads(coords)
-        else:
-            coords = request.data
-            realCoords = json.loads(coords)['coords']
+    print(coords)
+    
+    print(realCoords)
 
-        print(coords)
-        
-        print(realCoords)
+    if request_json and 'indices' in request_json:
+        requested = request_json['indices']
+    elif request_args and 'indices' in request_args:
+        requested = request_args.get('indices')
+    else:
+        requested = None
+    return realCoords, parse_indices(requested)
 
-        geometry = ee.Geometry.Polygon(realCoords);
-        
-        # Base Image
-        S2_SR = ee.ImageCollection('COPERNICUS/S2_SR').filterBounds(geometry) #.filterDate(end, start);
+# Make (or find) the PNG of each of the named indices for a field, and return the response:
+#   {"success": "true", "dateTaken": ..., "imageURL_<index>": ..., "dateTaken_<index>": ...}
+# "priority" is the export's priority (see ee_tasks.ExportScheduler).
+# Raises NoSceneFound if the field has no scene, and ExportFailed if the Earth Engine export fails.
+def make_index_pngs(realCoords, names, priority=INTERACTIVE):
+    geometry = ee.Geometry.Polygon(realCoords);
+    
+    # The scene picked for this field a short while ago, if there was one (see result_cache.py), so
+    # a repeat request doesn't wait for Earth Engine; otherwise pick the scene, and get its date and
+    # ID from Earth Engine (one round trip)
+    info = result_cache.get_scene(realCoords)
+    if info is None:
+        scene = select_scene(geometry)
+        info = scene_info(scene)
+        if info is None:
+            raise NoSceneFound()
+        result_cache.remember_scene(realCoords, info)
+    else:
+        scene = scene_image(info['id'])
+    
+    # Add every requested index to the scene
+    recent_S2 = add_indices(scene, names)
+    return make_field_pngs(realCoords, names, recent_S2, info, priority)
 
-        # Apply this function across your image collection
-        S2_NDVI = S2_SR.map(addNDVI);  
-        S2_NDWI = S2_SR.map(addNDWI);
-        
-        # Sort the image collection by date and select the most recent image
-        recent_S2_ndvi = ee.Image(S2_NDVI
-                     .sort('system:time_start', False)
-                     .sort('CLOUD_COVER').first());
-        recent_S2_ndwi = ee.Image(S2_NDWI
-                            .sort('system:time_start', False)
-                            .sort('CLOUD_COVER').first());
-        
-        #Print the image’s metadata to the console to view its metadata
-        dateTaken_ndvi = recent_S2_ndvi.date().format().getInfo().split("T")[0]
-        dateTaken_ndwi = recent_S2_ndwi.date().format().getInfo().split("T")[0]
-        
-        recent_S2_ndvi_for_export = recent_S2_ndvi.select('NDVI').visualize(**{
-            'min': 0,
-            'max': 1,
-            'palette': ['FF0000', 'FF6E07', 'FFA500', 'FFDB00', '00FF00', '009700']
-        })
-                        #red     #dark orange  #orange #yellow   #green #dark green        
-        recent_S2_ndwi_for_export = recent_S2_ndwi.select('NDWI').visualize(**{
-            'min': -1,
-            'max': 1,
-            'palette': ['FF0000', 'FF6E07', 'FFA500', 'FFDB00', '00FF00', '009700']
-        })
-                #red     #dark orange  #orange #yellow   #green #dark green        
-        
-        nameForFileNdvi = str(random.random()).replace(".", "") + '_' + dateTaken_ndvi
-        nameForFileNdwi = "ndwi_" + nameForFileNdvi
-        
-        task = ee.batch.Export.image.toCloudStorage(
-            image=recent_S2_ndvi_for_export,
-            region=geometry,
-            description='an image from the iPhone frontend',
-            bucket='braga-agx-native',
-            fileNamePrefix=nameForFileNdvi,
-            scale=1,
-            crs='EPSG:4326')
-        
-        task.start()
-        
-        done = False
-        while done == False:
-            state = task.status()['state']
-            print(state)
-            time.sleep(5)
-            if (state == 'COMPLETED'):
-                done = True
-            if (state == 'FAILED'):
-
-                value = {
-                    "success": task.status()['error_message'],
-                    "imageURL": "none",
-                    "dateTaken": "none"
-                }
-                
-                returnPackage = json.dumps(value)
-                # Set CORS headers for the main request
-                headers = {
-                    'Access-Control-Allow-Origin': '*'
-                }
-                return(returnPackage, 400, headers)
-
-        print("ndvi task has completed")
-        
-        task = ee.batch.Export.image.toCloudStorage(
-            image=recent_S2_ndwi_for_export,
-            region=geometry,
-            description='an image from the iPhone frontend',
-            bucket='braga-agx-native',
-            fileNamePrefix=nameForFileNdwi,
-            scale=1,
-            crs='EPSG:4326')
-        
-        task.start()
-        
-        done = False
-        while done == False:
-            state = task.status()['state']
-            print(state)
-            time.sleep(5)
-            if (state == 'COMPLETED'):
-                done = True
-            if (state == 'FAILED'):
-        
-                value = {
-                    "success": task.status()['error_message'],
-                    "imageURL": "none",
-                    "dateTaken": "none"
-                }
-                
-                returnPackage = json.dumps(value)
-                # Set CORS headers for the main request
-                headers = {
-                    'Access-Control-Allow-Origin': '*'
-                }
-                return(returnPackage, 400, headers)
-        
-        print("ndwi task has completed")
-        
-        # Now, download it to temp file, change the format with rasterio,
-        # and re-upload it to cloud storage
-        
-        destination_bucket = storage_client.get_bucket('braga-agx-native')
-        with NamedTemporaryFile() as tempTiff:
-            # Extract name to the temp file
-            tempTiff_file = "".join([str(tempTiff.name), "from_the_cloud.tif"])
-            blob = destination_bucket.blob(nameForFileNdvi + ".tif")
-            # Download the file to a destination
-            blob.download_to_filename(tempTiff_file)
-            
-            # convert it with rasterio
-            with rasterio.open(tempTiff_file) as infile:
-                profile=infile.profile
-                #
-                # change the driver name from GTiff to PNG
-                #
-                profile['driver']='PNG'
-                
-                with NamedTemporaryFile() as tempPng:
-                    tempPng_file = "".join([str(tempPng.name), "to_the_cloud.png"])
-                    
-                    raster=infile.read()
-                    with rasterio.open(tempPng_file, 'w', **profile) as dst:
-                        dst.write(raster)
-                        
-                    dest_blob = destination_bucket.blob(nameForFileNdvi + ".png")
-                    dest_blob.upload_from_filename(tempPng_file)
-                     
-        
-        
-        url_ndvi = "https://storage.googleapis.com/braga-agx-native/" + nameForFileNdvi + ".png"
-
-        destination_bucket = storage_client.get_bucket('braga-agx-native')
-        with NamedTemporaryFile() as tempTiff:
-            # Extract name to the temp file
-            tempTiff_file = "".join([str(tempTiff.name), "from_the_cloud.tif"])
-            blob = destination_bucket.blob(nameForFileNdwi + ".tif")
-            # Download the file to a destination
-            blob.download_to_filename(tempTiff_file)
-            
-            # convert it with rasterio
-            with rasterio.open(tempTiff_file) as infile:
-                profile=infile.profile
-                #
-                # change the driver name from GTiff to PNG
-                #
-                profile['driver']='PNG'
-                
-                with NamedTemporaryFile() as tempPng:
-                    tempPng_file = "".join([str(tempPng.name), "to_the_cloud.png"])
-                    
-                    raster=infile.read()
-                    with rasterio.open(tempPng_file, 'w', **profile) as dst:
-                        dst.write(raster)
-                        
-                    dest_blob = destination_bucket.blob(nameForFileNdwi + ".png")
-                    dest_blob.upload_from_filename(tempPng_file)
-                     
+# Make (or find) the PNG of each of the named indices for a field from a scene already picked
+# ("recent_S2", with the indices added, and its "info" from scene_info), and return the response
+# as make_index_pngs does
+def make_field_pngs(realCoords, names, recent_S2, info, priority=INTERACTIVE):
+    geometry = ee.Geometry.Polygon(realCoords);
+    dateTaken = info['date']
+    print(dateTaken)
+    
+    # Export at the native resolution of the bands, or coarser for a very big field
+    scale = export_scale(realCoords, names)
+    
+    # Look for PNGs already made of this field from this scene (see result_cache.py);
+    # only the indices that aren't there are made
+    keys = {name: result_key(realCoords, name, visualization_parameters(name), info['id'], scale) for name in names}
+    urls = {}
+    for name in names:
+        cached = result_cache.get(keys[name])
+        if cached is not None:
+            urls[name] = cached['url']
+    missing = [name for name in names if name not in urls]
+    
+    # Everything is named from the cache keys, so the same result is only ever stored once (see png_storage.py)
+    pngNames = {name: png_name(name, keys[name]) for name in names}
+    nameForFile = "export_" + content_name(*[keys[name] for name in missing])
+    
+    if not missing:
+        print("every index was in the cache")
+    elif pngs_exist(destination_bucket, [pngNames[name] for name in missing]):
+        # Made before, but not in the cache
+        urls.update({name: public_url(pngNames[name] + ".png") for name in missing})
+    elif use_fast_path(realCoords):
+        # A small field: fetch the PNGs straight away, without a batch export (see sentinel2_indices.py)
+        pngs = fetch_index_pngs(recent_S2, geometry, realCoords, missing, scale)
+        urls.update({name: upload_png(destination_bucket, pngNames[name], pngs[name]) for name in missing})
+    else:
+        # All the indices go out as one multi-band export
+        recent_S2_for_export = visualize_indices(recent_S2, missing)
         
+        # Export when a slot is free (see ee_tasks.ExportScheduler); the same export asked for by
+        # another request at the same time is only run once
+        def make_task():
+            return ee.batch.Export.image.toCloudStorage(
+                image=recent_S2_for_export,
+                region=geometry,
+                description='an image from the iPhone frontend',
+                bucket=BUCKET,
+                fileNamePrefix=nameForFile,
+                scale=scale,
+                crs='EPSG:4326')
         
-        url_ndwi = "https://storage.googleapis.com/braga-agx-native/" + nameForFileNdwi + ".png"
+        # Wait for the export, checking often at first and then less often (see ee_tasks.py)
+        try:
+            status = export_scheduler.run(nameForFile, make_task, priority)
+        except (TaskTimeout, TaskCancelled) as error:
+            status = {'state': 'FAILED', 'error_message': str(error)}
+        if status['state'] != 'COMPLETED':
+            raise ExportFailed(status.get('error_message', status['state']))
 
+        print("task has completed")
+    
+        # Now make a PNG of each index from its three bands of the export, in memory (see png_storage.py)
+        urls.update(zip(missing, convert_export_to_pngs(destination_bucket, nameForFile, [pngNames[name] for name in missing],
+                                                        visualized_band_numbers(missing))))
+    
+    for name in missing:
+        result_cache.put(keys[name], {'url': urls[name], 'dateTaken': dateTaken})
+    
+    # Every index comes from the same scene, so they all have the same date
+    value = {
+        "success": "true",
+        "dateTaken": dateTaken
+    }
+    for name in names:
+        value["imageURL_" + name.lower()] = urls[name]
+        value["dateTaken_" + name.lower()] = dateTaken
+    return value
 
+# The response to a request that failed, as the frontend expects it
+def failure_response(message, code=400):
+    value = {
+        "success": message,
+        "imageURL": "none",
+        "dateTaken": "none"
+    }
+    
+    returnPackage = json.dumps(value)
     # Set CORS headers for the main request
     headers = {
         'Access-Control-Allow-Origin': '*'
     }
-    
-    value = {
-        "success": "true",
-        "imageURL_ndvi": url_ndvi,
-        "dateTaken_ndvi": dateTaken_ndvi,
-        "imageURL_ndwi": url_ndwi,
-        "dateTaken_ndwi": dateTaken_ndwi
-        
+    return(returnPackage, code, headers)
+
+# Make the PNGs while the client waits, and return them
+def cors_enabled_function(request):
+
+    # Set CORS headers for the preflight request
+    if request.method == 'OPTIONS':
+        return preflight_response()
+
+    try:
+        realCoords, names = read_field_request(request)
+        value = make_index_pngs(realCoords, names)
+    except (ValueError, ExportFailed, ee.EEException) as error:
+        return failure_response(str(error))
+
+    # Set CORS headers for the main request
+    headers = {
+        'Access-Control-Allow-Origin': '*'
     }
     
     returnPackage = json.dumps(value)
     
-            
-    
     return (returnPackage, 200, headers)
+
+# Start making the PNGs in the background (see jobs.py), and return the job's ID straight away:
+#   {"success": "true", "jobId": ...}
+# Ask status_function for the job with that ID, or give a "callbackURL" in the request to have
+# the finished job POSTed to it (an https URL on one of the CALLBACK_ALLOWED_HOSTS, see jobs.py).
+def submit_function(request):
+
+    # Set CORS headers for the preflight request
+    if request.method == 'OPTIONS':
+        return preflight_response()
+
+    try:
+        realCoords, names = read_field_request(request)
+    except ValueError as error:
+        return failure_response(str(error))
+
+    request_json = request.get_json(silent=True) or {}
+    callbackURL = request_json.get('callbackURL') or request.args.get('callbackURL')
+
+    try:
+        jobId = job_runner.submit(lambda: make_index_pngs(realCoords, names), callbackURL,
+                                  details={'coords': realCoords, 'indices': names})
+    except CallbackNotAllowed as error:
+        return failure_response(str(error))
+
+    headers = {
+        'Access-Control-Allow-Origin': '*'
+    }
+    return (json.dumps({"success": "true", "jobId": jobId}), 202, headers)
+
+# The record of a job started by submit_function (see jobs.py), by its "jobId".  The response of a
+# finished job is in its 'result', or the reason it failed in its 'error'.
+def status_function(request):
+
+    # Set CORS headers for the preflight request
+    if request.method == 'OPTIONS':
+        return preflight_response()
+
+    request_json = request.get_json(silent=True) or {}
+    jobId = request_json.get('jobId') or request.args.get('jobId')
+    # (a job whose instance went away before it finished is reported as failed, see jobs.fail_lost_job)
+    record = fail_lost_job(job_store, job_store.get(jobId)) if jobId else None
+    if record is None:
+        return failure_response("No job " + str(jobId), 404)
+
+    headers = {
+        'Access-Control-Allow-Origin': '*'
+    }
+    return (json.dumps(record), 200, headers)
+
+# The scenes of several fields (see select_scene), as their infos (see scene_info), in the order of
+# "polygons".  Scenes picked for a field a short while ago are reused (see result_cache.py), fields with
+# the same polygon are only looked up once, and the rest are picked in one Earth Engine round trip.
+# A field gets None instead if it has no scene in sentinel2_indices.MAX_SEARCH_WINDOW_DAYS, or the exception if its
+# polygon can't be used, so one bad field doesn't fail the others.
+def pick_scenes(polygons):
+    infos = [None] * len(polygons)
+    lookups = collections.OrderedDict()
+    for position, coords in enumerate(polygons):
+        try:
+            infos[position] = result_cache.get_scene(coords)
+            if infos[position] is None:
+                geometry = ee.Geometry.Polygon(coords)
+                lookup = lookups.setdefault(scene_key(coords), {'coords': coords, 'geometry': geometry, 'positions': []})
+                lookup['positions'].append(position)
+        except (ee.EEException, ValueError, TypeError, IndexError) as error:
+            infos[position] = ValueError("The field's polygon can't be used: " + str(error))
+    lookups = list(lookups.values())
+
+    try:
+        found = scene_infos([select_scene(lookup['geometry']) for lookup in lookups])
+    except ee.EEException:
+        # Something Earth Engine couldn't use: look the fields up one by one, so only the bad ones fail
+        found = []
+        for lookup in lookups:
+            try:
+                found.append(scene_infos([select_scene(lookup['geometry'])])[0])
+            except ee.EEException as error:
+                found.append(error)
+
+    for lookup, info in zip(lookups, found):
+        if isinstance(info, dict):
+            result_cache.remember_scene(lookup['coords'], info)
+        for position in lookup['positions']:
+            infos[position] = info
+    return infos
+
+# Make the PNGs of every field of a farm (see farm_fields.py) in one request.  Its exports wait
+# behind single-field requests for a slot (they have BACKFILL priority).  The request has the
+# "fields" (a list of polygons, or a GeoJSON FeatureCollection), the "indices" as for a single field,
+# and can lower the number of fields worked on at once with "taskBudget".  Returns
+#   {"success": "true", "fields": [{"id": ..., "success": "true", "dateTaken": ..., "imageURL_<index>": ...}, ...]}
+# in the order of the request; a field that fails has its error as its "success", and the others still go ahead.
+def batch_function(request):
+
+    # Set CORS headers for the preflight request
+    if request.method == 'OPTIONS':
+        return preflight_response()
+
+    try:
+        request_json = request.get_json(silent=True)
+        if not request_json:
+            request_json = json.loads(request.data or '{}')
+        # The body can also be just the FeatureCollection, or just the list of polygons
+        if isinstance(request_json, dict) and request_json.get('type') != 'FeatureCollection':
+            options = request_json
+            fields = read_fields(request_json.get('fields') or [])
+        else:
+            options = {}
+            fields = read_fields(request_json)
+        names = parse_indices(options.get('indices'))
+        taskBudget = max(1, min(int(options.get('taskBudget', BATCH_TASK_BUDGET)), BATCH_TASK_BUDGET))
+    except (TypeError, ValueError) as error:
+        return failure_response(str(error))
+
+    # Pick every field's scene (see pick_scenes).  Fields in the same scene footprint get the same
+    # scene, which is then only set up once.
+    infos = pick_scenes([field['coords'] for field in fields])
+    scenes = {}
+    for info in infos:
+        if isinstance(info, dict) and info['id'] not in scenes:
+            scenes[info['id']] = add_indices(scene_image(info['id']), names)
+    print("%d fields in %d scenes" % (len(fields), len(scenes)))
+
+    def make_field(field_and_info):
+        field, info = field_and_info
+        try:
+            if isinstance(info, Exception):
+                raise info
+            if info is None:
+                raise NoSceneFound()
+            value = make_field_pngs(field['coords'], names, scenes[info['id']], info, BACKFILL)
+        except Exception as error:
+            value = {"success": str(error), "dateTaken": "none"}
+        value["id"] = field['id']
+        return value
+
+    # At most "taskBudget" fields (and so exports) at once
+    with concurrent.futures.ThreadPoolExecutor(max_workers=taskBudget) as pool:
+        results = list(pool.map(make_field, zip(fields, infos)))
+
+    headers = {
+        'Access-Control-Allow-Origin': '*'
+    }
+    return (json.dumps({"success": "true", "fields": results}), 200, headers)
+
+# How this instance's exports are doing (see ee_tasks.ExportScheduler.metrics): how many are
+# queued and running (here, and in the whole project), and how long they have waited for a slot
+def metrics_function(request):
+
+    # Set CORS headers for the preflight request
+    if request.method == 'OPTIONS':
+        return preflight_response()
+
+    headers = {
+        'Access-Control-Allow-Origin': '*'
+    }
+    return (json.dumps(export_scheduler.metrics()), 200, headers)
@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""
+Waiting for Earth Engine batch tasks (ee.batch.Export...) to finish.
+
+The backends used to check task.status() every 5 seconds, so every request waited up to
+5 seconds longer than its export took.  wait_for_task checks often at first (a small field's
+export is often done in a second or two) and then less and less often, up to a cap, so a
+long export doesn't hammer the Earth Engine API.  It gives up after an overall deadline, can
+be cancelled from another thread, and returns the task's final status, so a FAILED task's
+error message doesn't need a second task.status() call.
+
+ExportScheduler caps how many exports run at once, starts waiting exports in priority order
+(interactive requests before backfill), runs an export asked for twice only once, and keeps
+queue depth and wait-time metrics.  Its own cap is per instance of the cloud function; given a
+way to count the project's waiting and running tasks (for example ee.data.getTaskList, see
+active_task_count), it also holds exports back while the whole project has too many.
+
+This module only needs the task objects themselves, not the ee module, so it works with any
+object that has status() (and cancel()), such as a fake task in a test.
+"""
+
+import collections
+import heapq
+import itertools
+import os
+import threading
+import time
+
+# Task states after which a task's status never changes again
+finished_states = ('COMPLETED', 'FAILED', 'CANCELLED')
+
+# The first wait between status checks, in seconds, how much longer each wait is than the last,
+# and the longest wait.  For the first FAST_POLL_PERIOD_SECONDS the waits are capped at
+# FAST_POLL_SECONDS, so the checks come at about 0.25, 0.6, 1.1, 1.6, 2.1 ... seconds after the
+# start, and an export that takes under a minute (most fields) is seen finishing within half a
+# second.  After that they grow to MAX_POLL_SECONDS: such an export has already taken over a minute,
+# so seeing it up to 2 seconds late costs little, and a long export doesn't hammer the Earth Engine API.
+FIRST_POLL_SECONDS = 0.25
+POLL_BACKOFF = 1.5
+FAST_POLL_SECONDS = 0.5
+FAST_POLL_PERIOD_SECONDS = 60
+MAX_POLL_SECONDS = 2.0
+
+# How long to wait for an export before giving up, in seconds
+DEFAULT_TIMEOUT_SECONDS = 15 * 60
+
+class TaskTimeout(Exception):
+    pass
+
+class TaskCancelled(Exception):
+    pass
+
+# Raised by the backends when an export doesn't complete, with its error message
+class ExportFailed(Exception):
+    pass
+
+# The waits between status checks (see FIRST_POLL_SECONDS), given how long the task has been waited
+# for ("elapsed", a function returning seconds)
+def poll_delays(elapsed, first=FIRST_POLL_SECONDS, backoff=POLL_BACKOFF, longest=MAX_POLL_SECONDS,
+                fast=FAST_POLL_SECONDS, fast_period=FAST_POLL_PERIOD_SECONDS):
+    delay = first
+    while True:
+        if elapsed() < fast_period:
+            delay = min(delay, fast)
+        yield delay
+        delay = min(delay * backoff, longest)
+
+# Cancel a task, ignoring errors (it may have finished in the meantime)
+def cancel_task(task):
+    try:
+        task.cancel()
+    except Exception as error:
+        print("could not cancel the task: " + str(error))
+
+# Wait for a started task to finish, and return its final status (the dictionary from task.status(),
+# with 'state' one of finished_states).  A FAILED task is returned like any other; the caller decides
+# what to do with its 'error_message'.
+# "cancel", if given, is a threading.Event; setting it (from another thread) stops the wait straight away.
+# If the task hasn't finished after "timeout" seconds, or the wait is cancelled, the task is cancelled
+# too (unless "cancel_task_on_exit" is False) and TaskTimeout or TaskCancelled is raised.
+# "on_status", if given, is called with every status seen, for logging.
+def wait_for_task(task, timeout=DEFAULT_TIMEOUT_SECONDS, cancel=None, on_status=None, cancel_task_on_exit=True,
+                  first_poll=FIRST_POLL_SECONDS, backoff=POLL_BACKOFF, longest_poll=MAX_POLL_SECONDS):
+    if cancel is None:
+        cancel = threading.Event()
+    start = time.monotonic()
+    deadline = start + timeout
+    delays = poll_delays(lambda: time.monotonic() - start, first_poll, backoff, longest_poll)
+
+    while True:
+        status = task.status()
+        if on_status is not None:
+            on_status(status)
+        if status['state'] in finished_states:
+            return status
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            if cancel_task_on_exit:
+                cancel_task(task)
+            raise TaskTimeout("The export did not finish within %d seconds" % timeout)
+
+        # Event.wait returns straight away when the wait is cancelled
+        if cancel.wait(min(next(delays), remaining)):
+            if cancel_task_on_exit:
+                cancel_task(task)
+            raise TaskCancelled("The export was cancelled")
+
+# Export priorities for ExportScheduler: lower numbers go first
+INTERACTIVE = 0
+BACKFILL = 1
+
+# How many exports one instance runs at once.  It can be set with the MAX_RUNNING_EXPORTS
+# environment variable of the cloud function.
+MAX_RUNNING_EXPORTS = int(os.environ.get('MAX_RUNNING_EXPORTS', 10))
+
+# How many tasks the whole Earth Engine project may have waiting or running before the instances
+# hold new exports back (Earth Engine only runs a few batch tasks at a time per project, and queues
+# the rest out of sight, where priorities don't count).  It can be set with the MAX_PROJECT_EXPORTS
+# environment variable.  The project's tasks are counted at most every PROJECT_COUNT_SECONDS.
+MAX_PROJECT_EXPORTS = int(os.environ.get('MAX_PROJECT_EXPORTS', MAX_RUNNING_EXPORTS))
+PROJECT_COUNT_SECONDS = 5
+
+# Task states that take up one of the project's slots
+active_states = ('READY', 'RUNNING')
+
+# How many of a list of task statuses (such as ee.data.getTaskList() gives) are waiting or running
+def active_task_count(statuses):
+    return sum(1 for status in statuses if status.get('state') in active_states)
+
+# One export waiting for, or using, a slot in an ExportScheduler
+class _ScheduledExport:
+    def __init__(self, key, make_task, priority):
+        self.key = key
+        self.make_task = make_task
+        self.priority = priority
+        self.enqueued = time.monotonic()
+        self.started = False
+        self.cancelled = False
+        self.done = threading.Event()
+        self.status = None
+        self.error = None
+
+# Runs Earth Engine exports with at most "max_running" of them running at once.  Exports waiting
+# for a slot go in priority order (INTERACTIVE before BACKFILL), oldest first among equals.
+# An export asked for again (by the same key) while the first is still waiting or running isn't
+# started twice: the second caller waits for the first one's result, and, if it has a higher
+# priority, moves the waiting export up.
+# "max_running" only caps this scheduler (one instance of the cloud function).  To cap the whole
+# project, give "count_project_exports", a function returning how many of the project's tasks are
+# waiting or running (such as lambda: active_task_count(ee.data.getTaskList())); exports are then
+# also held back while that is "max_project_running" or more.  The count is refreshed at most every
+# "count_seconds", and the exports this scheduler starts in between are added to it.  If the count
+# fails, only the per-instance cap applies until the next one.
+# metrics() reports the queue depth and how long exports have waited for a slot.
+# It only needs objects with start() and status() (and cancel()), so it can be tried out with fake tasks.
+class ExportScheduler:
+    def __init__(self, max_running=MAX_RUNNING_EXPORTS, timeout=DEFAULT_TIMEOUT_SECONDS, count_project_exports=None,
+                 max_project_running=MAX_PROJECT_EXPORTS, count_seconds=PROJECT_COUNT_SECONDS):
+        self.max_running = max_running
+        self.timeout = timeout
+        self.count_project_exports = count_project_exports
+        self.max_project_running = max_project_running
+        self.count_seconds = count_seconds
+        self.project_running = 0
+        self.counted = None
+        self.condition = threading.Condition()
+        self.queue = []
+        self.exports = {}
+        self.sequence = itertools.count()
+        self.running = 0
+        self.counts = collections.Counter()
+        self.total_wait = 0.0
+        self.longest_wait = 0.0
+
+    # The next export to start, dropping queue entries left behind by a change of priority
+    def _next_export(self):
+        while self.queue:
+            priority, _, export = self.queue[0]
+            if export.started or export.cancelled or priority != export.priority:
+                heapq.heappop(self.queue)
+                continue
+            return export
+        return None
+
+    # Run an export, and return its final status (see wait_for_task).  "key" says which exports are
+    # the same (the output name, for example), "make_task" makes the (unstarted) task when it gets a slot.
+    # Raises TaskTimeout or TaskCancelled as wait_for_task does; "cancel" can also stop the wait for a slot.
+    def run(self, key, make_task, priority=INTERACTIVE, cancel=None):
+        with self.condition:
+            export = self.exports.get(key)
+            if export is not None:
+                self.counts['merged'] += 1
+                if priority < export.priority and not export.started:
+                    export.priority = priority
+                    heapq.heappush(self.queue, (priority, next(self.sequence), export))
+                    self.condition.notify_all()
+            else:
+                export = _ScheduledExport(key, make_task, priority)
+                self.exports[key] = export
+                heapq.heappush(self.queue, (priority, next(self.sequence), export))
+                self.counts['submitted'] += 1
+                return self._drive(export, cancel)
+
+        # Someone else is running this export: wait for their result
+        export.done.wait()
+        if export.error is not None:
+            raise export.error
+        return export.status
+
+    # Count the project's waiting and running tasks again (see count_project_exports), if the last
+    # count is more than "count_seconds" old.  Returns whether it counted.
+    def _recount_project_exports(self):
+        # (called holding self.condition, which is let go during the count)
+        if self.count_project_exports is None:
+            return False
+        if self.counted is not None and time.monotonic() - self.counted < self.count_seconds:
+            return False
+        self.condition.release()
+        try:
+            count = self.count_project_exports()
+        except Exception as error:
+            print("could not count the project's exports: " + str(error))
+            count = 0
+        finally:
+            self.condition.acquire()
+        self.project_running = count
+        self.counted = time.monotonic()
+        return True
+
+    # Wait for a slot, then start the export and wait for it to finish
+    def _drive(self, export, cancel):
+        # (called holding self.condition)
+        while True:
+            if cancel is not None and cancel.is_set():
+                export.cancelled = True
+                self._finish(export, error=TaskCancelled("The export was cancelled before it started"))
+                raise export.error
+            if self.running < self.max_running and self._next_export() is export:
+                # (the lock is let go while counting, so check everything again afterwards)
+                if self._recount_project_exports():
+                    continue
+                if self.count_project_exports is None or self.project_running < self.max_project_running:
+                    break
+            self.condition.wait(0.5)
+
+        heapq.heappop(self.queue)
+        export.started = True
+        self.running += 1
+        self.project_running += 1
+        waited = time.monotonic() - export.enqueued
+        self.total_wait += waited
+        self.longest_wait = max(self.longest_wait, waited)
+        self.counts['started'] += 1
+
+        self.condition.release()
+        try:
+            task = export.make_task()
+            task.start()
+            status = wait_for_task(task, self.timeout, cancel)
+        except Exception as error:
+            self.condition.acquire()
+            self.running -= 1
+            self._finish(export, error=error)
+            raise
+        self.condition.acquire()
+        self.running -= 1
+        self._finish(export, status=status)
+        return status
+
+    # Record how an export ended, and wake everyone waiting on it or for a slot
+    def _finish(self, export, status=None, error=None):
+        # (called holding self.condition)
+        export.status = status
+        export.error = error
+        del self.exports[export.key]
+        self.counts['completed' if status is not None and status['state'] == 'COMPLETED' else 'failed'] += 1
+        export.done.set()
+        self.condition.notify_all()
+
+    # How the scheduler is doing: exports waiting for a slot ("queued") and running, how many have been
+    # submitted, merged into another, started, completed and failed, and the mean and longest wait for
+    # a slot, in seconds.  "project_running" is the last count of the whole project's waiting and
+    # running tasks (None if they aren't counted).
+    def metrics(self):
+        with self.condition:
+            started = self.counts['started']
+            return {'queued': len(self.exports) - self.running,
+                    'running': self.running,
+                    'project_running': self.project_running if self.count_project_exports is not None else None,
+                    'submitted': self.counts['submitted'],
+                    'merged': self.counts['merged'],
+                    'started': started,
+                    'completed': self.counts['completed'],
+                    'failed': self.counts['failed'],
+                    'mean_wait_seconds': self.total_wait / started if started else 0.0,
+                    'longest_wait_seconds': self.longest_wait}
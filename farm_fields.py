@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+Reading the fields of a whole-farm request, for the braga-agx-native batch endpoint.
+
+A farm's fields can be sent as a list of polygons (each one as for a single field: a list of
+[longitude, latitude] points, a list of rings, or either as JSON text), or as a GeoJSON
+FeatureCollection of Polygon features.  Either way they come out as a list of
+{'id': ..., 'coords': ...}, where the ID is the feature's id (or its 'id' or 'name' property),
+or else the field's position in the request.
+"""
+
+import json
+import os
+
+# The most fields one request can have
+MAX_BATCH_FIELDS = int(os.environ.get('MAX_BATCH_FIELDS', 200))
+
+# How many fields of a batch are worked on (and so how many exports run) at once.  It can be set
+# with the BATCH_TASK_BUDGET environment variable of the cloud function, and lowered per request.
+BATCH_TASK_BUDGET = int(os.environ.get('BATCH_TASK_BUDGET', 8))
+
+# The ID of a GeoJSON feature, or None
+def feature_id(feature):
+    properties = feature.get('properties') or {}
+    for value in (feature.get('id'), properties.get('id'), properties.get('name')):
+        if value is not None:
+            return value
+    return None
+
+# The fields of a request: "fields" is a list of polygons, or a GeoJSON FeatureCollection (as a
+# dictionary or as JSON text).  Raises ValueError if they can't be read.
+def read_fields(fields, max_fields=MAX_BATCH_FIELDS):
+    if isinstance(fields, str):
+        fields = json.loads(fields)
+
+    if isinstance(fields, dict):
+        if fields.get('type') != 'FeatureCollection':
+            raise ValueError("The fields must be a list of polygons or a GeoJSON FeatureCollection")
+        result = []
+        for position, feature in enumerate(fields.get('features', [])):
+            geometry = feature.get('geometry') or {}
+            if geometry.get('type') != 'Polygon':
+                raise ValueError("Field " + str(position) + " is a " + str(geometry.get('type')) + ", not a Polygon")
+            field_id = feature_id(feature)
+            result.append({'id': position if field_id is None else field_id, 'coords': geometry['coordinates']})
+    else:
+        result = [{'id': position, 'coords': json.loads(coords) if isinstance(coords, str) else coords}
+                  for position, coords in enumerate(fields)]
+
+    if not result:
+        raise ValueError("No fields given")
+    if len(result) > max_fields:
+        raise ValueError("Too many fields (%d), the most is %d" % (len(result), max_fields))
+    return result
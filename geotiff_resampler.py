@@ -0,0 +1,453 @@
+# -*- coding: utf-8 -*-
+"""
+Resampling a GeoTIFF to a finer pixel size, block by block.
+
+This is the calculation part of 3_Question_eight.py, pulled out so it can be imported
+and used without the GUI.  Instead of reading the whole upsampled raster (25 times the
+input's pixels for a factor of 5) into one array, the output is written one block at a
+time.  Blocks are made of whole output tiles (or strips), and each is filled by reading
+just the source window it covers, with the matching buf_xsize/buf_ysize, so memory stays
+flat whatever the size of the input or the scale factor.
+
+Every band of the input is resampled (the block-by-block reader reads all bands of a
+window in one call).  resample_batch.py runs this over a whole directory of GeoTIFFs.
+
+The output has the same data type as the input, and is by default a tiled,
+DEFLATE-compressed GeoTIFF (BIGTIFF=IF_SAFER, so outputs over 4 GB still work).
+With output_mode='cog' it is written as a Cloud-Optimized GeoTIFF instead, which tile
+servers can range-read without downloading the whole file.
+
+By default the resampling is done by GDAL's warp engine (gdal.Warp), on all cores, with a
+choice of kernel (nearest, bilinear, cubic, lanczos, average) and any scale factor.
+With output_mode='vrt' only a small VRT file describing the resampling is written, and the
+resampling happens lazily whenever the VRT is read.  The block-by-block reader above is
+still available as engine='blocks', for whole-number scale factors with nearest neighbour.
+
+Statistics and overviews are cheap follow-ups rather than extra full passes: the block-by-block
+reader works out exact statistics from the blocks as it writes them, the warp engine by default
+reads approximate statistics from the smallest overview, overview levels are built on all cores,
+and overviews can go in an external .ovr file.  resample_geotiff always writes a new output (and
+deletes the old one, with its .ovr); add_overviews on an existing output is what only builds the
+overview levels that are missing.
+"""
+
+import contextlib
+import math
+import os
+
+import numpy
+from osgeo import osr, gdal
+
+from batch_files import partial_path_for
+
+# How many times smaller the output pixels are than the input pixels
+SCALE_FACTOR = 5
+
+# The spatial reference given to the output
+OUTPUT_EPSG = 32617
+
+# About how many output pixels are read and written at a time (a block is always made of
+# whole output tiles or strips, so it can be a little more than this)
+DEFAULT_BLOCK_PIXELS = 16 * 1024 * 1024
+
+# Output modes: a tiled GeoTIFF, a Cloud-Optimized GeoTIFF, or a virtual (VRT) raster
+output_modes = ['gtiff', 'cog', 'vrt']
+
+# Resampling kernels, and their names in gdal.Warp
+kernels = {'nearest': 'near',
+           'bilinear': 'bilinear',
+           'cubic': 'cubic',
+           'lanczos': 'lanczos',
+           'average': 'average'}
+
+# Resampling engines: GDAL's multi-threaded warper, or the block-by-block reader
+engines = ['warp', 'blocks']
+
+# How many threads GDAL uses for warping, compression and overviews.  A batch running several
+# files at once in separate processes gives each process a share of the cores instead.
+DEFAULT_THREADS = 'ALL_CPUS'
+
+# How much memory (in MB) the warper may use for its working buffers
+DEFAULT_WARP_MEMORY_MB = 512
+
+# Compressions that can be used for the output ('NONE' for no compression)
+compressions = ['DEFLATE', 'ZSTD', 'LZW', 'NONE']
+DEFAULT_COMPRESSION = 'DEFLATE'
+
+# The size of the output's tiles, in pixels
+DEFAULT_TILE_SIZE = 256
+
+# The TIFF predictor suited to a GDAL data type: floating point (3) or horizontal differencing (2)
+def predictor_for(data_type):
+    if data_type in (gdal.GDT_Float32, gdal.GDT_Float64):
+        return 3
+    return 2
+
+# GeoTIFF creation options for the output
+def creation_options(data_type, compression=DEFAULT_COMPRESSION, tiled=True, tile_size=DEFAULT_TILE_SIZE):
+    options = ['BIGTIFF=IF_SAFER']
+    if tiled:
+        options += ['TILED=YES', 'BLOCKXSIZE=' + str(tile_size), 'BLOCKYSIZE=' + str(tile_size)]
+    if compression and compression.upper() != 'NONE':
+        options.append('COMPRESS=' + compression.upper())
+        options.append('PREDICTOR=' + str(predictor_for(data_type)))
+    return options
+
+# Creation options for the COG driver
+def cog_creation_options(data_type, compression=DEFAULT_COMPRESSION, tile_size=DEFAULT_TILE_SIZE):
+    options = ['BIGTIFF=IF_SAFER', 'BLOCKSIZE=' + str(tile_size)]
+    if compression and compression.upper() != 'NONE':
+        options.append('COMPRESS=' + compression.upper())
+        options.append('PREDICTOR=YES')
+    return options
+
+# The overview levels built for the output
+OVERVIEW_LEVELS = [2, 4, 8, 16, 32, 64]
+
+# Set GDAL configuration options for the duration of a "with" block, then put back the old values
+@contextlib.contextmanager
+def gdal_config(**options):
+    previous = {name: gdal.GetConfigOption(name) for name in options}
+    for name, value in options.items():
+        gdal.SetConfigOption(name, value)
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            gdal.SetConfigOption(name, value)
+
+# The overview levels a band already has.  GDAL makes a level-N overview (N + width - 1) // N
+# pixels wide, so that is what each existing overview is matched against.
+def existing_overview_levels(band, levels=OVERVIEW_LEVELS):
+    widths = {band.GetOverview(i).XSize for i in range(band.GetOverviewCount())}
+    return [level for level in levels if (band.XSize + level - 1) // level in widths]
+
+# Build the overview levels an open dataset doesn't have yet, with every core (GDAL_NUM_THREADS)
+# working on them.  Overviews are compressed like the output.  To write them to an external
+# .ovr file, open the dataset read-only (see add_overviews).
+# Returns the levels that were built.
+def build_missing_overviews(ds, levels=OVERVIEW_LEVELS, resampling='average', compression=DEFAULT_COMPRESSION, threads=DEFAULT_THREADS):
+    present = existing_overview_levels(ds.GetRasterBand(1), levels)
+    missing = [level for level in levels if level not in present]
+    if missing:
+        with gdal_config(GDAL_NUM_THREADS=str(threads),
+                         COMPRESS_OVERVIEW=compression.upper() if compression else 'NONE',
+                         BIGTIFF_OVERVIEW='IF_SAFER'):
+            ds.BuildOverviews(resampling, missing)
+    return missing
+
+# Add the missing overview levels to a raster file, either inside it or (external=True) in an
+# external .ovr file next to it.  Levels already present are skipped, so this can be re-run.
+def add_overviews(path, levels=OVERVIEW_LEVELS, external=False, resampling='average', compression=DEFAULT_COMPRESSION, threads=DEFAULT_THREADS):
+    ds = gdal.Open(path, gdal.GA_ReadOnly if external else gdal.GA_Update)
+    built = build_missing_overviews(ds, levels, resampling, compression, threads)
+    del ds
+    return built
+
+# Statistics (minimum, maximum, mean, standard deviation) worked out from the blocks of a raster as
+# they are written, so no extra pass over the output is needed.  Nodata and NaN pixels are left out.
+class BlockStatistics:
+    def __init__(self, nodata=None):
+        self.nodata = nodata
+        self.count = 0
+        self.total = 0.0
+        self.total_of_squares = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def add(self, data):
+        values = data
+        if self.nodata is not None:
+            values = values[values != self.nodata]
+        if values.dtype.kind == 'f':
+            values = values[~numpy.isnan(values)]
+        if values.size == 0:
+            return
+        values = values.astype(numpy.float64, copy=False)
+        self.count += values.size
+        self.total += float(values.sum())
+        self.total_of_squares += float(numpy.square(values).sum())
+        minimum, maximum = float(values.min()), float(values.max())
+        self.minimum = minimum if self.minimum is None else min(self.minimum, minimum)
+        self.maximum = maximum if self.maximum is None else max(self.maximum, maximum)
+
+    # Store the statistics on a band, as ComputeStatistics would
+    def apply(self, band):
+        if self.count == 0:
+            return
+        mean = self.total / self.count
+        standard_deviation = math.sqrt(max(0.0, self.total_of_squares / self.count - mean * mean))
+        band.SetStatistics(self.minimum, self.maximum, mean, standard_deviation)
+
+# The output file for an input GeoTIFF: the same directory and name, with the suffix
+# "_resampled_and_converted" and the same extension (*.tif or *.tiff), or *.vrt for a VRT
+def resampled_path_for(tiff_path, output_mode='gtiff'):
+    base, file_extension = os.path.splitext(tiff_path)
+    if output_mode == 'vrt':
+        file_extension = '.vrt'
+    return base + "_resampled_and_converted" + file_extension
+
+# The files GDAL may keep next to a raster: external overviews and its .aux.xml (statistics)
+sidecar_suffixes = ['.ovr', '.aux.xml']
+
+# Delete an output file left by an earlier run, with its sidecar files.  gdal.Warp refuses to write
+# over an existing output ("Output dataset ... exists"), and a stale .ovr would be taken for
+# overviews that are already built.
+def remove_output(path):
+    for name in [path] + [path + suffix for suffix in sidecar_suffixes]:
+        if os.path.exists(name):
+            os.remove(name)
+
+# Rename a finished output, with its sidecar files, replacing whatever is there
+def move_output(path, out_path):
+    remove_output(out_path)
+    os.replace(path, out_path)
+    for suffix in sidecar_suffixes:
+        if os.path.exists(path + suffix):
+            os.replace(path + suffix, out_path + suffix)
+
+# Split the output raster into blocks of whole output tiles (or strips), each holding about
+# "max_block_pixels" pixels.  Yields (x offset, y offset, width, height) in output pixels.
+def output_blocks(out_columns, out_rows, block_xsize, block_ysize, max_block_pixels=DEFAULT_BLOCK_PIXELS):
+    # Use whole rows of tiles if a row of tiles fits in the budget, otherwise split the rows too
+    if out_columns * block_ysize <= max_block_pixels:
+        width = out_columns
+        height = max(1, max_block_pixels // (out_columns * block_ysize)) * block_ysize
+    else:
+        width = max(1, max_block_pixels // (block_xsize * block_ysize)) * block_xsize
+        height = block_ysize
+
+    for y in range(0, out_rows, height):
+        for x in range(0, out_columns, width):
+            yield x, y, min(width, out_columns - x), min(height, out_rows - y)
+
+# Read the part of the upsampled raster covering one output block, from a band or (for every band at
+# once) a whole dataset of "source_columns" x "source_rows" pixels.
+# The source window is the smallest whole-pixel window covering the block; it is read with
+# buf_xsize/buf_ysize of "scale" times its size (so every source pixel becomes a scale x scale
+# square, as when reading the whole raster with the upsampled buffer size), then trimmed to the block.
+def read_upsampled_block(source, x, y, width, height, scale, source_columns, source_rows):
+    source_x = x // scale
+    source_y = y // scale
+    source_width = min(source_columns, int(math.ceil((x + width) / scale))) - source_x
+    source_height = min(source_rows, int(math.ceil((y + height) / scale))) - source_y
+
+    data = source.ReadAsArray(source_x, source_y, source_width, source_height,
+                              buf_xsize=source_width * scale, buf_ysize=source_height * scale)
+    trim_x = x - source_x * scale
+    trim_y = y - source_y * scale
+    return data[..., trim_y:trim_y + height, trim_x:trim_x + width]
+
+# Resample every band of a GeoTIFF to pixels "scale" times smaller, and save it as a new GeoTIFF
+# (by default next to the original, see resampled_path_for) with the same data type as the input.
+# "kernel" is one of the "kernels" above, and "engine" is 'warp' (see resample_geotiff_warp) or
+# 'blocks' (see resample_geotiff_blocks).
+# "compression", "tiled" and "tile_size" set the GeoTIFF creation options (see creation_options).
+# "overview_levels" (None or [] for none), "external_overviews" (an .ovr file instead of internal
+# overviews) and "approximate_statistics" control the finishing steps (see finish_output).
+# "approximate_statistics" of None leaves it to the engine: approximate for 'warp' (so the output
+# isn't read again in full), exact for 'blocks' (which works them out from the blocks anyway).
+# "threads" is how many threads GDAL may use (see DEFAULT_THREADS).
+# "progress", if given, is called with (output pixels done, total output pixels).
+# The output is written to partial_path_for(out_path) and only renamed to "out_path" once it is
+# finished; if anything goes wrong the partial output is deleted.
+# Returns the path of the new file.
+def resample_geotiff(tiff_path, out_path=None, scale=SCALE_FACTOR, kernel='nearest', output_mode='gtiff', engine='warp',
+                     compression=DEFAULT_COMPRESSION, tiled=True, tile_size=DEFAULT_TILE_SIZE, progress=None,
+                     overview_levels=OVERVIEW_LEVELS, external_overviews=False, approximate_statistics=None,
+                     threads=DEFAULT_THREADS):
+    if out_path is None:
+        out_path = resampled_path_for(tiff_path, output_mode)
+    if approximate_statistics is None:
+        approximate_statistics = engine == 'warp'
+    finishing = dict(overview_levels=overview_levels, external_overviews=external_overviews,
+                     approximate_statistics=approximate_statistics, threads=threads)
+    if engine == 'warp':
+        resample = lambda write_path: resample_geotiff_warp(tiff_path, write_path, scale, kernel, output_mode, compression, tiled,
+                                                            tile_size, progress=progress, **finishing)
+    elif engine == 'blocks':
+        if kernel != 'nearest' or scale != int(scale) or output_mode == 'vrt':
+            raise ValueError("The 'blocks' engine only does nearest neighbour, by a whole-number scale factor, to a GeoTIFF or COG")
+        resample = lambda write_path: resample_geotiff_blocks(tiff_path, write_path, int(scale), progress=progress, compression=compression,
+                                                              tiled=tiled, tile_size=tile_size, output_mode=output_mode, **finishing)
+    else:
+        raise ValueError("Unknown engine " + repr(engine) + ", choose one of " + ", ".join(engines))
+
+    write_path = partial_path_for(out_path)
+    try:
+        resample(write_path)
+    except BaseException:
+        remove_output(write_path)
+        remove_output(write_path + ".tmp.tif")
+        raise
+    move_output(write_path, out_path)
+    return out_path
+
+# Resample with GDAL's warp engine (every band of the input), using every core (multithread,
+# NUM_THREADS="threads") and at most "warp_memory_mb" of working memory, whatever the size of the output.
+# The output gets the EPSG:32617 spatial reference without being reprojected (the input is treated as
+# already being in it), as the block-by-block version does.
+# With output_mode='vrt', only a VRT describing the resampling is written; nothing is resampled until
+# the VRT is read.  With 'cog', GDAL writes a Cloud-Optimized GeoTIFF (with its own overviews) directly.
+# A 'gtiff' output then gets its overviews and statistics (see finish_output).  The statistics are
+# approximate unless asked otherwise, since exact ones would mean reading the whole output again.
+def resample_geotiff_warp(tiff_path, out_path=None, scale=SCALE_FACTOR, kernel='nearest', output_mode='gtiff',
+                          compression=DEFAULT_COMPRESSION, tiled=True, tile_size=DEFAULT_TILE_SIZE,
+                          warp_memory_mb=DEFAULT_WARP_MEMORY_MB, progress=None,
+                          overview_levels=OVERVIEW_LEVELS, external_overviews=False, approximate_statistics=True,
+                          threads=DEFAULT_THREADS):
+    if output_mode not in output_modes:
+        raise ValueError("Unknown output mode " + repr(output_mode) + ", choose one of " + ", ".join(output_modes))
+    if kernel not in kernels:
+        raise ValueError("Unknown kernel " + repr(kernel) + ", choose one of " + ", ".join(kernels))
+    if out_path is None:
+        out_path = resampled_path_for(tiff_path, output_mode)
+
+    in_ds = gdal.Open(tiff_path)
+    in_band = in_ds.GetRasterBand(1)
+    data_type = in_band.DataType
+    out_columns = int(round(in_ds.RasterXSize * scale))
+    out_rows = int(round(in_ds.RasterYSize * scale))
+
+    sr = osr.SpatialReference()
+    sr.ImportFromEPSG(OUTPUT_EPSG)
+
+    if output_mode == 'vrt':
+        driver, options = 'VRT', []
+    elif output_mode == 'cog':
+        driver, options = 'COG', cog_creation_options(data_type, compression, tile_size) + ['NUM_THREADS=' + str(threads)]
+    else:
+        driver, options = 'GTiff', creation_options(data_type, compression, tiled, tile_size) + ['NUM_THREADS=' + str(threads)]
+
+    callback = None
+    if progress is not None:
+        callback = lambda complete, message, data: progress(int(complete * out_columns * out_rows), out_columns * out_rows) or 1
+
+    remove_output(out_path)
+    out_ds = gdal.Warp(out_path, in_ds, options=gdal.WarpOptions(format=driver,
+                                                                 width=out_columns,
+                                                                 height=out_rows,
+                                                                 srcSRS=sr.ExportToWkt(),
+                                                                 dstSRS=sr.ExportToWkt(),
+                                                                 resampleAlg=kernels[kernel],
+                                                                 multithread=True,
+                                                                 warpOptions=['NUM_THREADS=' + str(threads)],
+                                                                 warpMemoryLimit=warp_memory_mb,
+                                                                 creationOptions=options,
+                                                                 callback=callback))
+    if out_ds is None:
+        raise RuntimeError("gdal.Warp failed for " + tiff_path + ": " + gdal.GetLastErrorMsg())
+
+    # release the out_ds resource, effectively closing it and saving our changes
+    del out_ds
+
+    if output_mode == 'gtiff':
+        finish_output(out_path, overview_levels, external_overviews, approximate_statistics, compression, threads)
+    return out_path
+
+# Build the overviews of a finished GeoTIFF (see add_overviews), then its statistics.  The overviews
+# come first so that approximate statistics can be read from the smallest overview instead of the
+# full raster.  Statistics that were already worked out while writing are kept.
+def finish_output(out_path, overview_levels=OVERVIEW_LEVELS, external_overviews=False, approximate_statistics=False,
+                  compression=DEFAULT_COMPRESSION, threads=DEFAULT_THREADS):
+    if overview_levels:
+        add_overviews(out_path, overview_levels, external_overviews, compression=compression, threads=threads)
+
+    out_ds = gdal.Open(out_path, gdal.GA_Update)
+    for index in range(1, out_ds.RasterCount + 1):
+        out_band = out_ds.GetRasterBand(index)
+        if out_band.GetMetadataItem('STATISTICS_MEAN') is None:
+            out_band.ComputeStatistics(approximate_statistics)
+        del out_band
+    del out_ds
+
+# Resample every band by reading the input block by block (see output_blocks and
+# read_upsampled_block).  This only does nearest neighbour, by a whole-number scale factor.
+# Each block is read for all bands in one call, and exact statistics for every band are worked
+# out from the blocks as they are written.
+# With output_mode='cog' the resampled raster and its overviews are written to a temporary tiled
+# GeoTIFF first, then copied with GDAL's COG driver.
+def resample_geotiff_blocks(tiff_path, out_path=None, scale=SCALE_FACTOR, max_block_pixels=DEFAULT_BLOCK_PIXELS, progress=None,
+                            compression=DEFAULT_COMPRESSION, tiled=True, tile_size=DEFAULT_TILE_SIZE, output_mode='gtiff',
+                            overview_levels=OVERVIEW_LEVELS, external_overviews=False, approximate_statistics=False,
+                            threads=DEFAULT_THREADS):
+    if output_mode not in ('gtiff', 'cog'):
+        raise ValueError("The block-by-block resampler can only write 'gtiff' or 'cog'")
+    if out_path is None:
+        out_path = resampled_path_for(tiff_path, output_mode)
+
+    # Open the raster
+    in_ds = gdal.Open(tiff_path)
+    band_count = in_ds.RasterCount
+    data_type = in_ds.GetRasterBand(1).DataType
+
+    # Multiply the output size by the scale factor
+    out_rows = in_ds.RasterYSize * scale
+    out_columns = in_ds.RasterXSize * scale
+
+    # A COG can't be written block by block, so write a tiled GeoTIFF next to the output first
+    write_path = out_path + ".tmp.tif" if output_mode == 'cog' else out_path
+    remove_output(out_path)
+
+    gtiff_driver = gdal.GetDriverByName('GTiff')
+    out_ds = gtiff_driver.Create(write_path, out_columns, out_rows, band_count, data_type,
+                                 options=creation_options(data_type, compression, tiled or output_mode == 'cog', tile_size)
+                                 + ['NUM_THREADS=' + str(threads)])
+
+    # create an EPSG:32617 Spatial Reference, and put it into the new tiff
+    sr = osr.SpatialReference()
+    sr.ImportFromEPSG(OUTPUT_EPSG)
+    out_ds.SetProjection(sr.ExportToWkt())
+
+    # Edit the geotransform so the pixels are one-"scale"th of the previous size
+    geotransform = list(in_ds.GetGeoTransform())
+    geotransform[1] /= scale
+    geotransform[5] /= scale
+    out_ds.SetGeoTransform(geotransform)
+
+    # Keep each band's nodata value, if it has one
+    out_bands = []
+    statistics = []
+    for index in range(1, band_count + 1):
+        nodata = in_ds.GetRasterBand(index).GetNoDataValue()
+        out_band = out_ds.GetRasterBand(index)
+        if nodata is not None:
+            out_band.SetNoDataValue(nodata)
+        out_bands.append(out_band)
+        statistics.append(BlockStatistics(nodata))
+
+    # Write the output one block at a time, each block aligned to the output's own tiles (or strips),
+    # working out the statistics from the blocks on the way
+    block_xsize, block_ysize = out_bands[0].GetBlockSize()
+    pixels_done = 0
+    for x, y, width, height in output_blocks(out_columns, out_rows, block_xsize, block_ysize, max_block_pixels // band_count):
+        data = read_upsampled_block(in_ds, x, y, width, height, scale, in_ds.RasterXSize, in_ds.RasterYSize)
+        data = data.reshape((band_count, height, width))
+        for out_band, band_statistics, band_data in zip(out_bands, statistics, data):
+            out_band.WriteArray(band_data, x, y)
+            band_statistics.add(band_data)
+        pixels_done += width * height
+        if progress is not None:
+            progress(pixels_done, out_columns * out_rows)
+
+    # flush the cache, and store the statistics
+    for out_band, band_statistics in zip(out_bands, statistics):
+        out_band.FlushCache()
+        band_statistics.apply(out_band)
+    del out_band, out_bands
+
+    if output_mode == 'cog':
+        # The COG driver re-uses the overviews built here, and lays everything out for range reads
+        if overview_levels:
+            build_missing_overviews(out_ds, overview_levels, compression=compression, threads=threads)
+        cog_ds = gdal.GetDriverByName('COG').CreateCopy(out_path, out_ds, options=cog_creation_options(data_type, compression, tile_size))
+        del cog_ds
+        del out_ds
+        gdal.GetDriverByName('GTiff').Delete(write_path)
+        return out_path
+
+    # release the out_ds resource, effectively closing it and saving our changes
+    del out_ds
+
+    finish_output(out_path, overview_levels, external_overviews, approximate_statistics, compression, threads)
+    return out_path
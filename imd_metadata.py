@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+Reading the TOA reflectance figures for a Worldview-3 scene from its metadata file.
+
+Every Worldview-3 product comes with an *.IMD file (or the same information as *.XML).
+From it we read each band's absCalFactor and effectiveBandwidth, the mean sun elevation,
+the acquisition time and the catalog ID of the scene, and work out the earth-sun distance
+on the acquisition date, so none of them have to be typed in by hand.
+
+Parsing is cached in a small JSON index on disk (MetadataCache), keyed by scene ID, so a
+batch over thousands of tiles of the same scene only parses its metadata once.
+"""
+
+import datetime
+import glob
+import json
+import math
+import os
+import re
+import xml.etree.ElementTree as ElementTree
+
+from toa_reflectance import ALL_BANDS
+
+# The names of the band groups in the metadata file, and the band names used in "calibration_figures"
+imd_band_groups = {'BAND_P': 'Pan',
+                   'BAND_C': 'Coastal',
+                   'BAND_B': 'Blue',
+                   'BAND_G': 'Green',
+                   'BAND_Y': 'Yellow',
+                   'BAND_R': 'Red',
+                   'BAND_RE': 'RedEdge',
+                   'BAND_N': 'NIR1',
+                   'BAND_N2': 'NIR2'}
+
+# Earth-sun distance (in astronomical units) at a given UTC date and time, using the formula in
+# "Radiometric Use of WorldView-3 Imagery" (DigitalGlobe, 2016)
+def earth_sun_distance(when):
+    year, month = when.year, when.month
+    day = when.day + (when.hour + when.minute / 60 + (when.second + when.microsecond / 1e6) / 3600) / 24
+    if month <= 2:
+        year -= 1
+        month += 12
+    A = int(year / 100)
+    B = 2 - A + int(A / 4)
+    julian_day = int(365.25 * (year + 4716)) + int(30.6001 * (month + 1)) + day + B - 1524.5
+
+    D = julian_day - 2451545.0
+    g = math.radians(357.529 + 0.98560028 * D)
+    return 1.00014 - 0.01671 * math.cos(g) - 0.00014 * math.cos(2 * g)
+
+# Parse a time such as 2016-04-16T15:47:07.562500Z (the fraction can have any number of digits)
+def parse_imd_time(text):
+    match = re.match(r"(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})(?:\.(\d+))?", text.strip())
+    if match is None:
+        raise ValueError("Can't read the time " + repr(text))
+    fraction = match.group(7) or "0"
+    return datetime.datetime(*(int(part) for part in match.groups()[:6]),
+                             microsecond=int(round(float("0." + fraction) * 1e6)) % 1000000,
+                             tzinfo=datetime.timezone.utc)
+
+# Read an *.IMD file into a dictionary of groups, for example
+#   {'': {'productCatalogId': '...'}, 'BAND_C': {'absCalFactor': '9.29e-03', ...}, 'IMAGE_1': {...}}
+# Values are kept as text, without quotes; top-level values are in the '' group.
+def read_imd_groups(text):
+    groups = {'': {}}
+    current = ['']
+    for line in text.splitlines():
+        line = line.strip().rstrip(';')
+        if '=' not in line:
+            continue
+        key, value = (part.strip() for part in line.split('=', 1))
+        if key == 'BEGIN_GROUP':
+            current.append(value)
+            groups.setdefault(value, {})
+        elif key == 'END_GROUP':
+            if len(current) > 1:
+                current.pop()
+        else:
+            groups[current[-1]][key] = value.strip('"')
+    return groups
+
+# Read the same information from the XML version of the metadata.  Tag names are upper case
+# in the XML (ABSCALFACTOR rather than absCalFactor), so everything is compared in upper case.
+def read_xml_groups(text):
+    root = ElementTree.fromstring(text)
+    imd = root if root.tag.upper() == 'IMD' else root.find('.//IMD')
+    if imd is None:
+        raise ValueError("No IMD section in the XML metadata")
+    groups = {'': {}}
+    for child in imd:
+        if len(child):
+            groups[child.tag.upper()] = {item.tag.upper(): (item.text or '').strip() for item in child}
+        else:
+            groups[''][child.tag.upper()] = (child.text or '').strip()
+    return groups
+
+# Look up a value in a group without caring about upper/lower case
+def _group_value(group, key):
+    for name, value in group.items():
+        if name.upper() == key.upper():
+            return value
+    return None
+
+# Parse a Worldview-3 *.IMD or *.XML metadata file.  Returns a dictionary that can be saved as JSON:
+#   scene_id                the catalog ID of the scene (or the file name, if there isn't one)
+#   abscal_factors          {band name: absCalFactor}
+#   effective_bandwidths    {band name: effectiveBandwidth}
+#   sun_elevation           mean sun elevation, in degrees
+#   acquisition_time        first line time, as ISO text
+#   earth_sun_distance      on the acquisition date, in astronomical units
+#   solar_zenith_angle      90 - sun elevation, in radians (toa_reflectance.py passes it straight to math.cos)
+def parse_imd(path):
+    with open(path, encoding='utf-8', errors='replace') as metadata_file:
+        text = metadata_file.read()
+    groups = read_xml_groups(text) if text.lstrip().startswith('<') else read_imd_groups(text)
+    upper_groups = {name.upper(): group for name, group in groups.items()}
+
+    abscal_factors = {}
+    effective_bandwidths = {}
+    for group_name, band in imd_band_groups.items():
+        group = upper_groups.get(group_name)
+        if group is None:
+            continue
+        abscal_factors[band] = float(_group_value(group, 'absCalFactor'))
+        effective_bandwidths[band] = float(_group_value(group, 'effectiveBandwidth'))
+    if not abscal_factors:
+        raise ValueError("No band calibration figures found in " + path)
+
+    image = next((group for name, group in sorted(upper_groups.items()) if name.startswith('IMAGE')), None)
+    if image is None:
+        raise ValueError("No IMAGE group found in " + path)
+    sun_elevation = float(_group_value(image, 'meanSunEl'))
+    acquisition_time = parse_imd_time(_group_value(image, 'firstLineTime'))
+
+    scene_id = (_group_value(image, 'CatId')
+                or _group_value(upper_groups[''], 'productCatalogId')
+                or os.path.splitext(os.path.basename(path))[0])
+
+    return {'scene_id': scene_id,
+            'abscal_factors': abscal_factors,
+            'effective_bandwidths': effective_bandwidths,
+            'sun_elevation': sun_elevation,
+            'acquisition_time': acquisition_time.isoformat(),
+            'earth_sun_distance': earth_sun_distance(acquisition_time),
+            'solar_zenith_angle': math.radians(90 - sun_elevation)}
+
+# Find the metadata file for an image: a *.IMD or *.XML file with the same name, or with the
+# tile suffix (_R1C1 and so on) taken off, or else the only *.IMD file in the same directory
+def find_metadata_file(image_path):
+    stem = os.path.splitext(image_path)[0]
+    stems = [stem, re.sub(r"_R\d+C\d+$", "", stem)]
+    for candidate_stem in stems:
+        for extension in ('.IMD', '.imd', '.XML', '.xml'):
+            if os.path.exists(candidate_stem + extension):
+                return candidate_stem + extension
+    imd_files = glob.glob(os.path.join(os.path.dirname(image_path), '*.IMD')) + glob.glob(os.path.join(os.path.dirname(image_path), '*.imd'))
+    if len(imd_files) == 1:
+        return imd_files[0]
+    return None
+
+# The scene parameters toa_reflectance.process_scene needs, for one band (one abscal factor
+# and effective bandwidth) or for ALL_BANDS (every band's figures, keyed by band name)
+def parameters_from_metadata(metadata, band):
+    parameters = {'band': band,
+                  'earth_sun_distance': metadata['earth_sun_distance'],
+                  'solar_zenith_angle': metadata['solar_zenith_angle']}
+    if band == ALL_BANDS:
+        parameters['abscal_factor'] = metadata['abscal_factors']
+        parameters['effective_bandwidth'] = metadata['effective_bandwidths']
+    else:
+        if band not in metadata['abscal_factors']:
+            raise ValueError("The metadata of scene " + metadata['scene_id'] + " has no figures for the " + band + " band")
+        parameters['abscal_factor'] = metadata['abscal_factors'][band]
+        parameters['effective_bandwidth'] = metadata['effective_bandwidths'][band]
+    return parameters
+
+# The default place for the metadata cache index
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.worldview3_metadata_cache.json')
+
+# A small on-disk index of parsed metadata.  It holds
+#   'scenes': {scene ID: parsed metadata (see parse_imd)}
+#   'files':  {metadata file path: {'mtime': ..., 'size': ..., 'scene_id': ...}}
+# so when a metadata file has been seen before and hasn't changed since, its scene's metadata
+# comes straight from the index without parsing the file again.
+# The index is written to a temporary file and renamed into place, so a crash never leaves it
+# half written.  It isn't meant to be written by several processes at once: in a batch, look
+# the metadata up before handing the scenes to worker processes (as toa_batch.py does).
+class MetadataCache:
+    def __init__(self, index_path=DEFAULT_CACHE_PATH):
+        self.index_path = index_path
+        self.index = {'scenes': {}, 'files': {}}
+        if os.path.exists(index_path):
+            try:
+                with open(index_path) as index_file:
+                    self.index = json.load(index_file)
+            except ValueError:
+                # A damaged index is only a cache; start a new one
+                pass
+
+    # The metadata for the scene described by one metadata file
+    def get(self, metadata_path):
+        metadata_path = os.path.abspath(metadata_path)
+        status = os.stat(metadata_path)
+        seen = self.index['files'].get(metadata_path)
+        if (seen is not None and seen['mtime'] == status.st_mtime and seen['size'] == status.st_size
+                and seen['scene_id'] in self.index['scenes']):
+            return self.index['scenes'][seen['scene_id']]
+
+        metadata = parse_imd(metadata_path)
+        self.index['scenes'][metadata['scene_id']] = metadata
+        self.index['files'][metadata_path] = {'mtime': status.st_mtime, 'size': status.st_size, 'scene_id': metadata['scene_id']}
+        self.save()
+        return metadata
+
+    # The metadata for an image (see find_metadata_file)
+    def get_for_image(self, image_path):
+        metadata_path = find_metadata_file(image_path)
+        if metadata_path is None:
+            raise ValueError("No *.IMD or *.XML metadata file found for " + image_path)
+        return self.get(metadata_path)
+
+    def save(self):
+        temporary_path = self.index_path + '.tmp'
+        with open(temporary_path, 'w') as index_file:
+            json.dump(self.index, index_file, indent=1)
+        os.replace(temporary_path, self.index_path)
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+Background jobs for the braga-agx-native backends, so a client doesn't have to hold its
+HTTP request open for the whole export.
+
+Submitting work (JobRunner.submit) gives back a job ID straight away; the work runs in a
+background thread, and its state is written to a job store as it goes:
+
+    PENDING -> RUNNING -> SUCCEEDED (with 'result') or FAILED (with 'error')
+
+If the instance running a job is recycled or scaled down before the job finishes, its record
+would stay PENDING or RUNNING; a record that hasn't changed for JOB_LOST_SECONDS is reported
+(and saved) as FAILED instead, see fail_lost_job.
+
+Clients then ask for the job's record with the ID, or give a callback URL that the finished
+record is POSTed to.  The endpoints aren't authenticated, so a callback URL must be https, on
+one of the hosts in the CALLBACK_ALLOWED_HOSTS environment variable (callbacks are refused if it
+isn't set), and redirects aren't followed; otherwise anyone could make the backend POST to
+internal addresses.
+
+There are two job stores with the same methods:
+  - MemoryJobStore keeps the records in this process, for tests and a single instance
+  - BucketJobStore keeps them as small JSON files in the bucket, under jobs/, so any
+    instance of the cloud function can answer a status request
+The background threads need the instance to keep its CPU after the response is sent (a
+2nd gen cloud function or Cloud Run service with CPU always allocated).
+"""
+
+import concurrent.futures
+import copy
+import json
+import os
+import threading
+import time
+import urllib.parse
+import urllib.request
+import uuid
+
+from google.api_core.exceptions import NotFound
+
+from ee_tasks import DEFAULT_TIMEOUT_SECONDS
+
+# The states a job goes through
+PENDING = 'PENDING'
+RUNNING = 'RUNNING'
+SUCCEEDED = 'SUCCEEDED'
+FAILED = 'FAILED'
+finished_job_states = (SUCCEEDED, FAILED)
+
+# How many jobs one instance runs at once.  It can be set with the JOB_WORKERS environment
+# variable of the cloud function.
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 4))
+
+# Where the job records go in the bucket
+JOB_PREFIX = 'jobs/'
+
+# How long a PENDING or RUNNING job can go without its record changing before it is taken to have
+# been lost with its instance, in seconds: the longest an export is waited for, and some time to
+# pick the scene and make the PNGs
+JOB_LOST_SECONDS = DEFAULT_TIMEOUT_SECONDS + 5 * 60
+
+# How long to wait for a callback URL to answer, in seconds
+CALLBACK_TIMEOUT_SECONDS = 10
+
+# The hosts callbacks may be sent to, as a comma-separated list of host names in the
+# CALLBACK_ALLOWED_HOSTS environment variable of the cloud function
+CALLBACK_ALLOWED_HOSTS = [host.strip().lower() for host in os.environ.get('CALLBACK_ALLOWED_HOSTS', '').split(',') if host.strip()]
+
+class UnknownJob(Exception):
+    pass
+
+# Raised for a callback URL that isn't https, or isn't on an allowed host
+class CallbackNotAllowed(ValueError):
+    pass
+
+# Job records kept in memory.  It can be used from several threads at once.
+class MemoryJobStore:
+    def __init__(self):
+        self.records = {}
+        self.lock = threading.Lock()
+
+    def create(self, record):
+        with self.lock:
+            self.records[record['jobId']] = copy.deepcopy(record)
+
+    # Change some of a job's fields, and return the whole record
+    def update(self, job_id, **changes):
+        with self.lock:
+            if job_id not in self.records:
+                raise UnknownJob(job_id)
+            self.records[job_id].update(copy.deepcopy(changes))
+            return copy.deepcopy(self.records[job_id])
+
+    # A job's record, or None if there is no such job
+    def get(self, job_id):
+        with self.lock:
+            return copy.deepcopy(self.records.get(job_id))
+
+# Job records kept as JSON in the bucket, one object per job.  Only the thread running a job
+# writes its record after it is created, so a read-change-write is safe.
+class BucketJobStore:
+    def __init__(self, bucket, prefix=JOB_PREFIX):
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def record_name(self, job_id):
+        return self.prefix + job_id + '.json'
+
+    def create(self, record):
+        self.bucket.blob(self.record_name(record['jobId'])).upload_from_string(json.dumps(record), content_type='application/json')
+
+    def update(self, job_id, **changes):
+        record = self.get(job_id)
+        if record is None:
+            raise UnknownJob(job_id)
+        record.update(changes)
+        self.create(record)
+        return record
+
+    def get(self, job_id):
+        try:
+            return json.loads(self.bucket.blob(self.record_name(job_id)).download_as_string())
+        except NotFound:
+            return None
+
+# Check that a callback URL is https and on one of "allowed_hosts", and raise CallbackNotAllowed if not
+def check_callback_url(url, allowed_hosts=None):
+    if allowed_hosts is None:
+        allowed_hosts = CALLBACK_ALLOWED_HOSTS
+    try:
+        parts = urllib.parse.urlsplit(url)
+        host = (parts.hostname or '').lower()
+    except ValueError:
+        raise CallbackNotAllowed("The callback URL " + repr(url) + " isn't a valid URL")
+    if parts.scheme != 'https':
+        raise CallbackNotAllowed("The callback URL must be https")
+    if host not in allowed_hosts:
+        raise CallbackNotAllowed("Callbacks to " + repr(host) + " aren't allowed")
+
+# Redirects aren't followed, so an allowed host can't send the callback somewhere else
+class _NoRedirects(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+# POST a finished job's record, as JSON, to the URL the client gave (which is checked again with
+# check_callback_url).  A callback that fails is only logged: the record is still in the job store.
+def post_callback(url, record, timeout=CALLBACK_TIMEOUT_SECONDS, allowed_hosts=None):
+    try:
+        check_callback_url(url, allowed_hosts)
+        request = urllib.request.Request(url, data=json.dumps(record).encode('utf-8'),
+                                         headers={'Content-Type': 'application/json'}, method='POST')
+        with urllib.request.build_opener(_NoRedirects).open(request, timeout=timeout) as response:
+            response.read()
+    except Exception as error:
+        print("callback to " + url + " failed: " + str(error))
+
+# A job's record as it should be reported: if it is PENDING or RUNNING but hasn't been updated for
+# "lost_seconds", the instance running it has gone, so it is recorded as FAILED in the job store
+# (and returned that way even if the store can't be written)
+def fail_lost_job(store, record, lost_seconds=JOB_LOST_SECONDS):
+    now = time.time()
+    if record is None or record['state'] in finished_job_states or now - record['updated'] < lost_seconds:
+        return record
+    changes = {'state': FAILED, 'error': "The job was lost: it stopped without finishing", 'updated': now}
+    try:
+        return store.update(record['jobId'], **changes)
+    except Exception as error:
+        print("could not record job " + record['jobId'] + " as lost: " + str(error))
+        return dict(record, **changes)
+
+# Runs work in background threads, keeping its record in a job store up to date
+class JobRunner:
+    def __init__(self, store, workers=JOB_WORKERS):
+        self.store = store
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    # Start "work" (a function taking no arguments, that returns a result that can be saved as JSON,
+    # or raises an exception if it fails) in the background, and return the new job's ID straight away.
+    # "details" (the request, for example) are kept in the job's record.
+    # Raises CallbackNotAllowed for a "callback_url" that isn't allowed (see check_callback_url).
+    def submit(self, work, callback_url=None, details=None):
+        if callback_url:
+            check_callback_url(callback_url)
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        self.store.create({'jobId': job_id,
+                           'state': PENDING,
+                           'submitted': now,
+                           'updated': now,
+                           'details': details or {},
+                           'result': None,
+                           'error': None})
+        self.pool.submit(self.run, job_id, work, callback_url)
+        return job_id
+
+    # Run a job, and return its final record.  If the job store can't be written (a cloud storage
+    # error, or a result that can't be saved as JSON) the job is recorded as FAILED, so it is never
+    # left PENDING or RUNNING.
+    def run(self, job_id, work, callback_url=None):
+        try:
+            self.store.update(job_id, state=RUNNING, updated=time.time())
+            result = work()
+            record = self.store.update(job_id, state=SUCCEEDED, result=result, updated=time.time())
+        except Exception as error:
+            record = self.fail(job_id, error)
+        if callback_url:
+            post_callback(callback_url, record)
+        return record
+
+    # Record a job as FAILED, with the error.  If even that can't be written, the error is logged,
+    # and the record the job store should have had is returned.
+    def fail(self, job_id, error):
+        changes = {'state': FAILED, 'error': str(error), 'updated': time.time()}
+        try:
+            return self.store.update(job_id, **changes)
+        except Exception as store_error:
+            print("could not record job " + job_id + " as failed: " + str(store_error))
+            changes['jobId'] = job_id
+            return changes
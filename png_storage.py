@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Turning the GeoTIFFs Earth Engine exports into PNGs, and storing PNGs in cloud storage,
+for the braga-agx-native backends.
+
+Everything happens in memory: the exported GeoTIFF is downloaded as bytes, opened with a
+rasterio MemoryFile, each PNG is encoded into another MemoryFile, and uploaded from its
+bytes.  Nothing is written to disk, so there are no temp files to clean up.
+
+PNGs are named from a digest of what went into them (png_name), not at random, so the same
+result is only ever stored once, and is uploaded with a long-lived, immutable Cache-Control.
+"""
+
+import concurrent.futures
+import hashlib
+
+from rasterio.io import MemoryFile
+
+# The bucket the backends export to, and serve the PNGs from
+BUCKET = 'braga-agx-native'
+
+# The PNGs never change once written (their names come from everything that decides what they
+# look like, see png_name), so phones and caches can keep them for a year without checking back
+PNG_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# A name made from a digest of the given parts (cache keys, for example), so the same inputs
+# always give the same name, and different ones never clash
+def content_name(*parts):
+    return hashlib.sha256("\n".join(parts).encode('utf-8')).hexdigest()
+
+# The object name (without .png) of an index's PNG, from its cache key (see result_cache.result_key)
+def png_name(index, key):
+    return index.lower() + "_" + key
+
+# The public URL of an object in the bucket
+def public_url(object_name):
+    return "https://storage.googleapis.com/" + BUCKET + "/" + object_name
+
+# Encode an array of (bands, rows, columns) as a PNG, and return its bytes.  The georeferencing of
+# the GeoTIFF it came from can be kept with "crs" and "transform", as the rasterio profile used to.
+def encode_png(raster, crs=None, transform=None):
+    with MemoryFile() as png_file:
+        with png_file.open(driver='PNG', width=raster.shape[2], height=raster.shape[1],
+                           count=raster.shape[0], dtype=raster.dtype, crs=crs, transform=transform) as dst:
+            dst.write(raster)
+        return png_file.read()
+
+# Turn the bytes of a GeoTIFF into PNGs, one for each group of bands in "band_groups" (lists of
+# band numbers, counting from 1), or one of all its bands if no groups are given.
+# Returns a list of PNG bytes, in the order of "band_groups".
+def tiff_bytes_to_pngs(tiff_bytes, band_groups=None):
+    with MemoryFile(tiff_bytes) as tiff_file:
+        with tiff_file.open() as infile:
+            raster = infile.read()
+            crs, transform = infile.crs, infile.transform
+    if band_groups is None:
+        band_groups = [list(range(1, raster.shape[0] + 1))]
+    return [encode_png(raster[[band - 1 for band in bands]], crs, transform) for bands in band_groups]
+
+# Upload PNG bytes to the bucket as <name>.png, with PNG_CACHE_CONTROL, and return its public URL.
+# The names come from the inputs (see png_name), so if the object is already there it already holds
+# these bytes, and isn't uploaded again.
+def upload_png(bucket, name, data):
+    blob = bucket.blob(name + ".png")
+    if not blob.exists():
+        blob.cache_control = PNG_CACHE_CONTROL
+        blob.upload_from_string(data, content_type='image/png')
+    return public_url(name + ".png")
+
+# Whether every one of the named PNGs is already in the bucket
+def pngs_exist(bucket, names):
+    return all(bucket.blob(name + ".png").exists() for name in names)
+
+# Download the GeoTIFF <tiff_name>.tif that an export wrote to the bucket, turn each group of its
+# bands into a PNG (see tiff_bytes_to_pngs), and upload them as <png name>.png.  The uploads are
+# made at the same time.  "png_names" and "band_groups" go together; with no band groups, there is
+# one PNG of every band.  Returns the public URLs of the PNGs, in the order of "png_names".
+def convert_export_to_pngs(bucket, tiff_name, png_names, band_groups=None):
+    tiff_bytes = bucket.blob(tiff_name + ".tif").download_as_string()
+    pngs = tiff_bytes_to_pngs(tiff_bytes, band_groups)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(pngs))) as pool:
+        return list(pool.map(lambda name_and_data: upload_png(bucket, *name_and_data), zip(png_names, pngs)))
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Command-line batch resampling of GeoTIFFs, without the GUI.
+
+Every GeoTIFF found in the given directories or glob patterns is resampled (every band) with
+geotiff_resampler.resample_geotiff, in parallel across a pool of processes (one file per
+process).  Each process gives GDAL its share of the cores (cores / workers threads), so the
+pool and GDAL's own threads don't fight over them.  Files whose output already exists are
+skipped, unless --overwrite is given.  Outputs are named as in the GUI, with the suffix
+"_resampled_and_converted", and only get that name once they are complete (see
+geotiff_resampler.resample_geotiff), so a file whose resampling failed or was killed part way
+is resampled again on the next run.
+
+Example:
+    python resample_batch.py /data/tiles --scale 5 --kernel nearest --workers 4
+    python resample_batch.py "/data/tiles/*.tif" --output-mode cog --engine blocks
+"""
+
+import argparse
+import concurrent.futures
+import os
+import sys
+import time
+
+from osgeo import gdal
+
+from batch_files import find_scenes
+from geotiff_resampler import (DEFAULT_COMPRESSION, SCALE_FACTOR, compressions, engines, kernels, output_modes,
+                               resample_geotiff, resampled_path_for)
+
+# Resample one file.  This runs in a worker process, so it only takes and returns plain values.
+# Returns (file, output path, number of output pixels, seconds taken).
+def resample_file(tiff_path, out_path, options):
+    start = time.perf_counter()
+    in_ds = gdal.Open(tiff_path)
+    if in_ds is None:
+        raise RuntimeError("Can't open " + tiff_path + ": " + gdal.GetLastErrorMsg())
+    pixels = int(round(in_ds.RasterXSize * options['scale'])) * int(round(in_ds.RasterYSize * options['scale'])) * in_ds.RasterCount
+    del in_ds
+    resample_geotiff(tiff_path, out_path, **options)
+    return tiff_path, out_path, pixels, time.perf_counter() - start
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Resample GeoTIFFs to a finer pixel size, in parallel")
+    parser.add_argument("inputs", nargs="+", help="GeoTIFF files, directories, or glob patterns")
+    parser.add_argument("--scale", type=float, default=SCALE_FACTOR, help="how many times smaller the output pixels are (default: %(default)s)")
+    parser.add_argument("--kernel", choices=list(kernels), default='nearest', help="resampling kernel (default: %(default)s)")
+    parser.add_argument("--output-mode", choices=output_modes, default='gtiff', help="output type (default: %(default)s)")
+    parser.add_argument("--engine", choices=engines, default='warp', help="resampling engine (default: %(default)s)")
+    parser.add_argument("--compression", choices=compressions, default=DEFAULT_COMPRESSION, help="(default: %(default)s)")
+    parser.add_argument("--external-overviews", action="store_true", help="put the overviews in an external .ovr file")
+    statistics = parser.add_mutually_exclusive_group()
+    statistics.add_argument("--approximate-statistics", dest="approximate_statistics", action="store_const", const=True,
+                            help="work out the statistics from the smallest overview (the default for the warp engine)")
+    statistics.add_argument("--exact-statistics", dest="approximate_statistics", action="store_const", const=False,
+                            help="work out the statistics from the full output (the default for the blocks engine)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes (default: one per core)")
+    parser.add_argument("--overwrite", action="store_true", help="resample files even if their output already exists")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    if args.engine == 'blocks' and (args.scale != int(args.scale) or args.kernel != 'nearest'):
+        print("The 'blocks' engine only does nearest neighbour, by a whole-number scale factor")
+        return 1
+
+    files = find_scenes(args.inputs)
+    if not files:
+        print("No GeoTIFFs found")
+        return 1
+
+    jobs = []
+    for tiff_path in files:
+        out_path = resampled_path_for(tiff_path, args.output_mode)
+        if os.path.exists(out_path) and not args.overwrite:
+            print("skipped   " + tiff_path + " (" + os.path.basename(out_path) + " already exists)")
+            continue
+        jobs.append((tiff_path, out_path))
+
+    # Share the cores between the worker processes
+    workers = max(1, min(args.workers, len(jobs) or 1))
+    options = dict(scale=int(args.scale) if args.engine == 'blocks' else args.scale, kernel=args.kernel,
+                   output_mode=args.output_mode, engine=args.engine, compression=args.compression,
+                   external_overviews=args.external_overviews, approximate_statistics=args.approximate_statistics,
+                   threads=max(1, (os.cpu_count() or 1) // workers))
+
+    failures = 0
+    total_pixels = 0
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(resample_file, tiff_path, out_path, options): tiff_path for tiff_path, out_path in jobs}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                tiff_path, out_path, pixels, seconds = future.result()
+            except Exception as error:
+                failures += 1
+                print("FAILED    " + futures[future] + ": " + str(error))
+                continue
+            total_pixels += pixels
+            print("resampled %s -> %s: %.1f s, %.1f Mpixels/s" % (tiff_path, os.path.basename(out_path), seconds, pixels / seconds / 1e6))
+
+    seconds = time.perf_counter() - start
+    if jobs:
+        print("%d files resampled, %d failed, %d skipped in %.1f s (%.1f output Mpixels/s overall)"
+              % (len(jobs) - failures, failures, len(files) - len(jobs), seconds, total_pixels / seconds / 1e6))
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
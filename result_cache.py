@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+A cache of the PNGs the braga-agx-native backends have already made, so asking for the
+same field again doesn't start another Earth Engine export.
+
+A result is keyed by a hash of everything that decides what the PNG looks like: the field's
+polygon (normalized, so the same field drawn from a different corner or in the other direction
+gives the same key), the index, its visualization parameters, the Sentinel-2 scene it was made
+from and the export scale.  When a newer scene comes in, the key changes and the PNG is made again.
+
+There are two tiers:
+  - an in-memory LRU, which lives as long as the cloud function instance (a hit takes microseconds)
+  - a small JSON manifest per result in the bucket, under cache/, shared by every instance
+A result found in the bucket is put in the LRU too.
+
+Finding the key needs the scene, and picking the scene is a blocking Earth Engine round trip of
+a second or more, so the scene picked for each (normalized) polygon is also remembered in memory
+for SCENE_MEMO_SECONDS.  A repeat request within that time is answered without calling Earth
+Engine at all.
+"""
+
+import collections
+import hashlib
+import json
+import os
+import threading
+import time
+
+from google.api_core.exceptions import NotFound
+
+from sentinel2_indices import outer_ring, signed_area
+
+# How many results the in-memory tier holds
+RESULT_CACHE_SIZE = 1024
+
+# Where the manifests go in the bucket
+MANIFEST_PREFIX = 'cache/'
+
+# How long the scene picked for a field is remembered, in seconds.  Sentinel-2 passes over a field
+# every 5 days, so a few hours means a new scene is picked up soon after it comes in.  It can be set
+# with the SCENE_MEMO_SECONDS environment variable of the cloud function.
+SCENE_MEMO_SECONDS = int(os.environ.get('SCENE_MEMO_SECONDS', 6 * 60 * 60))
+
+# How many decimal places of a degree are kept when normalizing coordinates (6 is about 10 cm)
+COORDINATE_DIGITS = 6
+
+# A polygon's outer ring (see sentinel2_indices.outer_ring), normalized so the same field always gives
+# the same list of points: rounded to COORDINATE_DIGITS, without the repeated closing point, anticlockwise,
+# and starting from its smallest point
+def normalize_coords(coords, digits=COORDINATE_DIGITS):
+    points = [(round(float(point[0]), digits), round(float(point[1]), digits)) for point in outer_ring(coords)]
+    if len(points) > 1 and points[0] == points[-1]:
+        points = points[:-1]
+    if signed_area(points) < 0:
+        points.reverse()
+
+    start = points.index(min(points))
+    return [list(point) for point in points[start:] + points[:start]]
+
+# The cache key of one index's PNG of a field
+def result_key(coords, index, visualization, scene_id, scale):
+    description = {'coords': normalize_coords(coords),
+                   'index': index,
+                   'visualization': visualization,
+                   'scene': scene_id,
+                   'scale': round(float(scale), 3)}
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode('utf-8')).hexdigest()
+
+# The key the scene picked for a field is remembered by
+def scene_key(coords):
+    return hashlib.sha256(json.dumps(normalize_coords(coords)).encode('utf-8')).hexdigest()
+
+# The two-tier cache.  Results are small dictionaries that can be saved as JSON, such as
+# {'url': ..., 'dateTaken': ...}.  With no bucket, only the in-memory tier is used.
+# The scenes picked for fields (see scene_key) are only kept in memory, for "scene_seconds".
+# It can be used from several threads at once.
+class ResultCache:
+    def __init__(self, bucket=None, size=RESULT_CACHE_SIZE, prefix=MANIFEST_PREFIX, scene_seconds=SCENE_MEMO_SECONDS):
+        self.bucket = bucket
+        self.size = size
+        self.prefix = prefix
+        self.scene_seconds = scene_seconds
+        self.results = collections.OrderedDict()
+        self.scenes = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def manifest_name(self, key):
+        return self.prefix + key + '.json'
+
+    # The cached result for a key, or None
+    def get(self, key):
+        with self.lock:
+            if key in self.results:
+                self.results.move_to_end(key)
+                return self.results[key]
+        if self.bucket is None:
+            return None
+
+        try:
+            result = json.loads(self.bucket.blob(self.manifest_name(key)).download_as_string())
+        except NotFound:
+            return None
+        self.remember(key, result)
+        return result
+
+    # Put a result in the in-memory tier only
+    def remember(self, key, result):
+        with self.lock:
+            self.results[key] = result
+            self.results.move_to_end(key)
+            while len(self.results) > self.size:
+                self.results.popitem(last=False)
+
+    # Put a result in both tiers
+    def put(self, key, result):
+        self.remember(key, result)
+        if self.bucket is not None:
+            self.bucket.blob(self.manifest_name(key)).upload_from_string(json.dumps(result), content_type='application/json')
+
+    # The scene remembered for a field's polygon (its info from sentinel2_indices.scene_info), or None
+    # if there isn't one, or it is older than "scene_seconds"
+    def get_scene(self, coords):
+        key = scene_key(coords)
+        with self.lock:
+            if key not in self.scenes:
+                return None
+            expires, info = self.scenes[key]
+            if time.monotonic() >= expires:
+                del self.scenes[key]
+                return None
+            self.scenes.move_to_end(key)
+            return info
+
+    # Remember the scene picked for a field's polygon
+    def remember_scene(self, coords, info):
+        key = scene_key(coords)
+        with self.lock:
+            self.scenes[key] = (time.monotonic() + self.scene_seconds, info)
+            self.scenes.move_to_end(key)
+            while len(self.scenes) > self.size:
+                self.scenes.popitem(last=False)
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""
+Picking the Sentinel-2 scene for a field, and working out vegetation/water indices on it,
+for the braga-agx-native backends.
+
+The best scene is picked once per request (select_scene), every requested index is added
+to that one image as its own band (add_indices), and the coloured versions of all of them
+are put into one multi-band image (visualize_indices), so however many indices a request
+asks for, it costs one scene search and one export.  Each index's three coloured bands
+(named <index>_red, <index>_green, <index>_blue) then become that index's PNG.
+
+The scene search only looks at the last month of the archive to begin with, widening the
+window only when no scene in it is clear enough (see select_scene), and ranks scenes by
+Sentinel-2's own CLOUDY_PIXEL_PERCENTAGE.
+
+Small fields can skip the batch export altogether: use_fast_path says whether a polygon
+is small enough, and fetch_index_pngs gets the PNGs with synchronous thumbnail requests.
+
+Adding an index only needs a function and a display range in "indices" below.
+"""
+
+import concurrent.futures
+import datetime
+import json
+import math
+import os
+import urllib.request
+
+import ee
+
+# The Sentinel-2 surface reflectance collection the backends search
+S2_COLLECTION = 'COPERNICUS/S2_SR'
+
+# The palette every index is shown with
+index_palette = ['FF0000', 'FF6E07', 'FFA500', 'FFDB00', '00FF00', '009700']
+                 #red     #dark orange  #orange #yellow   #green #dark green
+
+# Sentinel-2 surface reflectance is stored as reflectance x 10000
+S2_REFLECTANCE_SCALE = 10000
+
+def ndvi(image):
+    return image.normalizedDifference(['B8', 'B4'])
+
+def ndwi(image):
+    return image.select('B8').subtract(image.select('B12')).divide(image.select('B8').add(image.select('B12')))
+
+# EVI and SAVI have constant terms, so they need the bands as reflectance (0 to 1)
+def evi(image):
+    return image.expression('2.5 * (NIR - RED) / (NIR + 6 * RED - 7.5 * BLUE + 1)',
+                            {'NIR': image.select('B8').divide(S2_REFLECTANCE_SCALE),
+                             'RED': image.select('B4').divide(S2_REFLECTANCE_SCALE),
+                             'BLUE': image.select('B2').divide(S2_REFLECTANCE_SCALE)})
+
+def savi(image):
+    return image.expression('1.5 * (NIR - RED) / (NIR + RED + 0.5)',
+                            {'NIR': image.select('B8').divide(S2_REFLECTANCE_SCALE),
+                             'RED': image.select('B4').divide(S2_REFLECTANCE_SCALE)})
+
+# Every index a request can ask for: the function that works it out from a Sentinel-2 image,
+# the bands it uses, and the range of values spread over the palette
+indices = {'NDVI': {'calculate': ndvi, 'bands': ['B8', 'B4'], 'min': 0, 'max': 1},
+           'NDWI': {'calculate': ndwi, 'bands': ['B8', 'B12'], 'min': -1, 'max': 1},
+           'EVI': {'calculate': evi, 'bands': ['B8', 'B4', 'B2'], 'min': 0, 'max': 1},
+           'SAVI': {'calculate': savi, 'bands': ['B8', 'B4'], 'min': 0, 'max': 1}}
+
+index_names = list(indices)
+
+# The indices the ndvi_ndwi backend returns when a request doesn't ask for any
+DEFAULT_INDICES = ['NDVI', 'NDWI']
+
+# Read the list of indices a request asks for.  It can be a list, a JSON list as text, or
+# comma-separated text ("NDVI,NDWI"); names aren't case sensitive and repeats are dropped.
+# Raises ValueError for an index that isn't in "indices".
+def parse_indices(value, default=DEFAULT_INDICES):
+    if value is None or len(value) == 0:
+        return list(default)
+    if isinstance(value, str):
+        value = json.loads(value) if value.strip().startswith('[') else value.split(',')
+
+    names = []
+    for name in value:
+        name = str(name).strip().upper()
+        if name not in indices:
+            raise ValueError("Unknown index " + repr(name) + ", choose from " + ", ".join(index_names))
+        if name not in names:
+            names.append(name)
+    return names
+
+# The native resolution of each Sentinel-2 band, in metres
+band_resolutions = {'B1': 60, 'B2': 10, 'B3': 10, 'B4': 10, 'B5': 20, 'B6': 20, 'B7': 20,
+                    'B8': 10, 'B8A': 20, 'B9': 60, 'B11': 20, 'B12': 20}
+
+# The most pixels an export may have.  Bigger fields are exported at a coarser scale instead,
+# so the export, the download and the PNG conversion stay quick, and the PNG stays small.
+# It can be set with the MAX_EXPORT_PIXELS environment variable of the cloud function.
+MAX_EXPORT_PIXELS = int(os.environ.get('MAX_EXPORT_PIXELS', 4000000))
+
+# The mean radius of the earth, in metres
+EARTH_RADIUS = 6371008.8
+
+# The export scale (in metres) at the native resolution of the named indices: the finest of the
+# bands they use (10 m for all the current ones, which all use B8)
+def native_scale(names):
+    return min(band_resolutions[band] for name in names for band in indices[name]['bands'])
+
+# The outer ring of a polygon's coordinates, as passed to ee.Geometry.Polygon: either a list of
+# [longitude, latitude] points, or a list of rings (the first one being the outside)
+def outer_ring(coords):
+    if isinstance(coords[0][0], (list, tuple)):
+        return coords[0]
+    return coords
+
+# The width and height (in metres) of the box around a polygon (see outer_ring), worked out
+# locally, so it doesn't cost a round trip to Earth Engine.  Longitudes are scaled by the cosine
+# of the middle latitude, which is plenty accurate for field-sized polygons.
+def bounding_box_size(coords):
+    ring = outer_ring(coords)
+    longitudes = [point[0] for point in ring]
+    latitudes = [point[1] for point in ring]
+    middle_latitude = math.radians((min(latitudes) + max(latitudes)) / 2)
+    width = math.radians(max(longitudes) - min(longitudes)) * EARTH_RADIUS * math.cos(middle_latitude)
+    height = math.radians(max(latitudes) - min(latitudes)) * EARTH_RADIUS
+    return width, height
+
+# The scale (in metres per pixel) to export a polygon at: the native resolution of the named
+# indices, or coarser if the box around the polygon would have more than "max_pixels" pixels
+def export_scale(coords, names, max_pixels=MAX_EXPORT_PIXELS):
+    scale = native_scale(names)
+    width, height = bounding_box_size(coords)
+    if width * height / (scale * scale) > max_pixels:
+        scale = math.sqrt(width * height / max_pixels)
+    return scale
+
+# Fields up to this area (in square metres) skip the batch export: their PNGs are fetched straight
+# from Earth Engine as thumbnails (see fetch_index_pngs), which takes a second or two rather than
+# the tens of seconds of a batch task.  It can be set with the FAST_PATH_MAX_AREA environment
+# variable of the cloud function.  A square kilometre is 10000 pixels at 10 m.
+FAST_PATH_MAX_AREA = float(os.environ.get('FAST_PATH_MAX_AREA', 1000000))
+
+# How long to wait for a thumbnail, in seconds
+THUMBNAIL_TIMEOUT_SECONDS = 60
+
+# The area of a ring of (x, y) points by the shoelace formula: positive if the ring goes anticlockwise,
+# negative if it goes clockwise.  The ring doesn't have to repeat its first point at the end.
+def signed_area(points):
+    points = list(points)
+    return sum(x1 * y2 - x2 * y1 for (x1, y1), (x2, y2) in zip(points, points[1:] + points[:1])) / 2
+
+# The area (in square metres) of a polygon (see outer_ring), worked out locally in the same way
+# as bounding_box_size
+def polygon_area(coords):
+    ring = outer_ring(coords)
+    latitudes = [point[1] for point in ring]
+    middle_latitude = math.radians((min(latitudes) + max(latitudes)) / 2)
+    return abs(signed_area((math.radians(point[0]) * EARTH_RADIUS * math.cos(middle_latitude), math.radians(point[1]) * EARTH_RADIUS)
+                           for point in ring))
+
+# Whether a polygon is small enough for the fast path (see FAST_PATH_MAX_AREA)
+def use_fast_path(coords, max_area=FAST_PATH_MAX_AREA):
+    return polygon_area(coords) <= max_area
+
+# Download a URL, and return the bytes
+def download(url, timeout=THUMBNAIL_TIMEOUT_SECONDS):
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        return response.read()
+
+# The fast path: fetch the coloured PNG of each of the named indices over a polygon straight from
+# Earth Engine, with a synchronous thumbnail request per index (made at the same time), at "scale"
+# metres per pixel.  No batch task is started.  Returns {index: PNG bytes}.
+# "fetch" downloads a URL (download, unless given), so this can be tried out without a network.
+def fetch_index_pngs(image, geometry, coords, names, scale, fetch=None):
+    if fetch is None:
+        fetch = download
+    width, height = bounding_box_size(coords)
+    dimensions = "%dx%d" % (max(1, int(math.ceil(width / scale))), max(1, int(math.ceil(height / scale))))
+
+    def fetch_index(name):
+        url = visualize_indices(image, [name]).getThumbURL({'region': geometry,
+                                                            'dimensions': dimensions,
+                                                            'crs': 'EPSG:4326',
+                                                            'format': 'png'})
+        return name, fetch(url)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(names))) as pool:
+        return dict(pool.map(fetch_index, names))
+
+# The scene search looks at the last SEARCH_WINDOW_DAYS days first, then twice as far back, and
+# so on up to MAX_SEARCH_WINDOW_DAYS, until it finds a scene with no more than
+# MAX_CLOUDY_PIXEL_PERCENTAGE cloudy pixels
+SEARCH_WINDOW_DAYS = 30
+MAX_SEARCH_WINDOW_DAYS = 365
+MAX_CLOUDY_PIXEL_PERCENTAGE = 20
+
+MILLISECONDS_PER_DAY = 24 * 60 * 60 * 1000
+
+# The Sentinel-2 scene used for a field.  Within the smallest search window (see SEARCH_WINDOW_DAYS)
+# that has a clear enough scene, the least cloudy one is picked, newest first among equals.  If no scene
+# in MAX_SEARCH_WINDOW_DAYS is clear enough, the least cloudy one of them all is picked instead.
+# The widening is done on the Earth Engine side in the one query, rather than with a round trip per
+# window: every scene gets the number of the first window it falls in (0 for the last 30 days, 1 for
+# 30-60 days ago, 2 for 60-120 ...), or a number after all of them if it is too cloudy, and the
+# scenes are sorted by that first.
+# "end" is the end of the search, a timezone-aware datetime (now, if not given).
+def select_scene(geometry, window_days=SEARCH_WINDOW_DAYS, max_window_days=MAX_SEARCH_WINDOW_DAYS,
+                 max_cloudy_pixel_percentage=MAX_CLOUDY_PIXEL_PERCENTAGE, end=None):
+    if end is None:
+        end = datetime.datetime.now(datetime.timezone.utc)
+    end_millis = int(end.timestamp() * 1000)
+    start_millis = end_millis - max_window_days * MILLISECONDS_PER_DAY
+    too_cloudy = int(math.ceil(math.log(max_window_days / window_days, 2))) + 1
+
+    def add_search_window(image):
+        age_in_windows = (ee.Number(end_millis).subtract(image.get('system:time_start'))
+                          .divide(window_days * MILLISECONDS_PER_DAY).max(1))
+        search_window = age_in_windows.log().divide(math.log(2)).ceil()
+        clear = ee.Number(image.get('CLOUDY_PIXEL_PERCENTAGE')).lte(max_cloudy_pixel_percentage)
+        return image.set('search_window', ee.Algorithms.If(clear, search_window, too_cloudy))
+
+    collection = (ee.ImageCollection(S2_COLLECTION)
+                  .filterBounds(geometry)
+                  .filterDate(ee.Date(start_millis), ee.Date(end_millis))
+                  .map(add_search_window))
+    return ee.Image(collection
+                    .sort('system:time_start', False)
+                    .sort('CLOUDY_PIXEL_PERCENTAGE')
+                    .sort('search_window').first())
+
+# Raised when select_scene finds no scene of a field at all in MAX_SEARCH_WINDOW_DAYS
+class NoSceneFound(ValueError):
+    def __init__(self, window_days=MAX_SEARCH_WINDOW_DAYS):
+        super().__init__("No Sentinel-2 scene of this field in the last %d days" % window_days)
+
+# The date (YYYY-MM-DD) and ID of a scene, fetched from Earth Engine in one round trip, or None if
+# the scene doesn't exist (select_scene found nothing; see scene_infos)
+def scene_info(image):
+    return scene_infos([image])[0]
+
+# The dates and IDs of several scenes (see scene_info), fetched from Earth Engine in one round trip.
+# A scene that doesn't exist (select_scene found nothing) gives None instead of failing them all.
+def scene_infos(images):
+    return ee.List([ee.Algorithms.If(image,
+                                     ee.Dictionary({'date': image.date().format('YYYY-MM-dd'),
+                                                    'id': image.get('system:index')}),
+                                     None) for image in images]).getInfo()
+
+# A scene, by its ID (as given by scene_info)
+def scene_image(scene_id):
+    return ee.Image(S2_COLLECTION + '/' + scene_id)
+
+# Add a band for each of the named indices to an image
+def add_indices(image, names):
+    return image.addBands(ee.Image.cat([indices[name]['calculate'](image).rename(name) for name in names]))
+
+# How an index is coloured (the parameters of ee.Image.visualize)
+def visualization_parameters(name):
+    return {'min': indices[name]['min'],
+            'max': indices[name]['max'],
+            'palette': index_palette}
+
+# The names of the three coloured bands of an index in the visualize_indices image
+def visualized_band_names(name):
+    return [name + '_red', name + '_green', name + '_blue']
+
+# The band numbers (counting from 1) of each named index's three coloured bands in the exported
+# visualize_indices image, in the order of "names"
+def visualized_band_numbers(names):
+    return [[3 * position + 1, 3 * position + 2, 3 * position + 3] for position in range(len(names))]
+
+# One image holding the coloured (8-bit RGB) version of each of the named indices, three bands
+# per index, in the order of "names".  This is what gets exported.
+def visualize_indices(image, names):
+    return ee.Image.cat([image.select(name).visualize(**visualization_parameters(name))
+                         .rename(visualized_band_names(name)) for name in names])
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+Shared set-up for the tests.
+
+The modules under test live at the top of the repository, so it is put on the path.  The
+Earth Engine API (ee) and google-cloud-storage are only needed by the cloud functions
+themselves; when they aren't installed, the few names the helper modules import from them
+at import time are filled in with stand-ins, and each test replaces what it uses.
+GDAL's Python bindings (osgeo) get empty stand-ins the same way, so the parts of
+geotiff_resampler.py that don't call GDAL can be tested without it; the tests that do need
+GDAL are skipped.
+"""
+
+import importlib.util
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Put an empty module (and its parent packages) in sys.modules under "name", unless the real one is installed
+def stand_in_module(name, **attributes):
+    try:
+        if importlib.util.find_spec(name) is not None:
+            return
+    except ModuleNotFoundError:
+        pass
+    parts = name.split('.')
+    for depth in range(1, len(parts) + 1):
+        sys.modules.setdefault('.'.join(parts[:depth]), types.ModuleType('.'.join(parts[:depth])))
+    for attribute, value in attributes.items():
+        setattr(sys.modules[name], attribute, value)
+
+class NotFound(Exception):
+    pass
+
+stand_in_module('ee')
+stand_in_module('google.api_core.exceptions', NotFound=NotFound)
+stand_in_module('osgeo.gdal')
+stand_in_module('osgeo.osr')
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of batch_files.py: the temporary names of outputs, and which files the batch tools take as inputs.
+"""
+
+import os
+
+from batch_files import find_scenes, partial_path_for
+
+def test_partial_path_keeps_the_extension():
+    assert partial_path_for('/data/scene_resampled_and_converted.tif') == '/data/scene_resampled_and_converted.partial.tif'
+    assert partial_path_for('scene.npy') == 'scene.partial.npy'
+
+def test_find_scenes(tmp_path):
+    for name in ['b.tif', 'a.TIFF', 'notes.txt', 'a_resampled_and_converted.tif', 'b_resampled_and_converted.partial.tif']:
+        (tmp_path / name).write_text('')
+    other = tmp_path / 'other'
+    other.mkdir()
+    (other / 'c.tif').write_text('')
+
+    # Directories are searched for GeoTIFFs, glob patterns are expanded, and outputs are left out
+    assert find_scenes([str(tmp_path)]) == [str(tmp_path / 'a.TIFF'), str(tmp_path / 'b.tif')]
+    assert find_scenes([str(tmp_path / '*.tif'), str(other / 'c.tif')]) == [str(tmp_path / 'b.tif'), str(other / 'c.tif')]
+
+def test_find_scenes_gives_absolute_paths(tmp_path, monkeypatch):
+    (tmp_path / 'scene.tif').write_text('')
+    monkeypatch.chdir(tmp_path)
+    assert find_scenes(['scene.tif']) == [os.path.join(str(tmp_path), 'scene.tif')]
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of ee_tasks.py with fake tasks: wait_for_task's deadline and cancellation, the poll
+schedule, and ExportScheduler's cap, priority order, merging and project-wide cap.
+"""
+
+import threading
+import time
+
+import pytest
+
+from ee_tasks import (BACKFILL, INTERACTIVE, ExportScheduler, TaskCancelled, TaskTimeout, active_task_count,
+                      poll_delays, wait_for_task)
+
+# Stands in for an ee.batch.Task.  It is RUNNING until "finish" is set (straight away if it is
+# already set), then has "final_state".
+class FakeTask:
+    def __init__(self, name='task', finish=None, final_state='COMPLETED', started=None):
+        self.name = name
+        self.finish = finish if finish is not None else threading.Event()
+        self.final_state = final_state
+        self.started = started if started is not None else []
+        self.cancelled = False
+        self.status_calls = 0
+
+    def start(self):
+        self.started.append(self.name)
+
+    def status(self):
+        self.status_calls += 1
+        if self.cancelled:
+            return {'state': 'CANCELLED'}
+        if self.finish.is_set():
+            return {'state': self.final_state, 'error_message': self.final_state.lower()}
+        return {'state': 'RUNNING'}
+
+    def cancel(self):
+        self.cancelled = True
+
+def finished():
+    event = threading.Event()
+    event.set()
+    return event
+
+# Wait (up to a few seconds) until "condition" is true
+def eventually(condition, seconds=5):
+    deadline = time.monotonic() + seconds
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+def in_thread(function, *args, **kwargs):
+    outcome = {}
+
+    def run():
+        try:
+            outcome['value'] = function(*args, **kwargs)
+        except Exception as error:
+            outcome['error'] = error
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread, outcome
+
+# ------------------ wait_for_task ------------------------------------------------------------
+
+def test_wait_for_task_returns_the_final_status():
+    task = FakeTask(finish=finished(), final_state='FAILED')
+    assert wait_for_task(task, timeout=5) == {'state': 'FAILED', 'error_message': 'failed'}
+    assert task.status_calls == 1
+
+def test_wait_for_task_gives_up_at_the_deadline_and_cancels_the_task():
+    task = FakeTask()
+    start = time.monotonic()
+    with pytest.raises(TaskTimeout):
+        wait_for_task(task, timeout=0.3)
+    assert 0.3 <= time.monotonic() - start < 1.5
+    assert task.cancelled
+
+def test_wait_for_task_can_be_cancelled_from_another_thread():
+    task = FakeTask()
+    cancel = threading.Event()
+    threading.Timer(0.1, cancel.set).start()
+    start = time.monotonic()
+    with pytest.raises(TaskCancelled):
+        wait_for_task(task, timeout=60, cancel=cancel)
+    assert time.monotonic() - start < 1
+    assert task.cancelled
+
+def test_wait_for_task_can_leave_the_task_running():
+    task = FakeTask()
+    with pytest.raises(TaskTimeout):
+        wait_for_task(task, timeout=0.1, cancel_task_on_exit=False)
+    assert not task.cancelled
+
+def test_polls_stay_fast_for_the_first_minute():
+    elapsed = [0.0]
+    delays = poll_delays(lambda: elapsed[0])
+    checks = []
+    while elapsed[0] < 120:
+        delay = next(delays)
+        assert delay <= (0.5 if elapsed[0] < 60 else 2.0)
+        elapsed[0] += delay
+        checks.append(elapsed[0])
+    assert checks[:3] == pytest.approx([0.25, 0.625, 1.125])
+    assert checks[-1] - checks[-2] == 2.0
+
+# ------------------ ExportScheduler ----------------------------------------------------------
+
+def test_the_scheduler_runs_at_most_max_running_exports():
+    scheduler = ExportScheduler(max_running=2)
+    finish = threading.Event()
+    started = []
+    threads = [in_thread(scheduler.run, name, lambda name=name: FakeTask(name, finish, started=started))[0]
+               for name in 'abcd']
+    eventually(lambda: len(started) == 2)
+    time.sleep(0.3)
+    assert len(started) == 2
+    assert scheduler.metrics()['running'] == 2
+    assert scheduler.metrics()['queued'] == 2
+    finish.set()
+    for thread in threads:
+        thread.join(5)
+    assert sorted(started) == ['a', 'b', 'c', 'd']
+    assert scheduler.metrics()['completed'] == 4
+
+def test_waiting_exports_start_in_priority_order():
+    scheduler = ExportScheduler(max_running=1)
+    first = threading.Event()
+    started = []
+    threads = [in_thread(scheduler.run, 'first', lambda: FakeTask('first', first, started=started))[0]]
+    eventually(lambda: started == ['first'])
+    for name, priority in (('backfill 1', BACKFILL), ('interactive 1', INTERACTIVE),
+                           ('backfill 2', BACKFILL), ('interactive 2', INTERACTIVE)):
+        threads.append(in_thread(scheduler.run, name, lambda name=name: FakeTask(name, finished(), started=started), priority)[0])
+        eventually(lambda: scheduler.metrics()['submitted'] == len(threads))
+    first.set()
+    for thread in threads:
+        thread.join(5)
+    assert started == ['first', 'interactive 1', 'interactive 2', 'backfill 1', 'backfill 2']
+
+def test_the_same_export_asked_for_twice_runs_once():
+    scheduler = ExportScheduler(max_running=1)
+    finish = threading.Event()
+    made = []
+
+    def make_task():
+        made.append(True)
+        return FakeTask('export', finish)
+
+    first, first_outcome = in_thread(scheduler.run, 'export', make_task, BACKFILL)
+    eventually(lambda: made)
+    second, second_outcome = in_thread(scheduler.run, 'export', make_task, INTERACTIVE)
+    eventually(lambda: scheduler.metrics()['merged'] == 1)
+    finish.set()
+    first.join(5)
+    second.join(5)
+    assert len(made) == 1
+    assert first_outcome['value'] == second_outcome['value'] == {'state': 'COMPLETED', 'error_message': 'completed'}
+
+def test_a_merged_request_moves_a_waiting_export_up():
+    scheduler = ExportScheduler(max_running=1)
+    first = threading.Event()
+    started = []
+    threads = [in_thread(scheduler.run, 'first', lambda: FakeTask('first', first, started=started))[0]]
+    eventually(lambda: started == ['first'])
+    for name, priority in (('other', BACKFILL), ('farm', BACKFILL), ('farm', INTERACTIVE)):
+        threads.append(in_thread(scheduler.run, name, lambda name=name: FakeTask(name, finished(), started=started), priority)[0])
+        eventually(lambda: scheduler.metrics()['submitted'] + scheduler.metrics()['merged'] == len(threads))
+    first.set()
+    for thread in threads:
+        thread.join(5)
+    assert started == ['first', 'farm', 'other']
+
+def test_an_export_cancelled_while_waiting_never_starts():
+    scheduler = ExportScheduler(max_running=1)
+    finish = threading.Event()
+    started = []
+    first = in_thread(scheduler.run, 'first', lambda: FakeTask('first', finish, started=started))[0]
+    eventually(lambda: started == ['first'])
+    cancel = threading.Event()
+    waiting, outcome = in_thread(scheduler.run, 'second', lambda: FakeTask('second', finished(), started=started), cancel=cancel)
+    cancel.set()
+    waiting.join(5)
+    assert isinstance(outcome['error'], TaskCancelled)
+    finish.set()
+    first.join(5)
+    assert started == ['first']
+    assert scheduler.metrics()['failed'] == 1
+
+def test_a_failed_export_is_reported_to_every_caller():
+    scheduler = ExportScheduler(max_running=1)
+
+    def make_task():
+        raise RuntimeError("no such image")
+
+    with pytest.raises(RuntimeError):
+        scheduler.run('export', make_task)
+    assert scheduler.metrics()['running'] == 0
+    assert scheduler.metrics()['failed'] == 1
+
+def test_exports_wait_while_the_project_is_full():
+    project_tasks = [3]
+    scheduler = ExportScheduler(max_running=5, count_project_exports=lambda: project_tasks[0],
+                                max_project_running=3, count_seconds=0.1)
+    started = []
+    thread = in_thread(scheduler.run, 'export', lambda: FakeTask('export', finished(), started=started))[0]
+    time.sleep(0.5)
+    assert started == []
+    assert scheduler.metrics()['project_running'] == 3
+    project_tasks[0] = 2
+    thread.join(5)
+    assert started == ['export']
+
+def test_exports_started_since_the_last_count_are_counted():
+    scheduler = ExportScheduler(max_running=5, count_project_exports=lambda: 1, max_project_running=2, count_seconds=60)
+    finish = threading.Event()
+    cancel = threading.Event()
+    started = []
+    threads = [in_thread(scheduler.run, name, lambda name=name: FakeTask(name, finish, started=started), cancel=cancel)[0]
+               for name in 'ab']
+    eventually(lambda: len(started) == 1)
+    time.sleep(0.3)
+    assert len(started) == 1
+    finish.set()
+    cancel.set()
+    for thread in threads:
+        thread.join(5)
+    assert len(started) == 1
+
+def test_a_failing_project_count_falls_back_to_the_instance_cap():
+    def count():
+        raise IOError("Earth Engine can't be reached")
+
+    scheduler = ExportScheduler(max_running=1, count_project_exports=count)
+    assert scheduler.run('export', lambda: FakeTask('export', finished()))['state'] == 'COMPLETED'
+
+def test_active_task_count():
+    statuses = [{'state': 'READY'}, {'state': 'RUNNING'}, {'state': 'COMPLETED'}, {'state': 'FAILED'}, {'state': 'RUNNING'}]
+    assert active_task_count(statuses) == 3
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of geotiff_resampler.py.
+
+The helpers that don't call GDAL (output_blocks, read_upsampled_block, existing_overview_levels,
+BlockStatistics, and the handling of the partial output) are tested everywhere; read_upsampled_block
+reads through rasterio, which is GDAL's RasterIO underneath.  The tests that resample real files
+(the two engines against each other, the bands, data types and nodata of the output, VRT and COG
+outputs, external overviews) need GDAL's Python bindings, and are skipped without them.
+"""
+
+import os
+
+import numpy
+import pytest
+import rasterio
+from osgeo import gdal
+from rasterio.enums import Resampling
+from rasterio.transform import Affine
+from rasterio.windows import Window
+
+import geotiff_resampler
+from batch_files import partial_path_for
+from geotiff_resampler import (BlockStatistics, add_overviews, existing_overview_levels, move_output, output_blocks,
+                               read_upsampled_block, resample_geotiff, resampled_path_for)
+
+needs_gdal = pytest.mark.skipif(not hasattr(gdal, 'Open'), reason="needs GDAL's Python bindings (osgeo)")
+
+# Write a small GeoTIFF with rasterio.  "data" is (bands, rows, columns).
+def write_geotiff(path, data, nodata=None):
+    with rasterio.open(str(path), 'w', driver='GTiff', width=data.shape[2], height=data.shape[1], count=data.shape[0],
+                       dtype=data.dtype, crs='EPSG:32617', transform=Affine(10, 0, 500000, 0, -10, 4000000),
+                       nodata=nodata) as dst:
+        dst.write(data)
+    return str(path)
+
+# Some random test data, with a few nodata pixels
+def sample_data(dtype='uint16', bands=2, rows=13, columns=17, nodata=0):
+    data = numpy.random.default_rng(1).integers(1, 2048, size=(bands, rows, columns)).astype(dtype)
+    data[:, 0, :3] = nodata
+    return data
+
+# The whole raster upsampled by nearest neighbour, the slow way
+def upsampled(data, scale):
+    return data.repeat(scale, axis=-2).repeat(scale, axis=-1)
+
+# What read_upsampled_block reads from: GDAL's ReadAsArray, done with rasterio
+class RasterioSource:
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def ReadAsArray(self, x, y, width, height, buf_xsize, buf_ysize):
+        return self.dataset.read(window=Window(x, y, width, height), out_shape=(self.dataset.count, buf_ysize, buf_xsize),
+                                 resampling=Resampling.nearest)
+
+@pytest.mark.parametrize('columns, rows, block_xsize, block_ysize, max_block_pixels', [
+    (1000, 700, 256, 256, 256 * 1000),     # whole rows of tiles
+    (1000, 700, 256, 256, 3 * 256 * 256),  # rows split into tiles
+    (1000, 700, 1000, 1, 4000),            # strips
+    (10, 10, 256, 256, 16),                # a budget smaller than one tile
+])
+def test_output_blocks_cover_the_raster_once_in_whole_tiles(columns, rows, block_xsize, block_ysize, max_block_pixels):
+    covered = numpy.zeros((rows, columns), dtype=int)
+    for x, y, width, height in output_blocks(columns, rows, block_xsize, block_ysize, max_block_pixels):
+        assert x % block_xsize == 0 and y % block_ysize == 0
+        assert width == columns - x or width % block_xsize == 0
+        assert height == rows - y or height % block_ysize == 0
+        assert width * height <= max(max_block_pixels, block_xsize * block_ysize)
+        covered[y:y + height, x:x + width] += 1
+    assert (covered == 1).all()
+
+@pytest.mark.parametrize('scale', [1, 2, 5])
+def test_read_upsampled_block(tmp_path, scale):
+    data = sample_data()
+    expected = upsampled(data, scale)
+    with rasterio.open(write_geotiff(tmp_path / 'in.tif', data)) as src:
+        source = RasterioSource(src)
+        # Blocks that don't start or end on a source pixel, and ones running off the edge
+        for x, y, width, height in [(0, 0, 17 * scale, 13 * scale), (3, 7, 11, 4), (scale * 17 - 2, 2, 2, 9),
+                                    (6, scale * 12, 20, scale)]:
+            block = read_upsampled_block(source, x, y, width, height, scale, 17, 13)
+            assert numpy.array_equal(block, expected[:, y:y + height, x:x + width])
+
+        # Every block of an output, put back together
+        out = numpy.zeros_like(expected)
+        for x, y, width, height in output_blocks(17 * scale, 13 * scale, 8, 8, 64):
+            out[:, y:y + height, x:x + width] = read_upsampled_block(source, x, y, width, height, scale, 17, 13)
+        assert numpy.array_equal(out, expected)
+
+class FakeOverview:
+    def __init__(self, width):
+        self.XSize = width
+
+class FakeBand:
+    def __init__(self, width, overview_widths=()):
+        self.XSize = width
+        self.overviews = [FakeOverview(overview_width) for overview_width in overview_widths]
+        self.statistics = None
+
+    def GetOverviewCount(self):
+        return len(self.overviews)
+
+    def GetOverview(self, index):
+        return self.overviews[index]
+
+    def SetStatistics(self, minimum, maximum, mean, standard_deviation):
+        self.statistics = (minimum, maximum, mean, standard_deviation)
+
+def test_existing_overview_levels():
+    # GDAL rounds overview sizes up: a level-4 overview of 1001 pixels is 251 wide
+    assert existing_overview_levels(FakeBand(1001), [2, 4, 8]) == []
+    assert existing_overview_levels(FakeBand(1001, [501, 251]), [2, 4, 8]) == [2, 4]
+    assert existing_overview_levels(FakeBand(1001, [126]), [2, 4, 8, 16]) == [8]
+
+def test_block_statistics_match_the_whole_raster():
+    data = sample_data('float32', bands=1)[0]
+    data[5, 5] = numpy.nan
+    statistics = BlockStatistics(nodata=0)
+    for rows in numpy.array_split(data, 4):
+        statistics.add(rows)
+
+    values = data[(data != 0) & ~numpy.isnan(data)].astype(numpy.float64)
+    band = FakeBand(17)
+    statistics.apply(band)
+    assert band.statistics == pytest.approx((values.min(), values.max(), values.mean(), values.std()))
+
+def test_block_statistics_of_an_empty_band_are_not_stored():
+    statistics = BlockStatistics(nodata=0)
+    statistics.add(numpy.zeros((4, 4), dtype=numpy.uint16))
+    band = FakeBand(4)
+    statistics.apply(band)
+    assert band.statistics is None
+
+def test_move_output_replaces_the_old_output_and_its_sidecars(tmp_path):
+    out_path = str(tmp_path / 'out.tif')
+    for name, text in [('out.tif', 'old'), ('out.tif.ovr', 'old'), ('out.tif.aux.xml', 'old'),
+                       ('out.partial.tif', 'new'), ('out.partial.tif.aux.xml', 'new')]:
+        (tmp_path / name).write_text(text)
+    move_output(partial_path_for(out_path), out_path)
+    assert sorted(os.listdir(str(tmp_path))) == ['out.tif', 'out.tif.aux.xml']
+    assert (tmp_path / 'out.tif').read_text() == 'new'
+    assert (tmp_path / 'out.tif.aux.xml').read_text() == 'new'
+
+def test_a_failed_resampling_leaves_no_partial_output(tmp_path, monkeypatch):
+    tiff_path = str(tmp_path / 'in.tif')
+    out_path = resampled_path_for(tiff_path)
+    (tmp_path / os.path.basename(out_path)).write_text('from an earlier run')
+
+    def failing_warp(tiff_path, write_path, *args, **kwargs):
+        for name in [write_path, write_path + '.ovr']:
+            with open(name, 'w') as partial_file:
+                partial_file.write('half written')
+        raise RuntimeError("the disk is full")
+    monkeypatch.setattr(geotiff_resampler, 'resample_geotiff_warp', failing_warp)
+
+    with pytest.raises(RuntimeError):
+        resample_geotiff(tiff_path)
+    assert sorted(os.listdir(str(tmp_path))) == [os.path.basename(out_path)]
+    assert (tmp_path / os.path.basename(out_path)).read_text() == 'from an earlier run'
+
+def test_the_warp_engine_defaults_to_approximate_statistics(tmp_path, monkeypatch):
+    calls = []
+    def recording_resampler(tiff_path, write_path, *args, **kwargs):
+        calls.append(kwargs['approximate_statistics'])
+        open(write_path, 'w').close()
+    monkeypatch.setattr(geotiff_resampler, 'resample_geotiff_warp', recording_resampler)
+    monkeypatch.setattr(geotiff_resampler, 'resample_geotiff_blocks', recording_resampler)
+
+    tiff_path = str(tmp_path / 'in.tif')
+    resample_geotiff(tiff_path, engine='warp')
+    resample_geotiff(tiff_path, engine='blocks')
+    resample_geotiff(tiff_path, engine='warp', approximate_statistics=False)
+    assert calls == [True, False, False]
+
+# Read every band of a raster file with GDAL
+def read_all(path):
+    ds = gdal.Open(path)
+    data = ds.ReadAsArray()
+    return data.reshape((ds.RasterCount, ds.RasterYSize, ds.RasterXSize))
+
+@needs_gdal
+@pytest.mark.parametrize('output_mode', ['gtiff', 'cog'])
+def test_the_engines_agree_for_a_whole_number_factor(tmp_path, output_mode):
+    data = sample_data()
+    tiff_path = write_geotiff(tmp_path / 'in.tif', data, nodata=0)
+    blocks = resample_geotiff(tiff_path, str(tmp_path / 'blocks.tif'), 5, engine='blocks', output_mode=output_mode)
+    warp = resample_geotiff(tiff_path, str(tmp_path / 'warp.tif'), 5, engine='warp', output_mode=output_mode)
+    assert numpy.array_equal(read_all(blocks), read_all(warp))
+    assert numpy.array_equal(read_all(blocks), upsampled(data, 5))
+
+@needs_gdal
+@pytest.mark.parametrize('engine', ['warp', 'blocks'])
+@pytest.mark.parametrize('dtype, nodata', [('uint8', 0), ('uint16', 0), ('int16', -9999), ('float32', -1.0)])
+def test_every_band_dtype_and_nodata_are_kept(tmp_path, engine, dtype, nodata):
+    data = sample_data(dtype, bands=3, nodata=nodata)
+    out_path = resample_geotiff(write_geotiff(tmp_path / 'in.tif', data, nodata=nodata), scale=2, engine=engine)
+    ds = gdal.Open(out_path)
+    assert (ds.RasterXSize, ds.RasterYSize, ds.RasterCount) == (34, 26, 3)
+    for index in range(1, 4):
+        band = ds.GetRasterBand(index)
+        assert band.GetNoDataValue() == nodata
+        assert band.GetMetadataItem('STATISTICS_MEAN') is not None
+    out = read_all(out_path)
+    assert out.dtype == numpy.dtype(dtype)
+    assert numpy.array_equal(out, upsampled(data, 2))
+
+@needs_gdal
+def test_a_vrt_still_opens_after_the_rename(tmp_path):
+    data = sample_data()
+    out_path = resample_geotiff(write_geotiff(tmp_path / 'in.tif', data), scale=3, output_mode='vrt')
+    assert out_path == str(tmp_path / 'in_resampled_and_converted.vrt')
+    assert sorted(os.listdir(str(tmp_path))) == ['in.tif', 'in_resampled_and_converted.vrt']
+    assert numpy.array_equal(read_all(out_path), upsampled(data, 3))
+
+@needs_gdal
+@pytest.mark.parametrize('engine', ['warp', 'blocks'])
+def test_a_cog_output_is_laid_out_as_a_cog(tmp_path, engine):
+    data = sample_data(rows=300, columns=260)
+    out_path = resample_geotiff(write_geotiff(tmp_path / 'in.tif', data), scale=2, engine=engine, output_mode='cog')
+    ds = gdal.Open(out_path)
+    # The COG driver marks the files it lays out; a plain GeoTIFF has no LAYOUT item
+    assert ds.GetMetadataItem('LAYOUT', 'IMAGE_STRUCTURE') == 'COG'
+    band = ds.GetRasterBand(1)
+    assert band.GetBlockSize() == [256, 256]
+    assert band.GetOverviewCount() > 0
+    assert not [name for name in os.listdir(str(tmp_path)) if '.partial' in name or '.tmp' in name]
+
+@needs_gdal
+def test_external_overviews_only_add_the_missing_levels(tmp_path):
+    tiff_path = write_geotiff(tmp_path / 'in.tif', sample_data(rows=100, columns=120))
+    out_path = resample_geotiff(tiff_path, scale=2, overview_levels=[2, 4], external_overviews=True)
+    assert os.path.exists(out_path + '.ovr')
+    assert not os.path.exists(partial_path_for(out_path) + '.ovr')
+
+    assert add_overviews(out_path, [2, 4, 8], external=True) == [8]
+    assert add_overviews(out_path, [2, 4, 8], external=True) == []
+    ds = gdal.Open(out_path)
+    assert existing_overview_levels(ds.GetRasterBand(1), [2, 4, 8]) == [2, 4, 8]
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of imd_metadata.py: reading a small *.IMD file and its *.XML twin, the earth-sun
+distance, finding the metadata file of a tile, and when MetadataCache parses a file again.
+"""
+
+import datetime
+import math
+import os
+
+import pytest
+
+import imd_metadata
+from imd_metadata import (MetadataCache, earth_sun_distance, find_metadata_file, parameters_from_metadata,
+                          parse_imd, parse_imd_time)
+from toa_reflectance import ALL_BANDS
+
+# A cut-down multispectral *.IMD file: two bands and the image group
+imd_text = '''version = "28.3";
+generationTime = 2016-05-02T10:11:12.000000Z;
+productCatalogId = "A01001B2C3D4E500";
+numRows = 4;
+BEGIN_GROUP = BAND_B
+	ULLon = -8.40;
+	absCalFactor = 1.783568e-02;
+	effectiveBandwidth = 5.430000e-02;
+END_GROUP = BAND_B
+BEGIN_GROUP = BAND_R
+	ULLon = -8.40;
+	absCalFactor = 1.103623e-02;
+	effectiveBandwidth = 5.740000e-02;
+END_GROUP = BAND_R
+BEGIN_GROUP = IMAGE_1
+	satId = "WV03";
+	CatId = "104001001A2B3C00";
+	firstLineTime = 2016-04-16T11:47:07.562500Z;
+	meanSunEl = 58.2;
+	meanSunAz = 154.3;
+END_GROUP = IMAGE_1
+END;
+'''
+
+# The same figures in the XML form of the metadata
+xml_text = '''<?xml version="1.0" encoding="UTF-8"?>
+<isd>
+ <IMD>
+  <VERSION>28.3</VERSION>
+  <PRODUCTCATALOGID>A01001B2C3D4E500</PRODUCTCATALOGID>
+  <BAND_B>
+   <ABSCALFACTOR>1.783568e-02</ABSCALFACTOR>
+   <EFFECTIVEBANDWIDTH>5.430000e-02</EFFECTIVEBANDWIDTH>
+  </BAND_B>
+  <BAND_R>
+   <ABSCALFACTOR>1.103623e-02</ABSCALFACTOR>
+   <EFFECTIVEBANDWIDTH>5.740000e-02</EFFECTIVEBANDWIDTH>
+  </BAND_R>
+  <IMAGE>
+   <SATID>WV03</SATID>
+   <CATID>104001001A2B3C00</CATID>
+   <FIRSTLINETIME>2016-04-16T11:47:07.562500Z</FIRSTLINETIME>
+   <MEANSUNEL>58.2</MEANSUNEL>
+  </IMAGE>
+ </IMD>
+</isd>
+'''
+
+def write_file(path, text):
+    with open(path, 'w') as written_file:
+        written_file.write(text)
+    return str(path)
+
+@pytest.mark.parametrize('name, text', [('scene.IMD', imd_text), ('scene.XML', xml_text)])
+def test_parse_imd(tmp_path, name, text):
+    metadata = parse_imd(write_file(tmp_path / name, text))
+    assert metadata['scene_id'] == '104001001A2B3C00'
+    assert metadata['abscal_factors'] == {'Blue': 1.783568e-02, 'Red': 1.103623e-02}
+    assert metadata['effective_bandwidths'] == {'Blue': 5.43e-02, 'Red': 5.74e-02}
+    assert metadata['sun_elevation'] == 58.2
+    assert metadata['acquisition_time'] == '2016-04-16T11:47:07.562500+00:00'
+    assert metadata['solar_zenith_angle'] == pytest.approx(math.radians(90 - 58.2))
+    assert metadata['earth_sun_distance'] == pytest.approx(earth_sun_distance(parse_imd_time('2016-04-16T11:47:07.5625Z')))
+
+def test_the_file_name_is_the_scene_id_without_a_catalog_id(tmp_path):
+    text = imd_text.replace('\tCatId = "104001001A2B3C00";\n', '').replace('productCatalogId = "A01001B2C3D4E500";\n', '')
+    assert parse_imd(write_file(tmp_path / '16APR16114707-M2AS.IMD', text))['scene_id'] == '16APR16114707-M2AS'
+
+def test_a_file_without_band_figures_is_refused(tmp_path):
+    with pytest.raises(ValueError):
+        parse_imd(write_file(tmp_path / 'scene.IMD', 'version = "28.3";\nEND;\n'))
+
+@pytest.mark.parametrize('when, distance', [
+    # J2000.0, a couple of days before perihelion
+    (datetime.datetime(2000, 1, 1, 12), 0.98331),
+    # Around perihelion and aphelion
+    (datetime.datetime(2016, 1, 3), 0.98330),
+    (datetime.datetime(2016, 7, 4), 1.01670),
+])
+def test_earth_sun_distance(when, distance):
+    assert earth_sun_distance(when) == pytest.approx(distance, abs=2e-4)
+
+def test_the_time_of_day_counts():
+    # The distance changes by about 1.7e-4 AU a day in April
+    morning = earth_sun_distance(datetime.datetime(2016, 4, 16, 0))
+    evening = earth_sun_distance(datetime.datetime(2016, 4, 16, 23, 59))
+    assert 1e-4 < evening - morning < 3e-4
+
+def test_find_metadata_file(tmp_path):
+    metadata_path = write_file(tmp_path / '16APR16114707-M2AS-058.IMD', imd_text)
+    # The same name, or the name of the tile with its _R1C1 suffix taken off
+    assert find_metadata_file(str(tmp_path / '16APR16114707-M2AS-058.TIF')) == metadata_path
+    assert find_metadata_file(str(tmp_path / '16APR16114707-M2AS-058_R1C1.TIF')) == metadata_path
+    assert find_metadata_file(str(tmp_path / '16APR16114707-M2AS-058_R12C3.TIF')) == metadata_path
+
+def test_find_metadata_file_falls_back_to_the_only_imd_file(tmp_path):
+    metadata_path = write_file(tmp_path / 'product.IMD', imd_text)
+    assert find_metadata_file(str(tmp_path / 'tile.TIF')) == metadata_path
+    write_file(tmp_path / 'other.IMD', imd_text)
+    assert find_metadata_file(str(tmp_path / 'tile.TIF')) is None
+
+def test_parameters_from_metadata(tmp_path):
+    metadata = parse_imd(write_file(tmp_path / 'scene.IMD', imd_text))
+    assert parameters_from_metadata(metadata, 'Red')['abscal_factor'] == 1.103623e-02
+    assert parameters_from_metadata(metadata, ALL_BANDS)['effective_bandwidth'] == metadata['effective_bandwidths']
+    with pytest.raises(ValueError):
+        parameters_from_metadata(metadata, 'Pan')
+
+# A MetadataCache on an index in tmp_path that counts the files it parses
+@pytest.fixture
+def counted_cache(tmp_path, monkeypatch):
+    parsed = []
+    def counting_parse_imd(path):
+        parsed.append(path)
+        return parse_imd(path)
+    monkeypatch.setattr(imd_metadata, 'parse_imd', counting_parse_imd)
+    return MetadataCache(str(tmp_path / 'index.json')), parsed
+
+def test_metadata_cache_hits_an_unchanged_file(tmp_path, counted_cache):
+    cache, parsed = counted_cache
+    metadata_path = write_file(tmp_path / 'scene.IMD', imd_text)
+    first = cache.get(metadata_path)
+    assert cache.get(metadata_path) == first
+    assert len(parsed) == 1
+
+    # A new cache on the same index doesn't parse the file either
+    assert MetadataCache(cache.index_path).get(metadata_path) == first
+    assert len(parsed) == 1
+
+def test_metadata_cache_misses_a_changed_file(tmp_path, counted_cache):
+    cache, parsed = counted_cache
+    metadata_path = write_file(tmp_path / 'scene.IMD', imd_text)
+    cache.get(metadata_path)
+    status = os.stat(metadata_path)
+
+    # Touched: the same size, a new modification time
+    os.utime(metadata_path, (status.st_atime, status.st_mtime + 10))
+    cache.get(metadata_path)
+    assert len(parsed) == 2
+
+    # Rewritten with the same modification time, but a different size
+    write_file(metadata_path, imd_text.replace('meanSunEl = 58.2;', 'meanSunEl = 60.25;'))
+    os.utime(metadata_path, (status.st_atime, status.st_mtime + 10))
+    assert cache.get(metadata_path)['sun_elevation'] == 60.25
+    assert len(parsed) == 3
+
+def test_a_damaged_index_is_started_again(tmp_path):
+    index_path = write_file(tmp_path / 'index.json', '{"scenes": ')
+    cache = MetadataCache(index_path)
+    assert cache.index == {'scenes': {}, 'files': {}}
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of jobs.py: the states a job goes through in JobRunner (with a MemoryJobStore), what
+happens when the job store fails, and which callback URLs are allowed.
+"""
+
+import threading
+import time
+
+import pytest
+
+import jobs
+from jobs import (FAILED, PENDING, RUNNING, SUCCEEDED, CallbackNotAllowed, JobRunner, MemoryJobStore, UnknownJob,
+                  check_callback_url, fail_lost_job)
+
+# A MemoryJobStore that keeps every state a job was put in, and can be told to fail writing one
+class RecordingStore(MemoryJobStore):
+    def __init__(self, failing_state=None):
+        super().__init__()
+        self.failing_state = failing_state
+        self.states = []
+
+    def update(self, job_id, **changes):
+        if changes.get('state') == self.failing_state:
+            raise IOError("the bucket can't be reached")
+        record = super().update(job_id, **changes)
+        self.states.append(record['state'])
+        return record
+
+def new_job(store, job_id='job', state=PENDING, updated=None):
+    store.create({'jobId': job_id, 'state': state, 'updated': time.time() if updated is None else updated,
+                  'result': None, 'error': None})
+    return job_id
+
+def test_a_job_that_succeeds():
+    store = RecordingStore()
+    record = JobRunner(store).run(new_job(store), lambda: {'success': 'true'})
+    assert store.states == [RUNNING, SUCCEEDED]
+    assert record['result'] == {'success': 'true'}
+    assert store.get('job') == record
+
+def test_a_job_that_fails():
+    store = RecordingStore()
+
+    def work():
+        raise ValueError("no scene")
+
+    record = JobRunner(store).run(new_job(store), work)
+    assert store.states == [RUNNING, FAILED]
+    assert record['error'] == "no scene"
+    assert record['result'] is None
+
+def test_a_job_is_failed_when_its_running_state_cannot_be_written():
+    store = RecordingStore(failing_state=RUNNING)
+    ran = []
+    record = JobRunner(store).run(new_job(store), lambda: ran.append(True))
+    assert not ran
+    assert store.get('job')['state'] == FAILED
+    assert record['error'] == "the bucket can't be reached"
+
+def test_a_job_is_failed_when_its_result_cannot_be_written():
+    store = RecordingStore(failing_state=SUCCEEDED)
+    record = JobRunner(store).run(new_job(store), lambda: 'a result')
+    assert store.states == [RUNNING, FAILED]
+    assert record['state'] == FAILED
+
+def test_a_job_the_store_cannot_record_at_all_still_finishes():
+    class BrokenStore(MemoryJobStore):
+        def update(self, job_id, **changes):
+            raise IOError("the bucket can't be reached")
+
+    record = JobRunner(BrokenStore()).run('job', lambda: 'a result')
+    assert record['jobId'] == 'job'
+    assert record['state'] == FAILED
+
+def test_submit_runs_the_job_in_the_background():
+    store = MemoryJobStore()
+    started = threading.Event()
+    release = threading.Event()
+
+    def work():
+        started.set()
+        release.wait(5)
+        return 42
+
+    runner = JobRunner(store, workers=1)
+    job_id = runner.submit(work, details={'coords': [[0, 0], [1, 0], [1, 1]]})
+    assert started.wait(5)
+    assert store.get(job_id)['state'] == RUNNING
+    assert store.get(job_id)['details'] == {'coords': [[0, 0], [1, 0], [1, 1]]}
+    release.set()
+    runner.pool.shutdown(wait=True)
+    assert store.get(job_id)['state'] == SUCCEEDED
+    assert store.get(job_id)['result'] == 42
+
+def test_memory_store_copies_records():
+    store = MemoryJobStore()
+    new_job(store)
+    store.get('job')['state'] = 'CHANGED'
+    assert store.get('job')['state'] == PENDING
+    with pytest.raises(UnknownJob):
+        store.update('no such job', state=RUNNING)
+
+@pytest.mark.parametrize('url', ["http://hooks.example.com/done",
+                                 "https://169.254.169.254/computeMetadata/v1/",
+                                 "https://localhost/done",
+                                 "https://hooks.example.com.evil.test/done",
+                                 "ftp://hooks.example.com/done",
+                                 "not a url"])
+def test_callbacks_that_are_not_allowed(url):
+    with pytest.raises(CallbackNotAllowed):
+        check_callback_url(url, ['hooks.example.com'])
+
+def test_callbacks_that_are_allowed():
+    check_callback_url("https://hooks.example.com/done", ['hooks.example.com'])
+    check_callback_url("https://HOOKS.example.com:8443/done?job=1", ['hooks.example.com'])
+
+def test_no_callbacks_are_allowed_by_default(monkeypatch):
+    monkeypatch.setattr(jobs, 'CALLBACK_ALLOWED_HOSTS', [])
+    with pytest.raises(CallbackNotAllowed):
+        JobRunner(MemoryJobStore()).submit(lambda: None, callback_url="https://hooks.example.com/done")
+
+def test_the_finished_record_is_posted_to_the_callback(monkeypatch):
+    posted = []
+    monkeypatch.setattr(jobs, 'post_callback', lambda url, record: posted.append((url, record['state'])))
+    store = MemoryJobStore()
+    JobRunner(store).run(new_job(store), lambda: 1, callback_url="https://hooks.example.com/done")
+    assert posted == [("https://hooks.example.com/done", SUCCEEDED)]
+
+@pytest.mark.parametrize('state', [PENDING, RUNNING])
+def test_a_job_left_unfinished_by_its_instance_is_reported_as_failed(state):
+    store = MemoryJobStore()
+    new_job(store, state=state, updated=time.time() - 3600)
+    record = fail_lost_job(store, store.get('job'), lost_seconds=1800)
+    assert record['state'] == FAILED
+    assert "lost" in record['error']
+    assert store.get('job')['state'] == FAILED
+
+def test_jobs_still_going_or_finished_are_not_lost():
+    store = MemoryJobStore()
+    new_job(store, 'recent', state=RUNNING)
+    new_job(store, 'finished', state=SUCCEEDED, updated=time.time() - 3600)
+    assert fail_lost_job(store, store.get('recent'), lost_seconds=1800)['state'] == RUNNING
+    assert fail_lost_job(store, store.get('finished'), lost_seconds=1800)['state'] == SUCCEEDED
+    assert fail_lost_job(store, None) is None
+
+def test_a_lost_job_is_reported_even_if_the_store_cannot_be_written():
+    class ReadOnlyStore(MemoryJobStore):
+        def update(self, job_id, **changes):
+            raise IOError("the bucket can't be reached")
+
+    store = ReadOnlyStore()
+    new_job(store, state=RUNNING, updated=time.time() - 3600)
+    assert fail_lost_job(store, store.get('job'), lost_seconds=1800)['state'] == FAILED
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of result_cache.py: polygon normalization, the in-memory LRU tier, the manifests in the
+bucket (with a fake bucket), and the scenes remembered for fields.
+"""
+
+import json
+import time
+
+import pytest
+
+from result_cache import NotFound, ResultCache, normalize_coords, result_key, scene_key
+
+SQUARE = [[0, 0], [1, 0], [1, 1], [0, 1]]
+
+# Stands in for a google.cloud.storage bucket, holding objects in a dictionary
+class FakeBucket:
+    def __init__(self):
+        self.objects = {}
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+
+    def download_as_string(self):
+        if self.name not in self.bucket.objects:
+            raise NotFound(self.name)
+        return self.bucket.objects[self.name]
+
+    def upload_from_string(self, data, content_type=None):
+        self.bucket.objects[self.name] = data
+
+@pytest.mark.parametrize('coords', [SQUARE,
+                                    SQUARE + [[0, 0]],
+                                    [SQUARE],
+                                    list(reversed(SQUARE)),
+                                    SQUARE[2:] + SQUARE[:2],
+                                    [[0.0000001, 0], [1, 0], [1, 1], [0, 1.0000004]]])
+def test_the_same_field_normalizes_the_same_way(coords):
+    assert normalize_coords(coords) == [[0, 0], [1, 0], [1, 1], [0, 1]]
+    assert scene_key(coords) == scene_key(SQUARE)
+
+def test_result_keys_differ_by_scene_and_scale():
+    visualization = {'min': 0, 'max': 1}
+    key = result_key(SQUARE, 'NDVI', visualization, 'scene', 10)
+    assert key == result_key(list(reversed(SQUARE)), 'NDVI', visualization, 'scene', 10.0001)
+    assert key != result_key(SQUARE, 'NDVI', visualization, 'other scene', 10)
+    assert key != result_key(SQUARE, 'NDVI', visualization, 'scene', 20)
+    assert key != result_key(SQUARE, 'NDWI', visualization, 'scene', 10)
+
+def test_the_memory_tier_drops_the_least_recently_used():
+    cache = ResultCache(size=2)
+    cache.put('a', {'url': 'a'})
+    cache.put('b', {'url': 'b'})
+    assert cache.get('a') == {'url': 'a'}
+    cache.put('c', {'url': 'c'})
+    assert cache.get('b') is None
+    assert cache.get('a') == {'url': 'a'}
+
+def test_results_are_shared_through_the_bucket():
+    bucket = FakeBucket()
+    ResultCache(bucket).put('key', {'url': 'https://example/png', 'dateTaken': '2021-10-19'})
+    assert json.loads(bucket.objects['cache/key.json'])['url'] == 'https://example/png'
+
+    other_instance = ResultCache(bucket)
+    assert other_instance.get('key') == {'url': 'https://example/png', 'dateTaken': '2021-10-19'}
+    assert other_instance.get('missing') is None
+
+def test_scenes_are_remembered_for_a_while():
+    cache = ResultCache(scene_seconds=0.2)
+    cache.remember_scene(SQUARE, {'id': 'scene', 'date': '2021-10-19'})
+    assert cache.get_scene(list(reversed(SQUARE))) == {'id': 'scene', 'date': '2021-10-19'}
+    assert cache.get_scene([[5, 5], [6, 5], [6, 6]]) is None
+    time.sleep(0.25)
+    assert cache.get_scene(SQUARE) is None
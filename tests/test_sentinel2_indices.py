@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the fast path in sentinel2_indices.py (use_fast_path and fetch_index_pngs), with a
+stand-in for the parts of the ee module it uses, so no Earth Engine account is needed.
+"""
+
+import math
+import types
+
+import pytest
+
+import sentinel2_indices
+from sentinel2_indices import bounding_box_size, fetch_index_pngs, polygon_area, use_fast_path
+
+# A square of about 110 m by 80 m near Braga, as a ring and as a list of rings
+SMALL_FIELD = [[-8.420, 41.550], [-8.419, 41.550], [-8.419, 41.551], [-8.420, 41.551], [-8.420, 41.550]]
+# A square of about 8 km by 11 km
+LARGE_FIELD = [[[-8.5, 41.5], [-8.4, 41.5], [-8.4, 41.6], [-8.5, 41.6]]]
+
+# Stands in for an ee.Image: it only keeps its band names, and records its thumbnail requests
+class FakeImage:
+    thumbnail_requests = []
+
+    def __init__(self, bands):
+        self.bands = list(bands)
+
+    def select(self, name):
+        assert name in self.bands
+        return FakeImage([name])
+
+    def visualize(self, **parameters):
+        assert set(parameters) == {'min', 'max', 'palette'}
+        return self
+
+    def rename(self, names):
+        return FakeImage(names)
+
+    def getThumbURL(self, parameters):
+        FakeImage.thumbnail_requests.append((self.bands, parameters))
+        return "https://thumbnails.example/" + ",".join(self.bands)
+
+@pytest.fixture
+def fake_ee(monkeypatch):
+    FakeImage.thumbnail_requests = []
+    cat = lambda images: FakeImage([band for image in images for band in image.bands])
+    monkeypatch.setattr(sentinel2_indices, 'ee', types.SimpleNamespace(Image=types.SimpleNamespace(cat=cat)))
+    return FakeImage
+
+def test_polygon_area_of_a_field():
+    width, height = bounding_box_size(SMALL_FIELD)
+    assert polygon_area(SMALL_FIELD) == pytest.approx(width * height)
+    assert polygon_area(SMALL_FIELD[:-1]) == pytest.approx(polygon_area(SMALL_FIELD))
+
+def test_use_fast_path():
+    assert use_fast_path(SMALL_FIELD)
+    assert not use_fast_path(LARGE_FIELD)
+    assert not use_fast_path(SMALL_FIELD, max_area=polygon_area(SMALL_FIELD) / 2)
+
+def test_fetch_index_pngs(fake_ee):
+    image = FakeImage(['B4', 'B8', 'NDVI', 'NDWI'])
+    geometry = object()
+    fetched = []
+
+    def fetch(url):
+        fetched.append(url)
+        return url.rsplit("/", 1)[1].encode('utf-8')
+
+    pngs = fetch_index_pngs(image, geometry, SMALL_FIELD, ['NDVI', 'NDWI'], 10, fetch=fetch)
+
+    assert pngs == {'NDVI': b'NDVI_red,NDVI_green,NDVI_blue', 'NDWI': b'NDWI_red,NDWI_green,NDWI_blue'}
+    assert sorted(fetched) == ["https://thumbnails.example/NDVI_red,NDVI_green,NDVI_blue",
+                               "https://thumbnails.example/NDWI_red,NDWI_green,NDWI_blue"]
+
+    width, height = bounding_box_size(SMALL_FIELD)
+    dimensions = "%dx%d" % (math.ceil(width / 10), math.ceil(height / 10))
+    assert len(fake_ee.thumbnail_requests) == 2
+    for bands, parameters in fake_ee.thumbnail_requests:
+        assert parameters == {'region': geometry, 'dimensions': dimensions, 'crs': 'EPSG:4326', 'format': 'png'}
+
+def test_fetch_index_pngs_of_a_tiny_field_is_at_least_one_pixel(fake_ee):
+    tiny = [[-8.42, 41.55], [-8.41999, 41.55], [-8.41999, 41.55001]]
+    fetch_index_pngs(FakeImage(['NDVI']), None, tiny, ['NDVI'], 60, fetch=lambda url: b'')
+    assert fake_ee.thumbnail_requests[0][1]['dimensions'] == "1x1"
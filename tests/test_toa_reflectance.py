@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of toa_reflectance.py: the vectorized calculation against the original per-pixel formula
+from 2_Question_seven.py, with the per-band scale and offset and through the lookup tables used
+for integer images, and the multi-band calculation against converting each band on its own.
+Whole scenes are put through process_scene in every output format and read back, and a scene
+that is cancelled or fails part way must leave no partial output behind.
+"""
+
+import math
+import os
+import threading
+
+import numpy
+import pytest
+import rasterio
+from rasterio.transform import Affine
+
+from toa_reflectance import (ALL_BANDS, ProcessingCancelled, calculate_multiband_toa_reflectance, calculate_toa_reflectance,
+                             getValueFromBand, header_path_for, lookup_table_size, multispectral_band_order, output_formats,
+                             output_path_for, process_scene, reflectance_lookup_table)
+
+# The figures of a scene
+scene = dict(abscal_factor=0.0104, earth_sun_distance=1.0148, solar_zenith_angle=0.6)
+
+# The calculation as the original GUI script did it, one pixel at a time (in double precision)
+def per_pixel_toa_reflectance(image, band, abscal_factor, earth_sun_distance, solar_zenith_angle, effective_bandwidth=None):
+    thisBandsGain = getValueFromBand(band, 'gain')
+    thisBandsOffset = getValueFromBand(band, 'offset')
+    thisBandsEffectiveBandwidth = effective_bandwidth or getValueFromBand(band, 'effective bandwidth')
+    thisBandsSolarSpectralIrradiance = getValueFromBand(band, 'band averaged solar_spectral irradiance (Thuillier 2003)')
+
+    toa_reflectance_values = numpy.zeros(image.shape)
+    for index, dn_of_this_pixel in numpy.ndenumerate(image):
+        toa_radiance_of_this_pixel = thisBandsGain * (float(dn_of_this_pixel) * (abscal_factor/thisBandsEffectiveBandwidth)) + thisBandsOffset
+        toa_reflectance_values[index] = (toa_radiance_of_this_pixel * pow(earth_sun_distance, 2) * math.pi) / (thisBandsSolarSpectralIrradiance * math.cos(solar_zenith_angle))
+    return toa_reflectance_values
+
+# Random DNs of an 11-bit image, in a given dtype
+def random_dns(shape, dtype, maximum=2048):
+    return numpy.random.default_rng(2).integers(0, maximum, size=shape).astype(dtype)
+
+# float32 is good to about 7 significant figures; reflectances are around 0 to 1
+def assert_close(result, expected):
+    assert result.dtype == numpy.float32
+    assert result.shape == expected.shape
+    numpy.testing.assert_allclose(result, expected, rtol=1e-5, atol=1e-6)
+
+@pytest.mark.parametrize('dtype', ['float32', 'float64', 'int16', 'int32', 'uint32'])
+@pytest.mark.parametrize('band', ['Pan', 'Red', 'NIR2'])
+def test_scale_and_offset_path_matches_the_per_pixel_formula(dtype, band):
+    image = random_dns((20, 30, 3), dtype)
+    assert_close(calculate_toa_reflectance(image, band, **scene), per_pixel_toa_reflectance(image, band, **scene))
+
+def test_an_effective_bandwidth_from_the_metadata_is_used():
+    image = random_dns((10, 10), 'float32')
+    result = calculate_toa_reflectance(image, 'Red', effective_bandwidth=0.0574, **scene)
+    assert_close(result, per_pixel_toa_reflectance(image, 'Red', effective_bandwidth=0.0574, **scene))
+    assert not numpy.allclose(result, calculate_toa_reflectance(image, 'Red', **scene))
+
+def test_the_result_can_go_into_a_given_array():
+    image = random_dns((10, 10), 'float64')
+    out = numpy.empty((10, 10), dtype=numpy.float32)
+    assert calculate_toa_reflectance(image, 'Blue', out=out, **scene) is out
+    assert_close(out, per_pixel_toa_reflectance(image, 'Blue', **scene))
+
+def test_an_unknown_band_is_refused():
+    with pytest.raises(ValueError):
+        calculate_toa_reflectance(numpy.zeros((2, 2)), 'Purple', **scene)
+
+@pytest.mark.parametrize('dtype, maximum', [('uint8', 256), ('uint16', 2048), ('uint16', 65536)])
+@pytest.mark.parametrize('band', ['Pan', 'Red', 'NIR2'])
+def test_lookup_table_path_matches_the_per_pixel_formula(dtype, maximum, band):
+    image = random_dns((20, 30, 3), dtype, maximum)
+    result = calculate_toa_reflectance(image, band, **scene)
+    assert_close(result, per_pixel_toa_reflectance(image, band, **scene))
+    # The table holds exactly what the scale and offset give
+    assert numpy.array_equal(result, calculate_toa_reflectance(image.astype(numpy.int32), band, **scene))
+
+def test_which_images_get_a_lookup_table():
+    assert lookup_table_size(numpy.uint8) == 256
+    assert lookup_table_size(numpy.uint16) == 65536
+    for dtype in [numpy.int16, numpy.uint32, numpy.float32]:
+        assert lookup_table_size(dtype) is None
+
+def test_lookup_tables_are_cached_and_read_only():
+    table = reflectance_lookup_table('Red', 0.0104, 1.0148, 0.6, None, 65536)
+    assert reflectance_lookup_table('Red', 0.0104, 1.0148, 0.6, None, 65536) is table
+    assert reflectance_lookup_table('Red', 0.0105, 1.0148, 0.6, None, 65536) is not table
+    assert not table.flags.writeable
+    with pytest.raises(ValueError):
+        table[0] = 0
+
+def test_the_lookup_table_result_can_go_into_a_given_array():
+    image = random_dns((10, 10), 'uint16')
+    out = numpy.empty((10, 10), dtype=numpy.float32)
+    assert calculate_toa_reflectance(image, 'Blue', out=out, **scene) is out
+    assert_close(out, per_pixel_toa_reflectance(image, 'Blue', **scene))
+
+@pytest.mark.parametrize('dtype', ['uint16', 'float32'])
+def test_multiband_matches_each_band_on_its_own(dtype):
+    image = random_dns((8, 12, 15), dtype)
+    abscal_factors = {band: 0.01 + 0.001 * i for i, band in enumerate(multispectral_band_order)}
+    effective_bandwidths = [0.04 + 0.005 * i for i in range(8)]
+    result = calculate_multiband_toa_reflectance(image, multispectral_band_order, abscal_factors, scene['earth_sun_distance'],
+                                                 scene['solar_zenith_angle'], effective_bandwidths)
+    for i, band in enumerate(multispectral_band_order):
+        single = calculate_toa_reflectance(image[i], band, abscal_factors[band], scene['earth_sun_distance'],
+                                           scene['solar_zenith_angle'], effective_bandwidths[i])
+        assert_close(result[i], single.astype(numpy.float64))
+        assert_close(result[i], per_pixel_toa_reflectance(image[i], band, abscal_factors[band], scene['earth_sun_distance'],
+                                                          scene['solar_zenith_angle'], effective_bandwidths[i]))
+
+def test_multiband_with_one_abscal_factor_for_every_band():
+    image = random_dns((8, 4, 5), 'float32')
+    result = calculate_multiband_toa_reflectance(image, multispectral_band_order, 0.0104, scene['earth_sun_distance'], scene['solar_zenith_angle'])
+    for i, band in enumerate(multispectral_band_order):
+        assert_close(result[i], per_pixel_toa_reflectance(image[i], band, **scene))
+
+# Write a small GeoTIFF with rasterio.  "data" is (bands, rows, columns).
+def write_geotiff(path, data):
+    with rasterio.open(str(path), 'w', driver='GTiff', width=data.shape[2], height=data.shape[1], count=data.shape[0],
+                       dtype=data.dtype, crs='EPSG:32617', transform=Affine(1.24, 0, 500000, 0, -1.24, 4000000)) as dst:
+        dst.write(data)
+    return str(path)
+
+# Read an output of process_scene back, as (rows, columns) or (bands, rows, columns)
+def read_output(path, output_format, shape):
+    if output_format == 'txt':
+        return numpy.loadtxt(path, dtype=numpy.float32, ndmin=2)
+    if output_format == 'gtiff':
+        with rasterio.open(path) as src:
+            assert src.crs.to_epsg() == 32617
+            assert src.transform == Affine(1.24, 0, 500000, 0, -1.24, 4000000)
+            data = src.read()
+        return data[0] if len(shape) == 2 else data
+    if output_format == 'npy':
+        return numpy.load(path, mmap_mode='r')
+    with open(header_path_for(path)) as header:
+        assert ("lines = %d" % shape[-2]) in header.read()
+    return numpy.memmap(path, dtype=numpy.float32, mode='r', shape=shape)
+
+@pytest.mark.parametrize('output_format', output_formats)
+def test_a_single_band_scene_in_every_output_format(tmp_path, output_format):
+    data = random_dns((1, 13, 7), 'uint16')
+    in_path = write_geotiff(tmp_path / 'scene.tif', data)
+    out_path = process_scene(in_path, 'Red', output_format=output_format, block_rows=4, **scene)
+    assert out_path == output_path_for(in_path, output_format)
+
+    expected = calculate_toa_reflectance(data[0], 'Red', **scene)
+    assert numpy.array_equal(read_output(out_path, output_format, expected.shape), expected)
+    assert not [name for name in os.listdir(str(tmp_path)) if '.partial' in name]
+
+@pytest.mark.parametrize('output_format', output_formats)
+def test_all_bands_in_every_output_format(tmp_path, output_format):
+    data = random_dns((8, 9, 6), 'uint16')
+    in_path = write_geotiff(tmp_path / 'scene.tif', data)
+    abscal_factors = {band: 0.01 + 0.001 * i for i, band in enumerate(multispectral_band_order)}
+    out_path = process_scene(in_path, ALL_BANDS, abscal_factors, scene['earth_sun_distance'], scene['solar_zenith_angle'],
+                             output_format=output_format, block_rows=4)
+
+    # A text file only holds one layer, so the bands go to a GeoTIFF
+    written_format = 'gtiff' if output_format == 'txt' else output_format
+    assert out_path == output_path_for(in_path, written_format)
+    expected = calculate_multiband_toa_reflectance(data, multispectral_band_order, abscal_factors, scene['earth_sun_distance'],
+                                                   scene['solar_zenith_angle'])
+    assert numpy.array_equal(read_output(out_path, written_format, expected.shape), expected)
+
+@pytest.mark.parametrize('output_format', output_formats)
+def test_a_cancelled_scene_leaves_no_output(tmp_path, output_format):
+    in_path = write_geotiff(tmp_path / 'scene.tif', random_dns((1, 13, 7), 'uint16'))
+    cancel = threading.Event()
+    with pytest.raises(ProcessingCancelled):
+        process_scene(in_path, 'Red', output_format=output_format, block_rows=4, cancel=cancel,
+                      progress=lambda done, total: cancel.set(), **scene)
+    assert os.listdir(str(tmp_path)) == ['scene.tif']
+
+@pytest.mark.parametrize('output_format', output_formats)
+def test_a_scene_that_fails_part_way_keeps_the_earlier_output(tmp_path, output_format):
+    in_path = write_geotiff(tmp_path / 'scene.tif', random_dns((1, 13, 7), 'uint16'))
+    out_path = output_path_for(in_path, output_format)
+    with open(out_path, 'w') as earlier_output:
+        earlier_output.write('from an earlier run')
+
+    def failing_progress(done, total):
+        raise IOError("the disk is full")
+    with pytest.raises(IOError):
+        process_scene(in_path, 'Red', output_format=output_format, block_rows=4, progress=failing_progress, **scene)
+    assert sorted(os.listdir(str(tmp_path))) == sorted(['scene.tif', os.path.basename(out_path)])
+    with open(out_path) as earlier_output:
+        assert earlier_output.read() == 'from an earlier run'
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Command-line batch TOA reflectance conversion of Worldview-3 scenes, without the GUI.
+
+Every scene found in the given directories or glob patterns is converted with
+toa_reflectance.process_scene, in parallel across a pool of processes (one scene per
+process).  Scenes whose output already exists are skipped, unless --overwrite is given.
+Outputs only get their final name once they are complete (see toa_reflectance.write_blocks),
+so a scene whose conversion failed or was killed part way is converted again on the next run.
+
+The scene parameters (band, abscal factor, earth-sun distance, solar zenith angle) are
+given on the command line and apply to every scene.  Per-scene values can be given in a
+JSON file (--scene-parameters), keyed by the scene's file name, for example:
+
+    {"scene_1.tif": {"abscal_factor": 0.0104, "earth_sun_distance": 1.0148, "solar_zenith_angle": 0.61},
+     "scene_2.tif": {"band": "All bands", "abscal_factor": {"Red": 0.0112, "NIR1": 0.0098}}}
+
+With --imd, the abscal factors, effective bandwidths, earth-sun distance and solar zenith
+angle are read from each scene's *.IMD or *.XML metadata file instead (see imd_metadata.py),
+through an on-disk cache so each scene's metadata is only parsed once, however many tiles
+it has.  Values in the per-scene JSON file still override them.
+
+Example:
+    python toa_batch.py /data/wv3/*.tif --band Red --abscal-factor 0.0104 \
+        --earth-sun-distance 1.0148 --solar-zenith-angle 0.61 --format gtiff --workers 8
+    python toa_batch.py /data/wv3 --band "All bands" --imd
+"""
+
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import time
+
+import rasterio
+
+from batch_files import find_scenes
+from imd_metadata import DEFAULT_CACHE_PATH, MetadataCache, parameters_from_metadata
+from toa_reflectance import ALL_BANDS, DEFAULT_BLOCK_ROWS, band_names, output_formats, output_path_for, process_scene
+
+# The scene parameters that can be given per scene, with their command-line defaults
+scene_parameter_names = ['band', 'abscal_factor', 'earth_sun_distance', 'solar_zenith_angle', 'effective_bandwidth']
+
+# The parameters for one scene: the command-line values, then (if a metadata cache is given)
+# the figures from the scene's metadata file, then anything given for that scene (by file name)
+# in the per-scene parameters
+def parameters_for_scene(scene, defaults, scene_parameters, metadata_cache=None):
+    parameters = dict(defaults)
+    overrides = scene_parameters.get(os.path.basename(scene), {})
+    if metadata_cache is not None:
+        band = overrides.get('band', parameters['band'])
+        if band is None:
+            raise ValueError("No band given for " + scene)
+        parameters.update(parameters_from_metadata(metadata_cache.get_for_image(scene), band))
+    parameters.update(overrides)
+    missing = [name for name in scene_parameter_names if name != 'effective_bandwidth' and parameters.get(name) is None]
+    if missing:
+        raise ValueError("No " + ", ".join(missing) + " given for " + scene)
+    return parameters
+
+# Convert one scene.  This runs in a worker process, so it only takes and returns plain values.
+# Returns (scene, output path, number of pixels, seconds taken).
+def convert_scene(scene, out_path, parameters, output_format, block_rows):
+    start = time.perf_counter()
+    with rasterio.open(scene) as src:
+        pixels = src.width * src.height * src.count
+    process_scene(scene, parameters['band'], parameters['abscal_factor'], parameters['earth_sun_distance'],
+                  parameters['solar_zenith_angle'], out_path=out_path, output_format=output_format,
+                  effective_bandwidth=parameters.get('effective_bandwidth'), block_rows=block_rows)
+    return scene, out_path, pixels, time.perf_counter() - start
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Convert Worldview-3 scenes to TOA reflectance, in parallel")
+    parser.add_argument("inputs", nargs="+", help="scene files, directories, or glob patterns")
+    parser.add_argument("--band", choices=band_names + [ALL_BANDS], help="band to calibrate, or '" + ALL_BANDS + "' for every band of a multi-band image")
+    parser.add_argument("--abscal-factor", type=float)
+    parser.add_argument("--earth-sun-distance", type=float)
+    parser.add_argument("--solar-zenith-angle", type=float, help="in radians")
+    parser.add_argument("--effective-bandwidth", type=float, help="overrides the figure in calibration_figures")
+    parser.add_argument("--scene-parameters", help="JSON file of per-scene parameters, keyed by scene file name")
+    parser.add_argument("--imd", action="store_true", help="read the scene parameters from each scene's *.IMD/*.XML metadata file")
+    parser.add_argument("--metadata-cache", default=DEFAULT_CACHE_PATH, help="index of parsed metadata, for --imd (default: %(default)s)")
+    parser.add_argument("--format", choices=output_formats, default='gtiff', help="output format (default: gtiff)")
+    parser.add_argument("--block-rows", type=int, default=DEFAULT_BLOCK_ROWS, help="rows read and converted at a time (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes (default: one per core)")
+    parser.add_argument("--overwrite", action="store_true", help="convert scenes even if their output already exists")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_arguments(argv)
+
+    scene_parameters = {}
+    if args.scene_parameters:
+        with open(args.scene_parameters) as parameters_file:
+            scene_parameters = json.load(parameters_file)
+    defaults = {name: getattr(args, name) for name in scene_parameter_names}
+
+    metadata_cache = MetadataCache(args.metadata_cache) if args.imd else None
+
+    scenes = find_scenes(args.inputs)
+    if not scenes:
+        print("No scenes found")
+        return 1
+
+    # Work out what to do for every scene before starting, so a bad parameter shows up straight away.
+    # A scene whose parameters can't be worked out (a metadata file without the band, say) is
+    # reported as failed, and the others are still converted
+    jobs = []
+    failures = 0
+    skipped = 0
+    for scene in scenes:
+        try:
+            parameters = parameters_for_scene(scene, defaults, scene_parameters, metadata_cache)
+        except ValueError as error:
+            failures += 1
+            print("FAILED    " + scene + ": " + str(error))
+            continue
+        output_format = 'gtiff' if parameters['band'] == ALL_BANDS and args.format == 'txt' else args.format
+        out_path = output_path_for(scene, output_format)
+        if os.path.exists(out_path) and not args.overwrite:
+            skipped += 1
+            print("skipped   " + scene + " (" + os.path.basename(out_path) + " already exists)")
+            continue
+        jobs.append((scene, out_path, parameters, output_format, args.block_rows))
+
+    total_pixels = 0
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(convert_scene, *job): job[0] for job in jobs}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                scene, out_path, pixels, seconds = future.result()
+            except Exception as error:
+                failures += 1
+                print("FAILED    " + futures[future] + ": " + str(error))
+                continue
+            total_pixels += pixels
+            print("converted %s -> %s: %.1f s, %.1f Mpixels/s" % (scene, os.path.basename(out_path), seconds, pixels / seconds / 1e6))
+
+    seconds = time.perf_counter() - start
+    if jobs or failures:
+        print("%d scenes converted, %d failed, %d skipped in %.1f s (%.1f Mpixels/s overall)"
+              % (len(scenes) - failures - skipped, failures, skipped, seconds, total_pixels / seconds / 1e6))
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,446 @@
+# -*- coding: utf-8 -*-
+"""
+TOA (top-of-atmosphere) radiance and reflectance calculation for Worldview-3 images.
+
+This is the calculation part of 2_Question_seven.py, pulled out so it can be imported
+and used without the GUI.  Instead of looping over every pixel, the scene constants
+(gain, abscal factor, effective bandwidth, earth-sun distance, solar irradiance and
+solar zenith angle) are folded into one scale and one offset per band, and the whole
+image is converted with NumPy array operations in float32.
+
+Scenes too large to fit in memory can be processed in blocks of rows with
+calculate_toa_reflectance_windowed, which reads the input with rasterio windows and
+writes each converted block straight to the output.
+
+Multi-band products (the 8-band multispectral image, or all nine bands) are calibrated in
+one pass: the calibration figures are turned into per-band scale and offset vectors once,
+and applied to every band of a block at the same time with numpy broadcasting.
+
+Worldview-3 DNs are 11-bit or 16-bit integers, so for unsigned integer images of up to 16 bits
+a band of a scene has at most 65,536 possible reflectance values.  Those images are converted
+with a lookup table (lut[dn]) built once per band and scene and cached, so there is no
+floating-point work per pixel.
+"""
+
+import functools
+import math
+import numbers
+import os
+import sys
+
+import numpy
+from numpy import float32
+
+import rasterio
+from rasterio.windows import Window
+
+from batch_files import partial_path_for
+
+# These are the gain, offset, effective bandwidth, and band-averaged solar spectral irradiance
+# figures for each band, in dictionary form.  The gain and offset figures came from
+# "ABSOLUTE RADIOMETRIC CALIBRATION",
+# published by Maxar in 2021.
+# The solar spectral irradiance and effective bandwith figures came from the PDF
+# "Radiometric Use of WorldView-3 Imagery",
+# published by DigitalGlobe in 2016.
+calibration_figures = [{"band": "Pan", "gain": 0.955, "offset": -5.505, "effective bandwidth": 0.2896, "band averaged solar_spectral irradiance (Thuillier 2003)": 1574.41},
+                       {"band": "Coastal", "gain": 0.938, "offset": -13.099, "effective bandwidth": 0.0405, "band averaged solar_spectral irradiance (Thuillier 2003)": 1757.89},
+                       {"band": "Blue", "gain": 0.946, "offset": -9.409, "effective bandwidth": 0.0540, "band averaged solar_spectral irradiance (Thuillier 2003)": 2004.61},
+                       {"band": "Green", "gain": 0.958, "offset": -7.771, "effective bandwidth": 0.0618, "band averaged solar_spectral irradiance (Thuillier 2003)": 1830.18},
+                       {"band": "Yellow", "gain": 0.979, "offset": -5.489, "effective bandwidth": 0.0381, "band averaged solar_spectral irradiance (Thuillier 2003)": 1712.07},
+                       {"band": "Red", "gain": 0.969, "offset": -4.579, "effective bandwidth": 0.0585, "band averaged solar_spectral irradiance (Thuillier 2003)": 1535.33},
+                       {"band": "RedEdge", "gain": 1.027, "offset": -5.552, "effective bandwidth": 0.0387, "band averaged solar_spectral irradiance (Thuillier 2003)": 1348.08},
+                       {"band": "NIR1", "gain": 0.977, "offset": -6.508, "effective bandwidth": 0.1004, "band averaged solar_spectral irradiance (Thuillier 2003)": 1055.94},
+                       {"band": "NIR2", "gain": 1.007, "offset": -3.699, "effective bandwidth": 0.0889, "band averaged solar_spectral irradiance (Thuillier 2003)": 858.77}]
+
+# The band names, in the same order as the "calibration_figures" list above
+band_names = [b['band'] for b in calibration_figures]
+
+def getValueFromBand(band, value):
+    for b in calibration_figures:
+        if (b['band'] == band):
+            return b[value]
+    raise ValueError("Unknown Worldview-3 band: " + str(band))
+
+# The TOA calculation for one pixel is
+#
+#   radiance    = gain * (DN * (abscal_factor / effective_bandwidth)) + offset
+#   reflectance = (radiance * earth_sun_distance^2 * pi) / (solar_irradiance * cos(solar_zenith_angle))
+#
+# Everything except DN is constant for a band of a scene, so it can be rewritten as
+#
+#   reflectance = DN * scale + offset
+#
+# This function works out that scale and offset for one band.  As in the GUI, the solar
+# zenith angle is passed straight to math.cos, so it is in radians.
+# The effective bandwidth can be given explicitly (for example, the value from the scene's
+# *.imd file); otherwise the figure from "calibration_figures" is used.
+def band_scale_and_offset(band, abscal_factor, earth_sun_distance, solar_zenith_angle, effective_bandwidth=None):
+    gain = getValueFromBand(band, 'gain')
+    offset = getValueFromBand(band, 'offset')
+    if effective_bandwidth is None:
+        effective_bandwidth = getValueFromBand(band, 'effective bandwidth')
+    solar_irradiance = getValueFromBand(band, 'band averaged solar_spectral irradiance (Thuillier 2003)')
+
+    reflectance_factor = (pow(earth_sun_distance, 2) * math.pi) / (solar_irradiance * math.cos(solar_zenith_angle))
+
+    scale = gain * (abscal_factor / effective_bandwidth) * reflectance_factor
+    return scale, offset * reflectance_factor
+
+# Convert an array of DNs to TOA radiance, using the same formula as the per-pixel version
+def calculate_toa_radiance(dn, band, abscal_factor, effective_bandwidth=None):
+    gain = getValueFromBand(band, 'gain')
+    offset = getValueFromBand(band, 'offset')
+    if effective_bandwidth is None:
+        effective_bandwidth = getValueFromBand(band, 'effective bandwidth')
+
+    radiance = numpy.multiply(dn, float32(gain * (abscal_factor / effective_bandwidth)), dtype=float32)
+    radiance += float32(offset)
+    return radiance
+
+# Convert an array of DNs (any shape, any numeric dtype) to TOA reflectance with a
+# precomputed scale and offset (see band_scale_and_offset above).
+# The result is a float32 array of the same shape.  If "out" is given, the result is
+# written into it instead of into a newly allocated array.
+def apply_scale_and_offset(dn, scale, offset, out=None):
+    out = numpy.multiply(dn, float32(scale), out=out, dtype=float32)
+    out += float32(offset)
+    return out
+
+# ------------------ Lookup tables for integer DNs ---------------------------------------
+# How many lookup tables (one per band and scene) are kept.  A 16-bit table is 256 KB.
+LOOKUP_TABLE_CACHE_SIZE = 64
+
+# The number of entries a lookup table needs for images of this dtype, or None if the image
+# can't be converted with a lookup table (floating point, signed, or more than 16 bits)
+def lookup_table_size(dtype):
+    dtype = numpy.dtype(dtype)
+    if dtype.kind == 'u' and dtype.itemsize <= 2:
+        return 2 ** (8 * dtype.itemsize)
+    return None
+
+# The TOA reflectance of every possible DN (0 to size - 1) of one band of a scene, as a float32 array.
+# The values are calculated with apply_scale_and_offset, so they are exactly what the direct
+# calculation gives.  Tables are cached by (band, abscal factor, earth-sun distance, solar zenith
+# angle, effective bandwidth, size), so every block or tile of the same scene reuses the same table.
+# The returned array is shared between callers, so it is read-only.
+@functools.lru_cache(maxsize=LOOKUP_TABLE_CACHE_SIZE)
+def reflectance_lookup_table(band, abscal_factor, earth_sun_distance, solar_zenith_angle, effective_bandwidth=None, size=65536):
+    scale, offset = band_scale_and_offset(band, abscal_factor, earth_sun_distance, solar_zenith_angle, effective_bandwidth)
+    lookup_table = apply_scale_and_offset(numpy.arange(size), scale, offset)
+    lookup_table.setflags(write=False)
+    return lookup_table
+
+# Convert an array of DNs for one band straight to TOA reflectance.
+# Unsigned integer images of up to 16 bits are converted with a single gather from the
+# band's lookup table; anything else is converted with the band's scale and offset.
+def calculate_toa_reflectance(dn, band, abscal_factor, earth_sun_distance, solar_zenith_angle, effective_bandwidth=None, out=None):
+    dn = numpy.asarray(dn)
+    size = lookup_table_size(dn.dtype)
+    if size is not None:
+        lookup_table = reflectance_lookup_table(band, abscal_factor, earth_sun_distance, solar_zenith_angle, effective_bandwidth, size)
+        return numpy.take(lookup_table, dn, out=out)
+
+    scale, offset = band_scale_and_offset(band, abscal_factor, earth_sun_distance, solar_zenith_angle, effective_bandwidth)
+    return apply_scale_and_offset(dn, scale, offset, out)
+
+# Band order of the Worldview-3 multispectral (8-band) product, and of a product with all
+# nine bands, Pan first, as in "calibration_figures"
+multispectral_band_order = ['Coastal', 'Blue', 'Green', 'Yellow', 'Red', 'RedEdge', 'NIR1', 'NIR2']
+all_band_order = ['Pan'] + multispectral_band_order
+
+# Guess which Worldview-3 bands an image holds from how many bands it has
+def default_band_order(band_count):
+    if band_count == len(multispectral_band_order):
+        return multispectral_band_order
+    if band_count == len(all_band_order):
+        return all_band_order
+    raise ValueError("Can't tell which Worldview-3 bands a " + str(band_count) + "-band image holds; pass the band names explicitly")
+
+# Turn "calibration_figures" into one scale and one offset per band (see band_scale_and_offset),
+# as float32 vectors in the order of "bands".
+# "abscal_factors" and "effective_bandwidths" can each be a single number used for every band,
+# a list in the same order as "bands", or a dictionary keyed by band name.
+def band_coefficient_vectors(bands, abscal_factors, earth_sun_distance, solar_zenith_angle, effective_bandwidths=None):
+    scales = numpy.empty(len(bands), dtype=float32)
+    offsets = numpy.empty(len(bands), dtype=float32)
+    for i, band in enumerate(bands):
+        scales[i], offsets[i] = band_scale_and_offset(band,
+                                                      _value_for_band(abscal_factors, band, i),
+                                                      earth_sun_distance,
+                                                      solar_zenith_angle,
+                                                      _value_for_band(effective_bandwidths, band, i))
+    return scales, offsets
+
+def _value_for_band(values, band, index):
+    if values is None or isinstance(values, numbers.Real):
+        return values
+    if isinstance(values, dict):
+        return values.get(band)
+    return values[index]
+
+# Convert a (bands, rows, columns) array of DNs to TOA reflectance, with the per-band scale and
+# offset vectors from band_coefficient_vectors.  The vectors are broadcast over rows and columns,
+# so every band is converted in one operation.
+def apply_band_coefficients(dn, scales, offsets, out=None):
+    out = numpy.multiply(dn, scales[:, None, None], out=out, dtype=float32)
+    out += offsets[:, None, None]
+    return out
+
+# Convert a (bands, rows, columns) array of DNs to TOA reflectance, each band with its own
+# figures.  Integer images use each band's cached lookup table; anything else uses the
+# broadcast scale and offset vectors.
+def calculate_multiband_toa_reflectance(dn, bands, abscal_factors, earth_sun_distance, solar_zenith_angle, effective_bandwidths=None, out=None):
+    dn = numpy.asarray(dn)
+    if lookup_table_size(dn.dtype) is None:
+        scales, offsets = band_coefficient_vectors(bands, abscal_factors, earth_sun_distance, solar_zenith_angle, effective_bandwidths)
+        return apply_band_coefficients(dn, scales, offsets, out)
+
+    if out is None:
+        out = numpy.empty(dn.shape, dtype=float32)
+    for i, band in enumerate(bands):
+        calculate_toa_reflectance(dn[i], band,
+                                  _value_for_band(abscal_factors, band, i),
+                                  earth_sun_distance,
+                                  solar_zenith_angle,
+                                  _value_for_band(effective_bandwidths, band, i),
+                                  out=out[i])
+    return out
+
+# The GUI writes a 2D text file, so images with more than one channel (the RGB test images)
+# are averaged into one value per pixel.  Because the TOA conversion is linear, the average
+# of the converted channels is the same as converting the averaged channels, but we convert
+# first so the numbers match the original script.
+def to_single_layer(reflectance):
+    if reflectance.ndim == 3:
+        return reflectance.mean(axis=2, dtype=float32)
+    return reflectance
+
+# ------------------ Out-of-core (windowed) processing -----------------------------------
+# How many rows of the image are read, converted and written at a time.  Peak memory is
+# roughly block_rows * width * (number of input bands) * (4 bytes for float32 + the input
+# pixel size), no matter how big the scene is.
+DEFAULT_BLOCK_ROWS = 512
+
+# Split an image of the given height and width into windows of "block_rows" full-width rows
+def row_windows(height, width, block_rows=DEFAULT_BLOCK_ROWS):
+    for row in range(0, height, block_rows):
+        yield Window(0, row, width, min(block_rows, height - row))
+
+# Read an open rasterio dataset one block of rows at a time and yield each window
+# together with its TOA reflectance.  All bands of the input are converted with the
+# figures of the same band and averaged into one layer, as the GUI does.
+def toa_reflectance_blocks(src, band, abscal_factor, earth_sun_distance, solar_zenith_angle,
+                           effective_bandwidth=None, block_rows=DEFAULT_BLOCK_ROWS):
+    for window in row_windows(src.height, src.width, block_rows):
+        reflectance = calculate_toa_reflectance(src.read(window=window), band, abscal_factor, earth_sun_distance,
+                                                solar_zenith_angle, effective_bandwidth)
+        if reflectance.shape[0] == 1:
+            yield window, reflectance[0]
+        else:
+            yield window, reflectance.mean(axis=0, dtype=float32)
+
+# ------------------ Output formats ------------------------------------------------------
+# The TOA reflectance can be written as
+#   'txt'     - the original numpy.savetxt text file (single layer only)
+#   'gtiff'   - a tiled, DEFLATE-compressed float32 GeoTIFF with the input's CRS and geotransform
+#   'npy'     - a .npy file, which numpy.load(path, mmap_mode='r') can read in windows
+#   'memmap'  - a raw float32 file (band, row, column order) with an ENVI .hdr header next to it,
+#               which can be opened with numpy.memmap or GDAL
+# Binary outputs keep the same row/column layout as the input image: single-layer results are
+# (rows, columns) and multi-band results are (bands, rows, columns).
+output_formats = ['txt', 'gtiff', 'npy', 'memmap']
+
+# The file extension each output format is saved with
+output_extensions = {'txt': '.txt', 'gtiff': '.tif', 'npy': '.npy', 'memmap': '.dat'}
+
+# GeoTIFF creation options for the 'gtiff' output
+gtiff_creation_options = {'tiled': True,
+                          'blockxsize': 256,
+                          'blockysize': 256,
+                          'compress': 'deflate',
+                          'predictor': 3,
+                          'BIGTIFF': 'IF_SAFER'}
+
+# Each writer is created with the size of the output, written to one window (block of rows)
+# at a time, and closed at the end.  "data" is (rows, columns) for one layer, or
+# (bands, rows, columns).
+
+class TextWriter:
+    def __init__(self, path, height, width, count=1, crs=None, transform=None):
+        if count != 1:
+            raise ValueError("The text output can only hold one layer; use 'gtiff', 'npy' or 'memmap' for multi-band results")
+        self.file = open(path, "w")
+
+    def write(self, window, data):
+        numpy.savetxt(self.file, data.reshape(data.shape[-2:]), newline="\n")
+
+    def close(self):
+        self.file.close()
+
+class GeoTIFFWriter:
+    def __init__(self, path, height, width, count=1, crs=None, transform=None, band_descriptions=None):
+        self.dataset = rasterio.open(path, 'w', driver='GTiff', height=height, width=width, count=count,
+                                     dtype='float32', crs=crs, transform=transform, **gtiff_creation_options)
+        for i, description in enumerate(band_descriptions or []):
+            self.dataset.set_band_description(i + 1, description)
+
+    def write(self, window, data):
+        if data.ndim == 2:
+            self.dataset.write(data, 1, window=window)
+        else:
+            self.dataset.write(data, window=window)
+
+    def close(self):
+        self.dataset.close()
+
+# The 'npy' and 'memmap' writers both write into a memory-mapped array on disk,
+# so only the block being written is ever in memory
+class MemmapWriter:
+    def __init__(self, path, height, width, count=1, crs=None, transform=None, npy=False):
+        shape = (height, width) if count == 1 else (count, height, width)
+        if npy:
+            self.array = numpy.lib.format.open_memmap(path, mode='w+', dtype=float32, shape=shape)
+        else:
+            self.array = numpy.memmap(path, mode='w+', dtype=float32, shape=shape)
+            write_envi_header(path, height, width, count, transform)
+
+    def write(self, window, data):
+        rows = slice(window.row_off, window.row_off + window.height)
+        columns = slice(window.col_off, window.col_off + window.width)
+        self.array[..., rows, columns] = data
+
+    def close(self):
+        self.array.flush()
+        del self.array
+
+# The ENVI header file that goes with a 'memmap' output
+def header_path_for(path):
+    return os.path.splitext(path)[0] + ".hdr"
+
+# A minimal ENVI header, so the raw 'memmap' output can be opened (with its georeferencing) by GDAL
+def write_envi_header(path, height, width, count, transform=None):
+    lines = ["ENVI",
+             "samples = " + str(width),
+             "lines = " + str(height),
+             "bands = " + str(count),
+             "header offset = 0",
+             "file type = ENVI Standard",
+             "data type = 4",
+             "interleave = bsq",
+             "byte order = " + ("0" if sys.byteorder == 'little' else "1")]
+    if transform is not None:
+        lines.append("map info = {Arbitrary, 1, 1, %r, %r, %r, %r}" % (transform.c, transform.f, transform.a, -transform.e))
+    with open(header_path_for(path), "w") as header:
+        header.write("\n".join(lines) + "\n")
+
+# Open a writer for one of the "output_formats"
+def open_reflectance_writer(path, output_format, height, width, count=1, crs=None, transform=None, band_descriptions=None):
+    if output_format == 'txt':
+        return TextWriter(path, height, width, count)
+    if output_format == 'gtiff':
+        return GeoTIFFWriter(path, height, width, count, crs, transform, band_descriptions)
+    if output_format == 'npy':
+        return MemmapWriter(path, height, width, count, npy=True)
+    if output_format == 'memmap':
+        return MemmapWriter(path, height, width, count, transform=transform)
+    raise ValueError("Unknown output format " + repr(output_format) + ", choose one of " + ", ".join(output_formats))
+
+# Raised by the windowed functions below when they are cancelled part way through
+class ProcessingCancelled(Exception):
+    pass
+
+# Write converted blocks (pairs of window and data) to a writer one at a time, then close it.  The
+# writer writes to partial_path_for(out_path), which is renamed to "out_path" once every block is
+# written; if anything goes wrong, the partly written file is deleted.
+# "progress", if given, is called after each block with (rows done, total rows).
+# "cancel", if given, is checked before each block (anything with an is_set() method, such as a
+# threading.Event); if it is set, the partly written output is deleted and ProcessingCancelled is raised.
+def write_blocks(writer, blocks, out_path, height, progress=None, cancel=None):
+    write_path = partial_path_for(out_path)
+    try:
+        try:
+            for window, data in blocks:
+                if cancel is not None and cancel.is_set():
+                    raise ProcessingCancelled()
+                writer.write(window, data)
+                if progress is not None:
+                    progress(window.row_off + window.height, height)
+        finally:
+            writer.close()
+    except BaseException:
+        for path in (write_path, header_path_for(write_path)):
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+
+    os.replace(write_path, out_path)
+    if os.path.exists(header_path_for(write_path)):
+        os.replace(header_path_for(write_path), header_path_for(out_path))
+
+# Convert a whole scene without ever holding it in memory.  The input is read with
+# rasterio in blocks of "block_rows" rows, and every converted block is written to the
+# output (in "output_format", see above) before the next block is read.
+# "progress" and "cancel" are passed on to write_blocks.
+def calculate_toa_reflectance_windowed(in_path, out_path, band, abscal_factor, earth_sun_distance, solar_zenith_angle,
+                                       effective_bandwidth=None, block_rows=DEFAULT_BLOCK_ROWS, progress=None, output_format='txt',
+                                       cancel=None):
+    with rasterio.open(in_path) as src:
+        writer = open_reflectance_writer(partial_path_for(out_path), output_format, src.height, src.width, 1, src.crs, src.transform, [band])
+        blocks = toa_reflectance_blocks(src, band, abscal_factor, earth_sun_distance, solar_zenith_angle, effective_bandwidth, block_rows)
+        write_blocks(writer, blocks, out_path, src.height, progress, cancel)
+    return out_path
+
+# Calibrate every band of a multi-band image in a single read of the file.  The input is read
+# in blocks of "block_rows" rows with all bands at once, each block is converted with
+# calculate_multiband_toa_reflectance, and written straight to the output, which has the same
+# number of bands and size as the input ("output_format" is 'gtiff', 'npy' or 'memmap').
+# If "bands" isn't given, it is guessed from the number of bands (see default_band_order).
+def calculate_multiband_toa_reflectance_windowed(in_path, out_path, abscal_factors, earth_sun_distance, solar_zenith_angle,
+                                                 bands=None, effective_bandwidths=None, block_rows=DEFAULT_BLOCK_ROWS, progress=None,
+                                                 output_format='gtiff', cancel=None):
+    with rasterio.open(in_path) as src:
+        if bands is None:
+            bands = default_band_order(src.count)
+        if len(bands) != src.count:
+            raise ValueError(str(len(bands)) + " band names given for a " + str(src.count) + "-band image")
+
+        writer = open_reflectance_writer(partial_path_for(out_path), output_format, src.height, src.width, src.count, src.crs, src.transform, bands)
+        blocks = ((window, calculate_multiband_toa_reflectance(src.read(window=window), bands, abscal_factors, earth_sun_distance,
+                                                               solar_zenith_angle, effective_bandwidths))
+                  for window in row_windows(src.height, src.width, block_rows))
+        write_blocks(writer, blocks, out_path, src.height, progress, cancel)
+    return out_path
+
+# ------------------ Whole scenes ---------------------------------------------------------
+# The name "bands" is given for calibrating every band of a multi-band image at once
+ALL_BANDS = 'All bands'
+
+# The output file for an input image: the same directory and name, with the suffix
+# "_resampled_and_converted" and the extension of the output format
+def output_path_for(in_path, output_format='txt'):
+    return os.path.splitext(in_path)[0] + "_resampled_and_converted" + output_extensions[output_format]
+
+# Convert one scene, the way the GUI does.  "band" is one of the band names in "calibration_figures",
+# or ALL_BANDS to calibrate every band of a multi-band image in one pass (a text file can only hold
+# one layer, so multi-band results written as 'txt' are saved as a GeoTIFF instead).
+# "abscal_factor" (and "effective_bandwidth") can be a single number, or, for ALL_BANDS, a list or a
+# dictionary keyed by band name.  If "out_path" isn't given, it comes from output_path_for.
+# "progress" and "cancel" are passed on to write_blocks.
+# Returns the path of the output file.
+def process_scene(in_path, band, abscal_factor, earth_sun_distance, solar_zenith_angle, out_path=None,
+                  output_format='txt', effective_bandwidth=None, block_rows=DEFAULT_BLOCK_ROWS, progress=None, cancel=None):
+    if band == ALL_BANDS:
+        if output_format == 'txt':
+            output_format = 'gtiff'
+        if out_path is None:
+            out_path = output_path_for(in_path, output_format)
+        return calculate_multiband_toa_reflectance_windowed(in_path, out_path, abscal_factor, earth_sun_distance, solar_zenith_angle,
+                                                            effective_bandwidths=effective_bandwidth, block_rows=block_rows,
+                                                            progress=progress, output_format=output_format, cancel=cancel)
+
+    if out_path is None:
+        out_path = output_path_for(in_path, output_format)
+    return calculate_toa_reflectance_windowed(in_path, out_path, band, abscal_factor, earth_sun_distance, solar_zenith_angle,
+                                              effective_bandwidth=effective_bandwidth, block_rows=block_rows,
+                                              progress=progress, output_format=output_format, cancel=cancel)